@@ -2,6 +2,19 @@ import argparse
 from pathlib import Path
 import mltable
 from workflowhelperfunc.workflowhelper import setup_logger, log_event
+from taxi_partitions import (
+    COLORS,
+    DATA_ROOT,
+    PARTITION_FORMAT,
+    YEARS,
+    is_remote,
+    parse_int_list,
+    projected_columns,
+)
+from partition_index import indexed_files, simple_predicates
+
+# Trips kept by preprocess_data
+TRIP_FILTER = "col('tripDistance') > 0"
 
 ## This logic needs to be reviewed and updated, don't think deleting a file is the right way to go
 def create_directories(save_dir, logger):
@@ -30,41 +43,97 @@ def create_directories(save_dir, logger):
     return mltable_dir
 
 
-def load_data():
+def partition_patterns(root=DATA_ROOT, colors=COLORS, years=YEARS, months=None):
     """
-    Load data from predefined paths.
+    Build the glob patterns of the partitions to read.
+
+    Only the colors, years and months asked for are matched, so the other
+    partitions are never listed or opened. A local root only gets the patterns
+    of partitions that exist, as mltable fails on a pattern matching no file.
+
+    Args:
+        root (str): The data root, the Azure Open Datasets container or a local
+            folder with the same <color>/puYear=<year>/puMonth=<month> layout.
+        colors (list[str]): The taxi colors to read.
+        years (list[int]): The pickup years to read.
+        months (list[int], optional): The pickup months to read. Defaults to all.
 
     Returns:
-        mltable.mltable: The loaded ML table.
+        list[dict]: The path patterns, as mltable.from_parquet_files takes them.
     """
-    # Define the data source
-    paths = [
-        {
-            "pattern": f"wasbs://nyctlc@azureopendatastorage.blob.core.windows\
-                .net/{color}/puYear={year}/puMonth=*/**/*.parquet"
-        }
-        for color in ["green", "yellow"]
-        for year in range(2015, 2020)
+    month_parts = ["*"] if not months else [str(month) for month in months]
+    patterns = [
+        f"{root.rstrip('/')}/{color}/puYear={year}/puMonth={month}/**/*.parquet"
+        for color in colors
+        for year in years
+        for month in month_parts
     ]
+    if not is_remote(root):
+        patterns = [pattern for pattern in patterns if _local_matches(pattern)]
+    return [{"pattern": pattern} for pattern in patterns]
+
+
+def _local_matches(pattern):
+    """
+    Check whether a local glob pattern matches at least one file.
+    """
+    path = Path(pattern)
+    anchor = Path(path.anchor) if path.is_absolute() else Path(".")
+    relative = path.relative_to(anchor) if path.is_absolute() else path
+    return next(anchor.glob(str(relative)), None) is not None
+
+
+def load_data(root=DATA_ROOT, colors=COLORS, years=YEARS, months=None, columns=None, paths=None):
+    """
+    Load the partitions and columns of the taxi data that are asked for.
+
+    The partition predicates are applied to the path patterns and the column
+    list is applied before any other step, so the parquet reader only opens the
+    matching partitions and only decodes the listed columns.
+
+    Args:
+        root (str): The data root, see partition_patterns.
+        colors (list[str]): The taxi colors to read.
+        years (list[int]): The pickup years to read.
+        months (list[int], optional): The pickup months to read. Defaults to all.
+        columns (list[str], optional): The columns to read. Defaults to all.
+        paths (list[dict], optional): The files to read, e.g. from
+            partition_index.indexed_files, instead of the partition patterns.
+
+    Returns:
+        mltable.mltable: The loaded ML table, with year and month columns.
+
+    Raises:
+        FileNotFoundError: If no partition matches.
+    """
+    if paths is None:
+        paths = partition_patterns(root, colors, years, months)
+    if not paths:
+        raise FileNotFoundError(f"No taxi data partitions under {root} match the selection")
 
     # Load the data and create an ML table
     tbl = mltable.from_parquet_files(paths)
+    tbl = tbl.extract_columns_from_partition_format(PARTITION_FORMAT)
+    if columns is not None:
+        tbl = tbl.keep_columns(columns + ["year", "month"])
     return tbl
 
-def preprocess_data(tbl):
+def preprocess_data(tbl, projected=False):
     """
     Preprocess the data.
 
     Args:
         tbl (mltable.mltable): The mltable to preprocess.
+        projected (bool): Whether load_data already kept only the needed
+            columns, in which case the location columns were never read.
 
     Returns:
         mltable.mltable: The preprocessed ML table.
     """
     tbl = tbl.take_random_sample(probability=0.001, seed=735)
-    tbl = tbl.filter("col('tripDistance') > 0")
-    tbl = tbl.drop_columns(["puLocationId", "doLocationId"])
-    tbl = tbl.extract_columns_from_partition_format("/puYear={year}/puMonth={month}")
+    tbl = tbl.filter(TRIP_FILTER)
+    if not projected:
+        tbl = tbl.drop_columns(["puLocationId", "doLocationId"])
 
     # Set the table name
     tbl.name = "NYC_taxi"
@@ -92,11 +161,45 @@ def main():
     try:
         parser = argparse.ArgumentParser(description='Create and save ML table.')
         parser.add_argument('save_directory', type=str, help='Directory to save data')
+        parser.add_argument('--data_root', type=str, default=DATA_ROOT,
+                            help='Root of the taxi data, or a local folder with the same layout')
+        parser.add_argument('--colors', type=str, default=','.join(COLORS),
+                            help='Comma separated taxi colors to read')
+        parser.add_argument('--years', type=str, default=f'{YEARS[0]}-{YEARS[-1]}',
+                            help='Pickup years to read, e.g. 2015-2017 or 2015,2019')
+        parser.add_argument('--months', type=str, default='',
+                            help='Pickup months to read, e.g. 1-3 (empty reads every month)')
+        parser.add_argument('--all_columns', action='store_true',
+                            help='Read every column instead of the ones the pipeline needs')
+        parser.add_argument('--index_root', type=str, default='',
+                            help='Local root of the partition_index.py indexes, to only read the '
+                                 'files that can hold trips to keep')
         args = parser.parse_args()
 
+        colors = args.colors.split(',')
+        unknown = set(colors) - set(COLORS)
+        if unknown:
+            raise ValueError(f"Unknown taxi colors: {sorted(unknown)}")
+        years = parse_int_list(args.years)
+        months = parse_int_list(args.months) if args.months else None
+        columns = None if args.all_columns else projected_columns(colors)
+
+        log_event(logger, 'info', f"Reading {colors} taxi data for years {years}, "
+                  f"months {months or 'all'}, columns {columns or 'all'} from {args.data_root}")
+
+        paths = None
+        if args.index_root:
+            files, certain, possible = indexed_files(
+                args.data_root, args.index_root, colors, years, months,
+                simple_predicates(TRIP_FILTER),
+            )
+            paths = [{'file': path} for path in files]
+            log_event(logger, 'info', f"The index keeps {len(files)} files, with {certain} to "
+                      f"{possible} trips matching {TRIP_FILTER}")
+
         mltable_dir = create_directories(args.save_directory, logger)
-        tbl = load_data()
-        tbl = preprocess_data(tbl)
+        tbl = load_data(args.data_root, colors, years, months, columns, paths)
+        tbl = preprocess_data(tbl, projected=columns is not None)
         save_data(tbl, mltable_dir)
 
         log_event(logger, 'info', "ML table created and saved successfully.")
@@ -0,0 +1,462 @@
+"""
+Evaluate an MLTable definition locally, with a multithreaded Arrow dataset scan.
+
+The mltable runtime only evaluates data_mltable/MLTable against blob storage.
+This script parses the same YAML and runs its transformations over local
+parquet folders, so an MLTable can be materialized and benchmarked offline.
+
+The transformations are planned before anything is read:
+    - extract_columns_from_partition_format and read_parquet's path column
+      become constant columns of each file, so a filter on them skips whole
+      files without opening them.
+    - filter expressions are translated to Arrow expressions and pushed into
+      the scan, which also skips the row groups their statistics rule out.
+    - drop_columns and keep_columns only decide which columns are decoded.
+    - take_random_sample keeps each row of the filtered scan with the given
+      probability, from a generator seeded with the given seed. Sampling after
+      the filters instead of before does not change the distribution of the
+      sample, but the rows drawn differ from the mltable runtime's draw.
+
+With --use_index, the row group statistics indexes of partition_index.py
+also skip the row groups and files the filters cannot match without opening
+them.
+
+Paths outside the MLTable folder, such as the wasbs:// patterns of the taxi
+data, are mapped onto local folders with --path_map.
+
+Usage:
+    python dataEngineer/nyc_taxi/src/local_mltable.py dataEngineer/nyc_taxi/data_mltable <output.parquet> \\
+        --path_map wasbs://nyctlc@azureopendatastorage.blob.core.windows.net=<local folder>
+"""
+import argparse
+import ast
+import glob
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import yaml
+from workflowhelperfunc.workflowhelper import setup_logger, log_event
+from partition_index import find_index, may_match, simple_predicates
+
+REPO_ROOT = Path(__file__).resolve().parents[3]
+sys.path.insert(0, str(REPO_ROOT / "data_science" / "nyc_taxi" / "src"))
+from taxi_io import common_arrow_type  # noqa: E402
+
+TRANSFORMATIONS = [
+    "extract_columns_from_partition_format",
+    "read_parquet",
+    "take_random_sample",
+    "filter",
+    "drop_columns",
+    "keep_columns",
+]
+
+_COMPARISONS = {
+    ast.Eq: lambda left, right: left == right,
+    ast.NotEq: lambda left, right: left != right,
+    ast.Lt: lambda left, right: left < right,
+    ast.LtE: lambda left, right: left <= right,
+    ast.Gt: lambda left, right: left > right,
+    ast.GtE: lambda left, right: left >= right,
+}
+_OPERATORS = {
+    ast.BitAnd: lambda left, right: left & right,
+    ast.BitOr: lambda left, right: left | right,
+    ast.Add: lambda left, right: left + right,
+    ast.Sub: lambda left, right: left - right,
+    ast.Mult: lambda left, right: left * right,
+    ast.Div: lambda left, right: left / right,
+}
+
+
+def load_definition(mltable_dir):
+    """
+    Read the MLTable file of a folder.
+
+    Args:
+        mltable_dir (str): The folder holding the MLTable file.
+
+    Returns:
+        dict: The parsed definition.
+    """
+    with open(Path(mltable_dir) / "MLTable", "r") as f:
+        return yaml.safe_load(f)
+
+
+def parse_path_map(entries):
+    """
+    Parse the --path_map entries.
+
+    Args:
+        entries (list[str]): Entries of the form <url prefix>=<local folder>.
+
+    Returns:
+        list[tuple[str, str]]: The prefixes and the folders they map to.
+    """
+    mapping = []
+    for entry in entries:
+        prefix, sep, folder = entry.rpartition("=")
+        if not sep or not prefix:
+            raise ValueError(f"Invalid path map {entry}, expected <url prefix>=<local folder>")
+        mapping.append((prefix.rstrip("/"), folder.rstrip("/")))
+    return mapping
+
+
+def resolve_paths(paths, mltable_dir, path_map):
+    """
+    List the local files the paths of an MLTable point to.
+
+    Args:
+        paths (list[dict]): The file, folder or pattern entries of the MLTable.
+        mltable_dir (str): The MLTable folder, which relative paths are under.
+        path_map (list[tuple[str, str]]): The URL prefixes and their local folders.
+
+    Returns:
+        list[str]: The files, sorted by path within each entry.
+
+    Raises:
+        ValueError: If a URL has no local folder mapped.
+    """
+    files = []
+    for entry in paths:
+        (kind, path), = entry.items()
+        for prefix, folder in path_map:
+            if path.startswith(prefix):
+                path = folder + path[len(prefix):]
+                break
+        if "://" in path:
+            raise ValueError(f"No local folder for {path}, map it with --path_map")
+        path = os.path.join(mltable_dir, path)
+
+        if kind == "file":
+            matches = [path]
+        elif kind == "folder":
+            matches = glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True)
+        elif kind == "pattern":
+            matches = glob.glob(path, recursive=True)
+        else:
+            raise ValueError(f"Unknown path kind {kind}")
+        files += sorted(match for match in matches if os.path.isfile(match))
+    return files
+
+
+def partition_values(files, partition_format, ignore_errors):
+    """
+    Extract the columns of a partition format from the file paths.
+
+    Args:
+        files (list[str]): The files.
+        partition_format (str): The format, e.g. /puYear={year}/puMonth={month}.
+        ignore_errors (bool): Whether a path not matching gives nulls instead
+            of an error.
+
+    Returns:
+        dict: Column -> value of each file. Columns whose values are all
+            integers are converted to int.
+    """
+    names = re.findall(r"\{(\w+)\}", partition_format)
+    pattern = ""
+    for literal, name in re.findall(r"([^{]*)\{(\w+)\}", partition_format):
+        pattern += re.escape(literal) + f"(?P<{name}>[^/]+)"
+    pattern = re.compile(pattern)
+
+    values = {name: [] for name in names}
+    for path in files:
+        match = pattern.search(Path(path).as_posix())
+        if match is None and not ignore_errors:
+            raise ValueError(f"{path} does not match the partition format {partition_format}")
+        for name in names:
+            values[name].append(match[name] if match else None)
+
+    for name, column in values.items():
+        if all(value is None or value.isdigit() for value in column):
+            values[name] = [None if value is None else int(value) for value in column]
+    return values
+
+
+def parse_filter(expression):
+    """
+    Translate an mltable filter expression into an Arrow expression.
+
+    Supports col('name'), constants, comparisons, the & | ~ and, or, not
+    operators and arithmetic, e.g. "col('tripDistance') > 0".
+
+    Args:
+        expression (str): The mltable filter expression.
+
+    Returns:
+        tuple: The Arrow expression and the set of columns it reads.
+
+    Raises:
+        ValueError: If the expression uses anything else.
+    """
+    columns = set()
+
+    def translate(node):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id == "col"
+            and len(node.args) == 1
+            and isinstance(node.args[0], ast.Constant)
+        ):
+            columns.add(node.args[0].value)
+            return ds.field(node.args[0].value)
+        if isinstance(node, ast.Compare):
+            result, left = None, translate(node.left)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = translate(comparator)
+                term = _COMPARISONS[type(op)](left, right)
+                result = term if result is None else result & term
+                left = right
+            return result
+        if isinstance(node, ast.BoolOp):
+            terms = [translate(value) for value in node.values]
+            result = terms[0]
+            for term in terms[1:]:
+                result = result & term if isinstance(node.op, ast.And) else result | term
+            return result
+        if isinstance(node, ast.BinOp) and type(node.op) in _OPERATORS:
+            return _OPERATORS[type(node.op)](translate(node.left), translate(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.Invert)):
+            return ~translate(node.operand)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return -translate(node.operand)
+        raise ValueError(f"Unsupported filter expression: {expression}")
+
+    try:
+        tree = ast.parse(expression, mode="eval")
+        return translate(tree.body), columns
+    except (KeyError, SyntaxError) as error:
+        raise ValueError(f"Unsupported filter expression: {expression}") from error
+
+
+def read_schema(files, threads):
+    """
+    Unify the schemas of the files, read from their footers in parallel.
+
+    The columns keep the order they are first seen in, and their types are
+    combined with common_arrow_type.
+
+    Args:
+        files (list[str]): The parquet files.
+        threads (int): The number of footers read at a time.
+
+    Returns:
+        pa.Schema: A schema every file can be cast to.
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        schemas = list(executor.map(pq.read_schema, files))
+    types = {}
+    for schema in schemas:
+        for field in schema:
+            types.setdefault(field.name, []).append(field.type)
+    return pa.schema([(name, common_arrow_type(column_types)) for name, column_types in types.items()])
+
+
+def plan_scan(definition, files, threads, use_index=False):
+    """
+    Turn the transformations of an MLTable into one dataset scan.
+
+    Args:
+        definition (dict): The MLTable definition.
+        files (list[str]): The local files of its paths.
+        threads (int): The number of footers read at a time.
+        use_index (bool): Whether to skip the files and row groups that the
+            partition indexes of partition_index.py show cannot match the
+            filters. Files without an up to date index entry are scanned.
+
+    Returns:
+        dict: The dataset to scan, the columns to output, the pushed down
+            filter, the (probability, seed) of the sample, if any, and the
+            number of row groups the index skipped.
+
+    Raises:
+        ValueError: If the MLTable uses an unsupported transformation or a
+            column that does not exist at that point.
+    """
+    schema = read_schema(files, threads)
+    partitions = {}
+    path_column = None
+    include_path = False
+    dataset_filter = None
+    predicates = []
+    sample = None
+
+    available = list(schema.names)
+    for transformation in definition.get("transformations", []):
+        (name, options), = transformation.items()
+        if name not in TRANSFORMATIONS:
+            raise ValueError(f"Unsupported transformation {name}, expected one of {TRANSFORMATIONS}")
+
+        if name == "extract_columns_from_partition_format":
+            values = partition_values(
+                files, options["partition_format"], options.get("ignore_errors", False)
+            )
+            partitions.update(values)
+            available += [column for column in values if column not in available]
+            path_column = options.get("path_column", "Path")
+        elif name == "read_parquet":
+            if options.get("include_path_column", False):
+                path_column = options.get("path_column", "Path")
+                include_path = True
+                available.append(path_column)
+        elif name == "take_random_sample":
+            sample = (options["probability"], options.get("seed"))
+        elif name == "filter":
+            expression, columns = parse_filter(options)
+            missing = columns - set(available)
+            if missing:
+                raise ValueError(f"The filter {options} uses unknown columns {sorted(missing)}")
+            dataset_filter = expression if dataset_filter is None else dataset_filter & expression
+            predicates += simple_predicates(options)
+        elif name == "drop_columns":
+            dropped = set([options] if isinstance(options, str) else options)
+            available = [column for column in available if column not in dropped]
+        elif name == "keep_columns":
+            kept = [options] if isinstance(options, str) else options
+            missing = set(kept) - set(available)
+            if missing:
+                raise ValueError(f"Cannot keep unknown columns {sorted(missing)}")
+            available = [column for column in available if column in kept]
+
+    # The partition columns and path are constants of each file, which the
+    # scan uses to skip files and fills in without reading them
+    for column, values in partitions.items():
+        kind = pa.int64() if all(isinstance(value, (int, type(None))) for value in values) else pa.string()
+        schema = schema.append(pa.field(column, kind))
+    if include_path:
+        schema = schema.append(pa.field(path_column, pa.string()))
+
+    file_format = ds.ParquetFileFormat()
+    filesystem = pa.fs.LocalFileSystem()
+    fragments = []
+    skipped = 0
+    for position, path in enumerate(files):
+        expression = ds.scalar(True)
+        for column, values in partitions.items():
+            if values[position] is None:
+                expression = expression & ds.field(column).is_null()
+            else:
+                expression = expression & (ds.field(column) == values[position])
+        if include_path:
+            expression = expression & (ds.field(path_column) == path)
+
+        row_groups = None
+        index, key = find_index(path) if use_index and predicates else (None, None)
+        if index is not None:
+            entry = index["files"][key]
+            row_groups = [
+                group for group, row_group in enumerate(entry["row_groups"])
+                if may_match(row_group, predicates)
+            ]
+            skipped += len(entry["row_groups"]) - len(row_groups)
+            if not row_groups:
+                continue
+        fragments.append(
+            file_format.make_fragment(os.path.abspath(path), filesystem, expression, row_groups)
+        )
+
+    dataset = ds.FileSystemDataset(fragments, schema, file_format, filesystem)
+    return {
+        "dataset": dataset,
+        "columns": available,
+        "filter": dataset_filter,
+        "sample": sample,
+        "skipped_row_groups": skipped,
+    }
+
+
+def scan(plan, batch_size=1 << 17):
+    """
+    Run a planned scan, with Arrow's thread pools.
+
+    The batches come in file order whatever the number of threads, and the
+    sample draws one number per filtered row in that order, so the output is
+    the same for any number of threads.
+
+    Args:
+        plan (dict): The plan from plan_scan.
+        batch_size (int): The maximum number of rows per batch.
+
+    Yields:
+        pa.RecordBatch: The rows of the MLTable.
+    """
+    scanner = plan["dataset"].scanner(
+        columns=plan["columns"], filter=plan["filter"], batch_size=batch_size, use_threads=True
+    )
+    rng = None
+    if plan["sample"] is not None:
+        probability, seed = plan["sample"]
+        rng = np.random.default_rng(seed)
+    for batch in scanner.to_batches():
+        if rng is not None:
+            batch = batch.filter(pa.array(rng.random(batch.num_rows) < probability))
+        if batch.num_rows:
+            yield batch
+
+
+def main():
+    """
+    Materialize an MLTable from local files and log how fast it was read.
+    """
+    logger = setup_logger(__name__)
+
+    parser = argparse.ArgumentParser(description="Evaluate an MLTable over local parquet files.")
+    parser.add_argument("mltable_directory", type=str, help="Folder holding the MLTable file")
+    parser.add_argument("output_file", type=str, help="Parquet file to write the rows to")
+    parser.add_argument("--path_map", type=str, action="append", default=[],
+                        help="<url prefix>=<local folder>, may be given several times")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(),
+                        help="Number of scan and decode threads")
+    parser.add_argument("--batch_size", type=int, default=1 << 17, help="Maximum rows per batch")
+    parser.add_argument("--use_index", action="store_true",
+                        help="Skip the row groups the partition indexes rule out")
+    args = parser.parse_args()
+
+    pa.set_cpu_count(args.threads)
+    pa.set_io_thread_count(args.threads)
+
+    start = time.perf_counter()
+    definition = load_definition(args.mltable_directory)
+    files = resolve_paths(
+        definition.get("paths", []), args.mltable_directory, parse_path_map(args.path_map)
+    )
+    if not files:
+        raise FileNotFoundError(f"The paths of {args.mltable_directory} match no local file")
+    plan = plan_scan(definition, files, args.threads, args.use_index)
+    scanned = plan["dataset"].get_fragments(filter=plan["filter"])
+    scanned_bytes = sum(os.path.getsize(fragment.path) for fragment in scanned)
+    log_event(logger, "info", f"{len(files)} files, {scanned_bytes / 1e6:.1f} MB to scan, "
+              f"{plan['skipped_row_groups']} row groups skipped by the index, "
+              f"columns {plan['columns']}, filter {plan['filter']}, sample {plan['sample']}")
+
+    Path(args.output_file).parent.mkdir(parents=True, exist_ok=True)
+    rows = 0
+    writer = None
+    try:
+        for batch in scan(plan, args.batch_size):
+            if writer is None:
+                writer = pq.ParquetWriter(args.output_file, batch.schema)
+            writer.write_table(pa.Table.from_batches([batch]))
+            rows += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    seconds = time.perf_counter() - start
+    log_event(logger, "info", f"{rows} rows written to {args.output_file} in {seconds:.2f}s "
+              f"with {args.threads} threads: {scanned_bytes / 1e6 / seconds:.1f} MB/s scanned")
+
+
+if __name__ == "__main__":
+    main()
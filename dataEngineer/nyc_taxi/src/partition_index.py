@@ -0,0 +1,555 @@
+"""
+Sidecar index of the row group statistics of the taxi data partitions.
+
+Each partition gets a small JSON file, <partition folder>/_row_group_stats.json,
+holding the row count of every file and row group and the min, max and null
+count of the key columns. It is built from the parquet footers once, and a
+refresh only reads the footers of the files added or changed since.
+
+Readers use the index to skip the files and row groups a filter cannot match
+without opening them, and to count rows without a scan. A filter is a list of
+(column, operator, value) conditions that must all hold, e.g.
+
+    parse_predicates("tripDistance>0,pickupLatitude>=40.5")
+    simple_predicates("col('tripDistance') > 0")
+
+The index folder mirrors the data layout. For local data it is the data root
+itself; the index of a remote root is kept in a local folder.
+
+Usage:
+    python dataEngineer/nyc_taxi/src/partition_index.py <data root> \\
+        --years 2015-2016 --where "tripDistance>0"
+"""
+import argparse
+import ast
+import datetime
+import json
+import operator
+import os
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import pyarrow.parquet as pq
+from workflowhelperfunc.workflowhelper import setup_logger, log_event
+from taxi_partitions import COLORS, YEARS, is_remote, list_partitions, parse_int_list, projected_columns
+
+INDEX_NAME = "_row_group_stats.json"
+INDEX_VERSION = 1
+KEY_COLUMNS = projected_columns(COLORS)
+
+OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+_AST_OPERATORS = {
+    ast.Eq: "==",
+    ast.NotEq: "!=",
+    ast.Lt: "<",
+    ast.LtE: "<=",
+    ast.Gt: ">",
+    ast.GtE: ">=",
+}
+_MIRRORED = {"<": ">", "<=": ">=", ">": "<", ">=": "<=", "==": "==", "!=": "!="}
+
+
+def partition_dir(root, partition):
+    """
+    Build the folder of a partition under a data or index root.
+
+    Args:
+        root (str): The root.
+        partition (Partition): The partition.
+
+    Returns:
+        str: The partition folder.
+    """
+    return f"{root.rstrip('/')}/{partition.color}/puYear={partition.year}/puMonth={partition.month}"
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return value
+
+
+def read_file_stats(path, open_file, columns=KEY_COLUMNS):
+    """
+    Read the row counts and column statistics of a parquet file from its footer.
+
+    Args:
+        path (str): The file.
+        open_file (callable): Opens a file path for pyarrow.
+        columns (list[str]): The columns to keep statistics of.
+
+    Returns:
+        dict: The rows of the file, and the rows and column statistics of
+            each of its row groups.
+    """
+    metadata = pq.ParquetFile(open_file(path)).metadata
+    row_groups = []
+    for index in range(metadata.num_row_groups):
+        row_group = metadata.row_group(index)
+        stats = {}
+        for position in range(row_group.num_columns):
+            chunk = row_group.column(position)
+            if chunk.path_in_schema not in columns or chunk.statistics is None:
+                continue
+            statistics = chunk.statistics
+            stats[chunk.path_in_schema] = {
+                "min": _json_value(statistics.min) if statistics.has_min_max else None,
+                "max": _json_value(statistics.max) if statistics.has_min_max else None,
+                "nulls": statistics.null_count if statistics.has_null_count else None,
+            }
+        row_groups.append({"rows": row_group.num_rows, "columns": stats})
+    return {
+        "rows": metadata.num_rows,
+        "columns": merge_stats(row_groups),
+        "row_groups": row_groups,
+    }
+
+
+def merge_stats(row_groups):
+    """
+    Combine the column statistics of row groups into those of their file.
+
+    Args:
+        row_groups (list[dict]): The row group entries.
+
+    Returns:
+        dict: Column -> min, max and null count over the row groups. A bound
+            or count is None when a row group lacks it.
+    """
+    merged = {}
+    for row_group in row_groups:
+        for column, stats in row_group["columns"].items():
+            if column not in merged:
+                merged[column] = dict(stats)
+                continue
+            total = merged[column]
+            for key, pick in (("min", min), ("max", max)):
+                if total[key] is None or stats[key] is None:
+                    total[key] = None
+                else:
+                    try:
+                        total[key] = pick(total[key], stats[key])
+                    except TypeError:
+                        total[key] = None
+            if total["nulls"] is None or stats["nulls"] is None:
+                total["nulls"] = None
+            else:
+                total["nulls"] += stats["nulls"]
+    for column in list(merged):
+        if not all(column in row_group["columns"] for row_group in row_groups):
+            merged[column] = {"min": None, "max": None, "nulls": None}
+    return merged
+
+
+def file_signature(path, filesystem=None):
+    """
+    Identify the version of a file, to tell whether its statistics are stale.
+
+    Args:
+        path (str): The file.
+        filesystem (fsspec.AbstractFileSystem, optional): The filesystem of a
+            remote file.
+
+    Returns:
+        dict: The size of the file and its modification time or etag.
+    """
+    if filesystem is None:
+        info = os.stat(path)
+        return {"size": info.st_size, "modified": info.st_mtime_ns}
+    info = filesystem.info(path)
+    modified = info.get("etag") or info.get("last_modified") or info.get("mtime")
+    return {"size": info.get("size"), "modified": str(modified)}
+
+
+def load_index(index_dir):
+    """
+    Read the index of a partition.
+
+    Args:
+        index_dir (str): The folder of the partition in the index root.
+
+    Returns:
+        dict: The index, or None if there is none or it has an older format.
+    """
+    path = Path(index_dir) / INDEX_NAME
+    if not path.is_file():
+        return None
+    with open(path, "r") as f:
+        index = json.load(f)
+    if index.get("version") != INDEX_VERSION or index.get("columns") != KEY_COLUMNS:
+        return None
+    return index
+
+
+def refresh_index(partition, root, index_root=None, filesystem=None, open_file=str, workers=8):
+    """
+    Bring the index of a partition up to date with its files.
+
+    Only the footers of the files added or changed since the last refresh are
+    read; the entries of removed files are dropped.
+
+    Args:
+        partition (Partition): The partition, from list_partitions.
+        root (str): The data root the partition was listed under.
+        index_root (str, optional): The local root of the index. Defaults to
+            the data root.
+        filesystem (fsspec.AbstractFileSystem, optional): The filesystem of a
+            remote root.
+        open_file (callable): Opens a file path for pyarrow.
+        workers (int): The number of footers read at a time.
+
+    Returns:
+        tuple: The index and the number of files whose footers were read.
+    """
+    data_dir = partition_dir(root, partition)
+    index_dir = partition_dir(index_root or root, partition)
+    index = load_index(index_dir) or {"version": INDEX_VERSION, "columns": KEY_COLUMNS, "files": {}}
+
+    files = {}
+    stale = []
+    for path in partition.files:
+        key = posixpath.relpath(Path(path).as_posix(), Path(data_dir).as_posix())
+        signature = file_signature(path, filesystem)
+        entry = index["files"].get(key)
+        if entry is not None and entry["signature"] == signature:
+            files[key] = entry
+        else:
+            stale.append((key, path, signature))
+
+    def read(item):
+        key, path, signature = item
+        return key, dict(read_file_stats(path, open_file), signature=signature)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        files.update(executor.map(read, stale))
+
+    if stale or len(files) != len(index["files"]):
+        index["files"] = dict(sorted(files.items()))
+        Path(index_dir).mkdir(parents=True, exist_ok=True)
+        temporary = Path(index_dir) / (INDEX_NAME + ".tmp")
+        with open(temporary, "w") as f:
+            json.dump(index, f)
+        os.replace(temporary, Path(index_dir) / INDEX_NAME)
+    return index, len(stale)
+
+
+def find_index(path):
+    """
+    Find the index holding a local file, in the folders above it.
+
+    Args:
+        path (str): The local parquet file.
+
+    Returns:
+        tuple: The index and the key of the file in it, or (None, None) if no
+            folder above the file has an up to date entry for it.
+    """
+    path = Path(path).resolve()
+    for folder in path.parents:
+        index = load_index(folder)
+        if index is None:
+            continue
+        key = path.relative_to(folder).as_posix()
+        entry = index["files"].get(key)
+        if entry is None or entry["signature"] != file_signature(str(path)):
+            return None, None
+        return index, key
+    return None, None
+
+
+def parse_predicates(text):
+    """
+    Parse conditions such as "tripDistance>0,pickupLatitude>=40.5".
+
+    Args:
+        text (str): Comma separated <column><operator><value> conditions.
+
+    Returns:
+        list[tuple]: The (column, operator, value) conditions. Numeric values
+            are converted to float.
+    """
+    predicates = []
+    for part in filter(None, (part.strip() for part in text.split(","))):
+        for symbol in sorted(OPERATORS, key=len, reverse=True):
+            column, found, value = part.partition(symbol)
+            if found:
+                break
+        else:
+            raise ValueError(f"Invalid condition {part}, expected <column><operator><value>")
+        value = value.strip()
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+        predicates.append((column.strip(), symbol, value))
+    return predicates
+
+
+def simple_predicates(expression):
+    """
+    Extract the conditions an index can check from an mltable filter expression.
+
+    Only the comparisons of a column with a constant that the whole filter
+    requires are kept, so rows the filter keeps are never pruned. Anything
+    else in the expression is left to the reader.
+
+    Args:
+        expression (str): The mltable filter, e.g. "col('tripDistance') > 0".
+
+    Returns:
+        list[tuple]: The (column, operator, value) conditions.
+    """
+
+    def column_name(node):
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id == "col"
+            and len(node.args) == 1
+            and isinstance(node.args[0], ast.Constant)
+        ):
+            return node.args[0].value
+        return None
+
+    def conditions(node):
+        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+            return [condition for value in node.values for condition in conditions(value)]
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitAnd):
+            return conditions(node.left) + conditions(node.right)
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in _AST_OPERATORS:
+            symbol = _AST_OPERATORS[type(node.ops[0])]
+            left, right = node.left, node.comparators[0]
+            if column_name(left) and isinstance(right, ast.Constant):
+                return [(column_name(left), symbol, right.value)]
+            if column_name(right) and isinstance(left, ast.Constant):
+                return [(column_name(right), _MIRRORED[symbol], left.value)]
+        return []
+
+    return conditions(ast.parse(expression, mode="eval").body)
+
+
+def _compare(symbol, left, right):
+    try:
+        return OPERATORS[symbol](left, right)
+    except TypeError:
+        return None
+
+
+def may_match(entry, predicates):
+    """
+    Check whether any row of a file or row group can meet every condition.
+
+    Args:
+        entry (dict): The index entry of a file or row group.
+        predicates (list[tuple]): The (column, operator, value) conditions.
+
+    Returns:
+        bool: False only if the statistics rule every row out.
+    """
+    for column, symbol, value in predicates:
+        stats = entry["columns"].get(column)
+        if stats is None:
+            continue
+        if stats["nulls"] is not None and stats["nulls"] >= entry["rows"]:
+            # Comparisons with nulls never hold
+            return False
+        low, high = stats["min"], stats["max"]
+        if low is None or high is None:
+            continue
+        outcomes = {
+            "==": (_compare("<=", low, value), _compare(">=", high, value)),
+            "<": (_compare("<", low, value),),
+            "<=": (_compare("<=", low, value),),
+            ">": (_compare(">", high, value),),
+            ">=": (_compare(">=", high, value),),
+            "!=": (not (_compare("==", low, value) and _compare("==", high, value)),),
+        }[symbol]
+        if any(outcome is False for outcome in outcomes):
+            return False
+    return True
+
+
+def all_match(entry, predicates):
+    """
+    Check whether every row of a file or row group meets every condition.
+
+    Args:
+        entry (dict): The index entry of a file or row group.
+        predicates (list[tuple]): The (column, operator, value) conditions.
+
+    Returns:
+        bool: True only if the statistics prove it.
+    """
+    for column, symbol, value in predicates:
+        stats = entry["columns"].get(column)
+        if stats is None or stats["nulls"] != 0 or stats["min"] is None or stats["max"] is None:
+            return False
+        low, high = stats["min"], stats["max"]
+        if symbol == "==":
+            holds = _compare("==", low, value) and _compare("==", high, value)
+        elif symbol == "!=":
+            holds = _compare(">", low, value) or _compare("<", high, value)
+        elif symbol in ("<", "<="):
+            holds = _compare(symbol, high, value)
+        else:
+            holds = _compare(symbol, low, value)
+        if not holds:
+            return False
+    return True
+
+
+def prune(index, predicates):
+    """
+    List the row groups of each file of an index that can match the conditions.
+
+    Args:
+        index (dict): The index of a partition.
+        predicates (list[tuple]): The (column, operator, value) conditions.
+
+    Returns:
+        dict: File key -> indices of its row groups that can match, for the
+            files with at least one.
+    """
+    selected = {}
+    for key, entry in index["files"].items():
+        if not may_match(entry, predicates):
+            continue
+        row_groups = [
+            position for position, row_group in enumerate(entry["row_groups"])
+            if may_match(row_group, predicates)
+        ]
+        if row_groups:
+            selected[key] = row_groups
+    return selected
+
+
+def count_rows(index, predicates=()):
+    """
+    Count the rows of an index meeting the conditions, without a scan.
+
+    Args:
+        index (dict): The index of a partition.
+        predicates (list[tuple]): The (column, operator, value) conditions.
+
+    Returns:
+        tuple: The number of rows that certainly match and the number that
+            may match. Both are the exact row count without conditions.
+    """
+    certain = possible = 0
+    for entry in index["files"].values():
+        for row_group in entry["row_groups"]:
+            if all_match(row_group, predicates):
+                certain += row_group["rows"]
+                possible += row_group["rows"]
+            elif may_match(row_group, predicates):
+                possible += row_group["rows"]
+    return certain, possible
+
+
+def indexed_files(root, index_root, colors=COLORS, years=YEARS, months=None, predicates=()):
+    """
+    List the files of the indexed partitions that can match the conditions.
+
+    Nothing under the data root is listed or opened, so the index must have
+    been refreshed since the data last changed.
+
+    Args:
+        root (str): The data root the files are under, local or a URL.
+        index_root (str): The local root of the index.
+        colors (list[str]): The taxi colors to list.
+        years (list[int]): The pickup years to list.
+        months (list[int], optional): The pickup months to list. Defaults to all.
+        predicates (list[tuple]): The (column, operator, value) conditions.
+
+    Returns:
+        tuple: The paths of the files, and the number of rows that certainly
+            and that possibly match.
+    """
+    files = []
+    certain = possible = 0
+    for color in colors:
+        for year in years:
+            found = []
+            for index_file in Path(index_root).glob(f"{color}/puYear={year}/puMonth=*/{INDEX_NAME}"):
+                month = int(index_file.parent.name.rsplit("=", 1)[1])
+                index = load_index(index_file.parent)
+                if index is None or (months and month not in months):
+                    continue
+                found.append((month, index))
+            for month, index in sorted(found, key=lambda item: item[0]):
+                data_dir = f"{root.rstrip('/')}/{color}/puYear={year}/puMonth={month}"
+                files += [f"{data_dir}/{key}" for key in prune(index, predicates)]
+                matched = count_rows(index, predicates)
+                certain += matched[0]
+                possible += matched[1]
+    return files, certain, possible
+
+
+def main():
+    """
+    Build or refresh the index of the selected partitions and count their rows.
+    """
+    logger = setup_logger(__name__)
+
+    parser = argparse.ArgumentParser(description="Index the row group statistics of the taxi data.")
+    parser.add_argument("data_root", type=str, help="Local folder or fsspec URL of the taxi data")
+    parser.add_argument("--index_root", type=str, default="",
+                        help="Local folder of the index (defaults to a local data root)")
+    parser.add_argument("--storage_options", type=str, default="{}",
+                        help="JSON options of the fsspec filesystem of a remote root")
+    parser.add_argument("--colors", type=str, default=",".join(COLORS), help="Comma separated taxi colors")
+    parser.add_argument("--years", type=str, default=f"{YEARS[0]}-{YEARS[-1]}",
+                        help="Pickup years, e.g. 2015-2017 or 2015,2019")
+    parser.add_argument("--months", type=str, default="", help="Pickup months, e.g. 1-3 (empty for all)")
+    parser.add_argument("--where", type=str, default="", help="Conditions to count rows for, e.g. tripDistance>0")
+    parser.add_argument("--workers", type=int, default=8, help="Number of footers read at a time")
+    args = parser.parse_args()
+
+    root = args.data_root
+    filesystem = None
+    open_file = str
+    if is_remote(root):
+        if not args.index_root:
+            raise ValueError("A remote data root needs a local --index_root")
+        import fsspec
+
+        filesystem, root = fsspec.core.url_to_fs(root, **json.loads(args.storage_options))
+        open_file = lambda path: filesystem.open(path, "rb")  # noqa: E731
+
+    months = parse_int_list(args.months) if args.months else None
+    partitions = list_partitions(
+        root, args.colors.split(","), parse_int_list(args.years), months, filesystem
+    )
+    predicates = parse_predicates(args.where)
+
+    totals = {"files": 0, "read": 0, "rows": 0, "certain": 0, "possible": 0, "kept_files": 0}
+    for partition in partitions:
+        index, read = refresh_index(
+            partition, root, args.index_root or None, filesystem, open_file, args.workers
+        )
+        certain, possible = count_rows(index, predicates)
+        totals["files"] += len(index["files"])
+        totals["read"] += read
+        totals["rows"] += count_rows(index)[0]
+        totals["certain"] += certain
+        totals["possible"] += possible
+        totals["kept_files"] += len(prune(index, predicates))
+
+    log_event(logger, "info", f"Indexed {len(partitions)} partitions, {totals['files']} files, "
+              f"{totals['rows']} rows; read {totals['read']} footers")
+    if predicates:
+        log_event(logger, "info", f"{predicates}: {totals['certain']} to {totals['possible']} rows "
+                  f"may match, in {totals['kept_files']} of {totals['files']} files")
+
+
+if __name__ == "__main__":
+    main()
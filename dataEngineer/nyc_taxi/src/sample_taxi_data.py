@@ -0,0 +1,371 @@
+"""
+Draw a reproducible sample of the partitioned NYC taxi data.
+
+Instead of reading every partition and sampling afterwards, the sampler reads
+the parquet footers first. The row counts in the footers are enough to choose
+the sampled rows up front, so only the row groups that hold sampled rows are
+read, in parallel, and only for the needed columns. A fixed-size or stratified
+sample fills its quotas without ever reading the row groups holding none of
+its rows.
+
+Modes:
+    bernoulli   Keep each row with --probability.
+    reservoir   Keep --size rows, drawn uniformly from all the selected rows.
+    stratified  Keep --size rows per stratum, drawn uniformly from its rows.
+                The strata are the combinations of --stratify_by, any of
+                color, year and month.
+
+The rows are drawn from generators seeded with --seed and the stratum or row
+group, so the same data and arguments always give the same sample, whatever
+the number of readers. With --index_root, the row counts come from the row
+group statistics indexes of partition_index.py instead of the footers. The
+sample of each color is written to <output>/<color>TaxiData.parquet, the raw
+layout the prep step reads, with puYear and puMonth columns added.
+
+Usage:
+    python dataEngineer/nyc_taxi/src/sample_taxi_data.py <output folder> \\
+        --data_root <local folder> --mode stratified --size 10000 --stratify_by color,month
+"""
+import argparse
+import json
+import posixpath
+import time
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from workflowhelperfunc.workflowhelper import setup_logger, log_event
+from partition_index import partition_dir, refresh_index
+from taxi_partitions import COLORS, COLUMNS, YEARS, is_remote, list_partitions, parse_int_list
+
+MODES = ["bernoulli", "reservoir", "stratified"]
+STRATA = ["color", "year", "month"]
+
+# A row group of a parquet file of a partition. key is the file path relative
+# to the data root, which seeds the draws of the row group.
+RowGroup = namedtuple("RowGroup", ["partition", "file", "key", "index", "rows"])
+
+
+def seeded_rng(seed, *key):
+    """
+    Create a random generator for one part of the sample.
+
+    Args:
+        seed (int): The seed of the sample.
+        *key: What the generator is for, e.g. a stratum or a row group.
+
+    Returns:
+        np.random.Generator: A generator that depends on the seed and key only.
+    """
+    return np.random.default_rng([seed, zlib.crc32(repr(key).encode())])
+
+
+def read_footers(partitions, root, open_file, workers):
+    """
+    List the row groups of every file of the partitions, from the parquet footers.
+
+    Args:
+        partitions (list[Partition]): The partitions to sample.
+        root (str): The data root the file paths are under.
+        open_file (callable): Opens a file path for pyarrow.
+        workers (int): The number of footers read at a time.
+
+    Returns:
+        list[RowGroup]: The row groups, in partition, file and row group order.
+    """
+    files = [(partition, path) for partition in partitions for path in partition.files]
+
+    def footer(item):
+        partition, path = item
+        metadata = pq.ParquetFile(open_file(path)).metadata
+        key = posixpath.relpath(Path(path).as_posix(), Path(root).as_posix())
+        return [
+            RowGroup(partition, path, key, index, metadata.row_group(index).num_rows)
+            for index in range(metadata.num_row_groups)
+        ]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [group for groups in executor.map(footer, files) for group in groups]
+
+
+def indexed_row_groups(partitions, root, index_root, filesystem, open_file, workers):
+    """
+    List the row groups of the partitions from their row group statistics indexes.
+
+    The indexes are refreshed first, which only reads the footers of the files
+    added or changed since they were built.
+
+    Args:
+        partitions (list[Partition]): The partitions to sample.
+        root (str): The data root the file paths are under.
+        index_root (str): The local root of the indexes, see partition_index.py.
+        filesystem (fsspec.AbstractFileSystem): The filesystem of a remote
+            root, or None.
+        open_file (callable): Opens a file path for pyarrow.
+        workers (int): The number of footers read at a time.
+
+    Returns:
+        list[RowGroup]: The row groups, in partition, file and row group order.
+    """
+    row_groups = []
+    for partition in partitions:
+        index, _ = refresh_index(partition, root, index_root, filesystem, open_file, workers)
+        data_dir = Path(partition_dir(root, partition)).as_posix()
+        for path in partition.files:
+            entry = index["files"][posixpath.relpath(Path(path).as_posix(), data_dir)]
+            key = posixpath.relpath(Path(path).as_posix(), Path(root).as_posix())
+            row_groups += [
+                RowGroup(partition, path, key, position, row_group["rows"])
+                for position, row_group in enumerate(entry["row_groups"])
+            ]
+    return row_groups
+
+
+def select_bernoulli(row_groups, probability, seed):
+    """
+    Keep each row with a given probability.
+
+    Args:
+        row_groups (list[RowGroup]): The row groups to sample.
+        probability (float): The probability of keeping a row.
+        seed (int): The seed of the sample.
+
+    Returns:
+        dict: RowGroup -> sorted positions of its sampled rows, for the row
+            groups with at least one.
+    """
+    selection = {}
+    for group in row_groups:
+        rng = seeded_rng(seed, group.key, group.index)
+        count = rng.binomial(group.rows, probability)
+        if count:
+            selection[group] = np.sort(rng.choice(group.rows, count, replace=False))
+    return selection
+
+
+def select_fixed(row_groups, size, rng):
+    """
+    Keep a fixed number of rows, drawn uniformly without replacement.
+
+    Args:
+        row_groups (list[RowGroup]): The row groups to sample.
+        size (int): The number of rows to keep. Every row is kept when there
+            are fewer.
+        rng (np.random.Generator): The generator to draw with.
+
+    Returns:
+        dict: RowGroup -> sorted positions of its sampled rows, for the row
+            groups with at least one.
+    """
+    offsets = np.concatenate([[0], np.cumsum([group.rows for group in row_groups], dtype=np.int64)])
+    total = int(offsets[-1])
+    chosen = np.sort(rng.choice(total, min(size, total), replace=False))
+
+    # Map the row numbers over all the row groups back onto each row group
+    owners = np.searchsorted(offsets, chosen, side="right") - 1
+    groups, starts = np.unique(owners, return_index=True)
+    return {
+        row_groups[group]: positions - offsets[group]
+        for group, positions in zip(groups, np.split(chosen, starts[1:]))
+    }
+
+
+def select_rows(row_groups, mode, seed, probability=0.001, size=0, stratify_by=STRATA):
+    """
+    Choose the rows of a sample from the row counts of the row groups.
+
+    Args:
+        row_groups (list[RowGroup]): The row groups to sample.
+        mode (str): One of MODES.
+        seed (int): The seed of the sample.
+        probability (float): The probability of keeping a row, for bernoulli.
+        size (int): The number of rows, in all for reservoir or per stratum
+            for stratified.
+        stratify_by (list[str]): The partition fields the strata are made of.
+
+    Returns:
+        dict: RowGroup -> sorted positions of its sampled rows.
+    """
+    if mode == "bernoulli":
+        return select_bernoulli(row_groups, probability, seed)
+    if mode == "reservoir":
+        return select_fixed(row_groups, size, seeded_rng(seed, "reservoir"))
+    if mode != "stratified":
+        raise ValueError(f"Invalid sampling mode: {mode}")
+
+    strata = {}
+    for group in row_groups:
+        stratum = tuple(getattr(group.partition, field) for field in stratify_by)
+        strata.setdefault(stratum, []).append(group)
+    selection = {}
+    for stratum, groups in strata.items():
+        selection.update(select_fixed(groups, size, seeded_rng(seed, *stratum)))
+    return selection
+
+
+def read_rows(group, positions, open_file):
+    """
+    Read the sampled rows of a row group, in the needed columns only.
+
+    Args:
+        group (RowGroup): The row group.
+        positions (np.ndarray): The positions of its sampled rows.
+        open_file (callable): Opens a file path for pyarrow.
+
+    Returns:
+        pa.Table: The sampled rows, with puYear and puMonth columns.
+    """
+    parquet_file = pq.ParquetFile(open_file(group.file))
+    names = set(parquet_file.schema_arrow.names)
+    columns = [column for column in COLUMNS[group.partition.color] if column in names]
+    table = parquet_file.read_row_group(group.index, columns=columns).take(pa.array(positions))
+    rows = len(table)
+    table = table.append_column("puYear", pa.array(np.full(rows, group.partition.year, dtype=np.int16)))
+    return table.append_column("puMonth", pa.array(np.full(rows, group.partition.month, dtype=np.int8)))
+
+
+def align(table, schema):
+    """
+    Give a table the schema of the first sample table of its color.
+
+    The column types of the taxi data change over the years, and older files
+    can miss columns, which are filled with nulls.
+
+    Args:
+        table (pa.Table): The sampled rows.
+        schema (pa.Schema): The schema of the output file.
+
+    Returns:
+        pa.Table: The rows with that schema.
+    """
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            columns.append(table[field.name].cast(field.type))
+        else:
+            columns.append(pa.nulls(len(table), field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def write_sample(selection, output_dir, open_file, workers):
+    """
+    Read the sampled rows with parallel readers and write one file per color.
+
+    At most two row groups per reader are in flight, and the rows are written
+    in row group order, so the output does not depend on the number of readers.
+
+    Args:
+        selection (dict): RowGroup -> sorted positions, from select_rows.
+        output_dir (str): The folder to write the sample to.
+        open_file (callable): Opens a file path for pyarrow.
+        workers (int): The number of row groups read at a time.
+
+    Returns:
+        dict: Color -> number of rows written.
+    """
+    writers = {}
+    counts = {}
+
+    def write(table, color):
+        if color not in writers:
+            path = Path(output_dir) / f"{color}TaxiData.parquet"
+            writers[color] = pq.ParquetWriter(str(path), table.schema)
+            counts[color] = 0
+        writers[color].write_table(align(table, writers[color].schema))
+        counts[color] += len(table)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for group, positions in selection.items():
+                if len(pending) >= 2 * workers:
+                    future, color = pending.popleft()
+                    write(future.result(), color)
+                future = executor.submit(read_rows, group, positions, open_file)
+                pending.append((future, group.partition.color))
+            for future, color in pending:
+                write(future.result(), color)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return counts
+
+
+def main():
+    """
+    Sample the partitions of the taxi data selected on the command line.
+    """
+    logger = setup_logger(__name__)
+
+    parser = argparse.ArgumentParser(description="Sample the partitioned NYC taxi data.")
+    parser.add_argument("output_directory", type=str, help="Directory to write the sample to")
+    parser.add_argument("--data_root", type=str, help="Local folder or fsspec URL of the taxi data")
+    parser.add_argument("--storage_options", type=str, default="{}",
+                        help="JSON options of the fsspec filesystem of a remote root")
+    parser.add_argument("--colors", type=str, default=",".join(COLORS), help="Comma separated taxi colors")
+    parser.add_argument("--years", type=str, default=f"{YEARS[0]}-{YEARS[-1]}",
+                        help="Pickup years, e.g. 2015-2017 or 2015,2019")
+    parser.add_argument("--months", type=str, default="", help="Pickup months, e.g. 1-3 (empty for all)")
+    parser.add_argument("--mode", type=str, default="bernoulli", choices=MODES, help="Sampling mode")
+    parser.add_argument("--probability", type=float, default=0.001, help="Row probability for bernoulli")
+    parser.add_argument("--size", type=int, default=0,
+                        help="Rows in all for reservoir, or per stratum for stratified")
+    parser.add_argument("--stratify_by", type=str, default=",".join(STRATA),
+                        help="Comma separated partition fields the strata are made of")
+    parser.add_argument("--seed", type=int, default=735, help="Seed of the sample")
+    parser.add_argument("--workers", type=int, default=8, help="Number of parallel readers")
+    parser.add_argument("--index_root", type=str, default="",
+                        help="Local root of the partition_index.py indexes, to take the row "
+                             "counts from instead of the footers")
+    args = parser.parse_args()
+
+    stratify_by = args.stratify_by.split(",")
+    if set(stratify_by) - set(STRATA):
+        raise ValueError(f"Can only stratify by {STRATA}, got {stratify_by}")
+    if args.mode != "bernoulli" and args.size <= 0:
+        raise ValueError(f"The {args.mode} mode needs a --size")
+
+    root = args.data_root
+    filesystem = None
+    open_file = str
+    if is_remote(root):
+        import fsspec
+
+        filesystem, root = fsspec.core.url_to_fs(root, **json.loads(args.storage_options))
+        open_file = lambda path: filesystem.open(path, "rb")  # noqa: E731
+
+    start = time.perf_counter()
+    months = parse_int_list(args.months) if args.months else None
+    partitions = list_partitions(
+        root, args.colors.split(","), parse_int_list(args.years), months, filesystem
+    )
+    if not partitions:
+        raise FileNotFoundError(f"No taxi data partitions under {args.data_root} match the selection")
+
+    if args.index_root:
+        row_groups = indexed_row_groups(
+            partitions, root, args.index_root, filesystem, open_file, args.workers
+        )
+    else:
+        row_groups = read_footers(partitions, root, open_file, args.workers)
+    total_rows = sum(group.rows for group in row_groups)
+    log_event(logger, "info", f"{len(partitions)} partitions, {len(row_groups)} row groups, "
+              f"{total_rows} rows")
+
+    selection = select_rows(
+        row_groups, args.mode, args.seed, args.probability, args.size, stratify_by
+    )
+    sampled = sum(len(positions) for positions in selection.values())
+    log_event(logger, "info", f"{args.mode} sample of {sampled} rows from {len(selection)} "
+              f"of {len(row_groups)} row groups")
+
+    Path(args.output_directory).mkdir(parents=True, exist_ok=True)
+    counts = write_sample(selection, args.output_directory, open_file, args.workers)
+    log_event(logger, "info", f"Sample written in {time.perf_counter() - start:.2f}s: {counts}")
+
+
+if __name__ == "__main__":
+    main()
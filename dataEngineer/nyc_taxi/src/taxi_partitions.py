@@ -0,0 +1,138 @@
+"""
+Layout of the partitioned NYC taxi parquet data, shared by createMlTable.py
+and sample_taxi_data.py.
+
+The trip records are stored as <root>/<color>/puYear=<year>/puMonth=<month>/,
+with any number of parquet files under each month folder. The root is the
+Azure Open Datasets container, or a local folder with the same layout for
+offline development.
+"""
+from collections import namedtuple
+from pathlib import Path
+
+# Azure Open Datasets container of the NYC taxi trip records
+DATA_ROOT = "wasbs://nyctlc@azureopendatastorage.blob.core.windows.net"
+COLORS = ["green", "yellow"]
+YEARS = list(range(2015, 2020))
+PARTITION_FORMAT = "/puYear={year}/puMonth={month}"
+
+# Columns of each color that the prep step reads, plus tripDistance for the filter
+COLUMNS = {
+    "green": [
+        "vendorID",
+        "lpepPickupDatetime",
+        "lpepDropoffDatetime",
+        "storeAndFwdFlag",
+        "pickupLongitude",
+        "pickupLatitude",
+        "dropoffLongitude",
+        "dropoffLatitude",
+        "passengerCount",
+        "fareAmount",
+        "tripDistance",
+    ],
+    "yellow": [
+        "vendorID",
+        "tpepPickupDateTime",
+        "tpepDropoffDateTime",
+        "storeAndFwdFlag",
+        "startLon",
+        "startLat",
+        "endLon",
+        "endLat",
+        "passengerCount",
+        "fareAmount",
+        "tripDistance",
+    ],
+}
+
+# One month of one color, with its parquet files
+Partition = namedtuple("Partition", ["color", "year", "month", "files"])
+
+
+def parse_int_list(text):
+    """
+    Parse a list of integers and inclusive ranges, e.g. "2015-2017,2019".
+
+    Args:
+        text (str): The comma separated values and ranges.
+
+    Returns:
+        list[int]: The values, in the order given.
+    """
+    values = []
+    for part in text.split(","):
+        first, _, last = part.strip().partition("-")
+        values += range(int(first), int(last or first) + 1)
+    return values
+
+
+def projected_columns(colors=COLORS):
+    """
+    List the columns to read for a set of colors, in a stable order.
+
+    Args:
+        colors (list[str]): The taxi colors read.
+
+    Returns:
+        list[str]: The union of the needed columns of every color.
+    """
+    columns = []
+    for color in colors:
+        columns += [column for column in COLUMNS[color] if column not in columns]
+    return columns
+
+
+def is_remote(root):
+    """
+    Check whether a data root is a URL rather than a local folder.
+
+    Args:
+        root (str): The data root.
+
+    Returns:
+        bool: True for URLs such as wasbs:// or az://.
+    """
+    return "://" in root
+
+
+def list_partitions(root, colors=COLORS, years=YEARS, months=None, filesystem=None):
+    """
+    List the partitions of the selected colors, years and months that exist.
+
+    Only the folders of the selected colors and years are listed.
+
+    Args:
+        root (str): The data root. A URL needs an fsspec filesystem.
+        colors (list[str]): The taxi colors to list.
+        years (list[int]): The pickup years to list.
+        months (list[int], optional): The pickup months to list. Defaults to all.
+        filesystem (fsspec.AbstractFileSystem, optional): The filesystem of a
+            remote root, with the root given as a path inside it.
+
+    Returns:
+        list[Partition]: The partitions that hold parquet files, sorted by
+            color, year and month, with a tuple of their files sorted by path.
+    """
+    partitions = []
+    for color in colors:
+        for year in years:
+            year_dir = f"{root.rstrip('/')}/{color}/puYear={year}"
+            if filesystem is None:
+                month_dirs = [str(path) for path in Path(year_dir).glob("puMonth=*")]
+            else:
+                month_dirs = filesystem.glob(f"{year_dir}/puMonth=*")
+
+            found = []
+            for month_dir in month_dirs:
+                month = int(month_dir.rstrip("/").rsplit("=", 1)[1])
+                if months and month not in months:
+                    continue
+                if filesystem is None:
+                    files = [str(path) for path in Path(month_dir).rglob("*.parquet")]
+                else:
+                    files = [path for path in filesystem.find(month_dir) if path.endswith(".parquet")]
+                if files:
+                    found.append(Partition(color, year, month, tuple(sorted(files))))
+            partitions += sorted(found, key=lambda partition: partition.month)
+    return partitions
@@ -0,0 +1,134 @@
+"""
+Benchmark taxi_features.trip_features, the feature rules transform.py,
+predict.py and serve.py share, against the previous pd.DatetimeIndex
+implementation of the datetime features.
+
+trip_features also checks the coordinates, distance, passengers and vendor of
+each trip, which the previous implementation did not, so the speedup it shows
+is a lower bound for the datetime features alone.
+
+Usage:
+    python data_science/nyc_taxi/benchmarks/bench_datetime_features.py --rows 1000000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from taxi_features import CALENDAR_FEATURES, trip_features  # noqa: E402
+
+
+def make_trips(rows, seed=735):
+    """
+    Create a frame of random usable prepped trips.
+
+    Args:
+        rows (int): The number of trips.
+        seed (int): The random seed.
+
+    Returns:
+        pd.DataFrame: The TRIP_COLUMNS of the trips, with the timestamps as
+            strings and every coordinate inside the city.
+    """
+    rng = np.random.default_rng(seed)
+    start = np.datetime64("2015-01-01T00:00:00").astype("int64")
+    end = np.datetime64("2020-01-01T00:00:00").astype("int64")
+    pickup = rng.integers(start, end, rows).astype("datetime64[s]")
+    dropoff = pickup + rng.integers(60, 3600, rows).astype("timedelta64[s]")
+    trips = pd.DataFrame(
+        {
+            "pickup_datetime": np.datetime_as_string(pickup).astype(object),
+            "dropoff_datetime": np.datetime_as_string(dropoff).astype(object),
+        }
+    ).replace("T", " ", regex=True)
+    for prefix in ["pickup", "dropoff"]:
+        trips[f"{prefix}_longitude"] = rng.uniform(-74.0, -73.8, rows)
+        trips[f"{prefix}_latitude"] = rng.uniform(40.6, 40.8, rows)
+    trips["distance"] = rng.uniform(0.1, 20.0, rows)
+    trips["passengers"] = rng.integers(1, 7, rows)
+    trips["vendor"] = rng.integers(1, 3, rows)
+    trips["store_forward"] = rng.choice(np.array(["N", "Y"], dtype=object), rows)
+    return trips
+
+
+def legacy_datetime_features(df):
+    """
+    The datetime features as transform.py computed them before the fused engine.
+    """
+    df = df.copy()
+    for prefix in ["pickup", "dropoff"]:
+        temp = pd.DatetimeIndex(df[f"{prefix}_datetime"], dtype="datetime64[ns]")
+        df[f"{prefix}_date"] = temp.date
+        df[f"{prefix}_weekday"] = temp.dayofweek
+        df[f"{prefix}_month"] = temp.month
+        df[f"{prefix}_monthday"] = temp.day
+        df[f"{prefix}_time"] = temp.time
+        df[f"{prefix}_hour"] = temp.hour
+        df[f"{prefix}_minute"] = temp.minute
+        df[f"{prefix}_second"] = temp.second
+    for column in [
+        "pickup_datetime",
+        "dropoff_datetime",
+        "pickup_date",
+        "dropoff_date",
+        "pickup_time",
+        "dropoff_time",
+    ]:
+        del df[column]
+    return df
+
+
+def time_it(func, df, repeat):
+    """
+    Return the best wall time of repeat calls of func(df), and its last result.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(df)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    """
+    Time both implementations and check that they agree.
+    """
+    parser = argparse.ArgumentParser("bench_datetime_features")
+    parser.add_argument("--rows", type=int, default=1000000, help="Number of trips")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per implementation")
+    args = parser.parse_args()
+
+    df = make_trips(args.rows)
+
+    legacy_seconds, legacy = time_it(legacy_datetime_features, df, args.repeat)
+    fused_seconds, (features, valid) = time_it(trip_features, df, args.repeat)
+
+    if not valid.all():
+        raise AssertionError("trip_features rejected generated trips")
+    columns = [
+        f"{prefix}_{name}" for prefix in ["pickup", "dropoff"] for name in CALENDAR_FEATURES
+    ]
+    fused = pd.DataFrame({column: features[column] for column in columns})
+    for column in columns:
+        if not np.array_equal(legacy[column].to_numpy(), fused[column].to_numpy()):
+            raise AssertionError(f"Feature {column} differs between implementations")
+
+    print(f"rows: {args.rows}")
+    print(f"legacy DatetimeIndex: {args.rows / legacy_seconds:,.0f} rows/s ({legacy_seconds:.3f}s)")
+    print(f"trip_features:        {args.rows / fused_seconds:,.0f} rows/s ({fused_seconds:.3f}s)")
+    print(f"speedup: {legacy_seconds / fused_seconds:.1f}x")
+    print(
+        "feature bytes per row: legacy %d, fused %d"
+        % (
+            legacy[columns].memory_usage(index=False).sum() // args.rows,
+            fused.memory_usage(index=False).sum() // args.rows,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Load test the scoring service of serve.py with concurrent clients.
+
+Each client thread keeps one connection open and posts trips taken from a test
+data file written by train.py. The client side throughput and p50/p99 latency
+are printed with the /metrics of the service.
+
+Usage:
+    python data_science/nyc_taxi/src/serve.py --model_input <model folder> &
+    python data_science/nyc_taxi/benchmarks/bench_serving.py --test_data <test_data.csv> \
+        --clients 32 --requests 200
+"""
+import argparse
+import http.client
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from taxi_io import read_frame  # noqa: E402
+from taxi_schema import FEATURE_COLUMNS  # noqa: E402
+
+
+def run_client(url, bodies, latencies):
+    """
+    Post every request body over one connection and record the latencies.
+    """
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    headers = {"Content-Type": "application/json"}
+    for body in bodies:
+        start = time.perf_counter()
+        connection.request("POST", "/score", body, headers)
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"Scoring failed with status {response.status}")
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def main():
+    """
+    Run the load test and print the results.
+    """
+    parser = argparse.ArgumentParser("bench_serving")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8080", help="Service address")
+    parser.add_argument("--test_data", type=str, help="Test data file to take the trips from")
+    parser.add_argument("--clients", type=int, default=16, help="Number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per client")
+    parser.add_argument("--trips", type=int, default=1, help="Trips per request")
+    args = parser.parse_args()
+
+    url = urlparse(args.url)
+    records = read_frame(args.test_data, columns=FEATURE_COLUMNS).to_dict("records")
+
+    clients = []
+    latencies = [[] for _ in range(args.clients)]
+    for client in range(args.clients):
+        bodies = []
+        for request in range(args.requests):
+            first = (client * args.requests + request) * args.trips
+            trips = [records[(first + i) % len(records)] for i in range(args.trips)]
+            bodies.append(json.dumps({"trips": trips}, default=float))
+        clients.append(
+            threading.Thread(target=run_client, args=(url, bodies, latencies[client]))
+        )
+
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    seconds = time.perf_counter() - start
+
+    all_latencies = np.concatenate([np.array(client) for client in latencies])
+    if len(all_latencies) != args.clients * args.requests:
+        raise RuntimeError("Some clients failed, see the errors above")
+    p50, p99 = np.percentile(all_latencies, [50, 99]) * 1000
+    print("requests: %d in %.2fs" % (len(all_latencies), seconds))
+    print("throughput: %.0f requests/s, %.0f trips/s" % (len(all_latencies) / seconds, len(all_latencies) * args.trips / seconds))
+    print("client latency: p50 %.2f ms, p99 %.2f ms" % (p50, p99))
+
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    connection.request("GET", "/metrics")
+    print("service metrics:")
+    print(json.dumps(json.loads(connection.getresponse().read()), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+Benchmark the nyc_taxi pipeline steps locally, stage by stage.
+
+The raw sample files in dataEngineer/nyc_taxi/data_csv are scaled up to each
+requested number of rows, then prep.py, transform.py, train.py, predict.py and
+score.py are run one after the other as they are in the pipeline, each in its
+own process. The wall time, input rows per second and peak resident memory of
+every stage are written to a JSON results file, and compared against a baseline
+results file when one is given. The peak memory is that of the step process
+itself, not of the worker processes it may start.
+
+Throughput depends on the machine, so a baseline is only meaningful when it
+was recorded on the same machine. Record one by running the benchmark on the
+commit to compare against, then rerun it on the change with --baseline:
+
+    git checkout <reference commit>
+    python data_science/nyc_taxi/benchmarks/bench_stages.py --rows 10000 1000000 \
+        --output baseline.json
+    git checkout <change>
+    python data_science/nyc_taxi/benchmarks/bench_stages.py --rows 10000 1000000 \
+        --output bench_results.json --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[3]
+SRC_DIR = Path(__file__).resolve().parents[1] / "src"
+RAW_SAMPLES = REPO_ROOT / "dataEngineer" / "nyc_taxi" / "data_csv"
+
+sys.path.insert(0, str(SRC_DIR))
+from taxi_io import format_from_path  # noqa: E402
+
+def scale_csv(source, destination, rows, block_rows=100000):
+    """
+    Write a copy of a CSV file with its data rows repeated up to a number of rows.
+
+    Args:
+        source (Path): The sample CSV file.
+        destination (Path): The scaled CSV file to write.
+        rows (int): The number of data rows to write.
+        block_rows (int): The number of rows written at a time.
+    """
+    with open(source, "rb") as f:
+        header = f.readline()
+        lines = [line if line.endswith(b"\n") else line + b"\n" for line in f]
+
+    with open(destination, "wb") as f:
+        f.write(header)
+        written = 0
+        while written < rows:
+            block = min(block_rows, rows - written)
+            f.writelines(lines[(written + i) % len(lines)] for i in range(block))
+            written += block
+
+
+def count_rows(folder):
+    """
+    Count the data rows of a data file, or of every data file under a folder.
+
+    Args:
+        folder (Path): A data file, or a step input or output folder.
+
+    Returns:
+        int: The number of rows.
+    """
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+
+    rows = 0
+    folder = Path(folder)
+    paths = [folder] if folder.is_file() else sorted(folder.rglob("*"))
+    for path in paths:
+        data_format = format_from_path(path)
+        if not path.is_file() or data_format is None:
+            continue
+        if data_format == "parquet":
+            rows += pq.ParquetFile(path).metadata.num_rows
+        elif data_format == "arrow":
+            with ipc.open_file(path) as reader:
+                rows += sum(
+                    reader.get_batch(i).num_rows for i in range(reader.num_record_batches)
+                )
+        else:
+            with open(path, "rb") as f:
+                rows += sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b"")) - 1
+    return rows
+
+
+def peak_rss_mb(usage):
+    """
+    Convert the ru_maxrss of a resource usage into megabytes.
+    """
+    # Linux reports kilobytes, macOS bytes
+    scale = 1 if sys.platform == "darwin" else 1024
+    return usage.ru_maxrss * scale / 1e6
+
+
+def run_stage(stage, arguments, input_folder):
+    """
+    Run one step script in its own process and measure it.
+
+    Args:
+        stage (str): The step name, which is also its script name.
+        arguments (list[str]): The command line arguments of the script.
+        input_folder (Path): The main input of the step, to count its rows.
+
+    Returns:
+        dict: The stage, its input rows, wall time, rows per second and peak RSS.
+
+    Raises:
+        RuntimeError: If the script fails.
+    """
+    rows = count_rows(input_folder)
+    command = [sys.executable, str(SRC_DIR / f"{stage}.py")] + arguments
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, cwd=SRC_DIR)
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    if os.WIFEXITED(status):
+        process.returncode = os.WEXITSTATUS(status)
+    else:
+        process.returncode = -os.WTERMSIG(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"{stage}.py failed with exit code {process.returncode}")
+
+    return {
+        "stage": stage,
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_second": rows / max(seconds, 1e-9),
+        "peak_rss_mb": peak_rss_mb(usage),
+    }
+
+
+def run_pipeline(rows, workdir, output_format):
+    """
+    Run every stage on raw data scaled to a number of rows.
+
+    Args:
+        rows (int): The number of raw rows, split evenly between the samples.
+        workdir (Path): The folder for the raw data and stage outputs.
+        output_format (str): The format the steps write their outputs in.
+
+    Returns:
+        list[dict]: The measurements of each stage.
+    """
+    folders = {
+        name: workdir / name
+        for name in [
+            "raw_data",
+            "prep_data",
+            "transformed_data",
+            "model",
+            "test_data",
+            "predictions",
+            "score_report",
+        ]
+    }
+    for folder in folders.values():
+        folder.mkdir(parents=True)
+
+    samples = sorted(RAW_SAMPLES.glob("*.csv"))
+    for i, sample in enumerate(samples):
+        sample_rows = rows // len(samples) + (i < rows % len(samples))
+        scale_csv(sample, folders["raw_data"] / sample.name, sample_rows)
+
+    model_output = folders["model"] / "model"
+    stages = [
+        (
+            "prep",
+            ["--raw_data", folders["raw_data"], "--prep_data", folders["prep_data"],
+             "--output_format", output_format],
+            folders["raw_data"],
+        ),
+        (
+            "transform",
+            ["--clean_data", folders["prep_data"], "--transformed_data", folders["transformed_data"],
+             "--output_format", output_format],
+            folders["prep_data"] / f"merged_data.{output_format}",
+        ),
+        (
+            "train",
+            ["--train_data", folders["transformed_data"], "--test_data", folders["test_data"],
+             "--model_output", model_output, "--test_split_ratio", "0.2",
+             "--output_format", output_format],
+            folders["transformed_data"],
+        ),
+        (
+            "predict",
+            ["--model_input", model_output, "--test_data", folders["test_data"],
+             "--predictions", folders["predictions"], "--output_format", output_format],
+            folders["test_data"],
+        ),
+        (
+            "score",
+            ["--predictions", folders["predictions"], "--model", model_output,
+             "--score_report", folders["score_report"]],
+            folders["predictions"],
+        ),
+    ]
+
+    results = []
+    for stage, arguments, input_folder in stages:
+        result = run_stage(stage, [str(argument) for argument in arguments], input_folder)
+        result["raw_rows"] = rows
+        print(
+            "%-9s %12d rows %8.2fs %12.0f rows/s %9.1f MB peak RSS"
+            % (stage, result["rows"], result["seconds"], result["rows_per_second"], result["peak_rss_mb"])
+        )
+        results.append(result)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare stage throughput against a baseline results file.
+
+    Args:
+        results (list[dict]): The current measurements.
+        baseline (dict): The baseline results file content.
+        tolerance (float): The fraction of baseline rows/s a stage may lose.
+
+    Returns:
+        list[str]: A description of each regression found.
+    """
+    expected = {
+        (result["stage"], result["raw_rows"]): result for result in baseline["results"]
+    }
+    regressions = []
+    for result in results:
+        reference = expected.get((result["stage"], result["raw_rows"]))
+        if reference is None:
+            continue
+        ratio = result["rows_per_second"] / reference["rows_per_second"]
+        print(
+            "%-9s %12d raw rows: %.2fx baseline rows/s, %.2fx baseline peak RSS"
+            % (result["stage"], result["raw_rows"], ratio, result["peak_rss_mb"] / reference["peak_rss_mb"])
+        )
+        if ratio < 1 - tolerance:
+            regressions.append(
+                "%s at %d raw rows: %.0f rows/s against %.0f in the baseline"
+                % (result["stage"], result["raw_rows"], result["rows_per_second"], reference["rows_per_second"])
+            )
+    return regressions
+
+
+def main():
+    """
+    Run the stage benchmarks, save the results and check them against the baseline.
+    """
+    parser = argparse.ArgumentParser("bench_stages")
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[10000, 100000], help="Raw row counts to run the pipeline at"
+    )
+    parser.add_argument("--output_format", type=str, default="csv", help="Format of the step outputs")
+    parser.add_argument("--output", type=str, default="bench_results.json", help="Path of the results file")
+    parser.add_argument("--baseline", type=str, default="", help="Results file to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction of the baseline rows/s a stage may lose before it counts as a regression",
+    )
+    parser.add_argument("--workdir", type=str, default="", help="Folder for the scaled data (default: a temporary folder)")
+    args = parser.parse_args()
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="bench_stages_"))
+    results = []
+    try:
+        for rows in args.rows:
+            run_dir = workdir / f"rows_{rows}"
+            shutil.rmtree(run_dir, ignore_errors=True)
+            results.extend(run_pipeline(rows, run_dir, args.output_format))
+            shutil.rmtree(run_dir, ignore_errors=True)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "output_format": args.output_format,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("results written to %s" % args.output)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: %s" % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
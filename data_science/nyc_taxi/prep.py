@@ -1,13 +1,19 @@
 import argparse
 import os
+import sys
 from datetime import datetime
 from pathlib import Path
-import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import pickle
 from sklearn.linear_model import LinearRegression
 from sklearn.model_selection import train_test_split
 from mltables import MLTable
 
+sys.path.insert(0, str(Path(__file__).resolve().parent / "src"))
+from taxi_io import common_arrow_type  # noqa: E402
+
 parser = argparse.ArgumentParser("prep")
 parser.add_argument("--raw_data", type=str, help="Path to raw data file")
 parser.add_argument("--prep_data", type=str, help="Path of prepped data")
@@ -18,18 +24,37 @@ for line in lines:
     print(line)
 
 print("mounted_path files: ")
-taxi_df = pd.read_parquet(args.raw_data)
+raw_files = (
+    sorted(Path(args.raw_data).rglob("*.parquet"))
+    if Path(args.raw_data).is_dir()
+    else [Path(args.raw_data)]
+)
+print(raw_files)
 
 # Define useful columns needed for the Azure Machine Learning NYC Taxi tutorial
-useful_columns = f"['cost', 'distance', 'dropoff_datetime', 'dropoff_latitude', 'dropoff_longitude', 'passengers', 'pickup_datetime', 'pickup_latitude', 'pickup_longitude', 'store_forward', 'vendor']"
+useful_columns = [
+    "cost",
+    "distance",
+    "dropoff_datetime",
+    "dropoff_latitude",
+    "dropoff_longitude",
+    "passengers",
+    "pickup_datetime",
+    "pickup_latitude",
+    "pickup_longitude",
+    "store_forward",
+    "vendor",
+]
 
-# Rename columns as per Azure Machine Learning NYC Taxi tutorial
+# Rename columns as per Azure Machine Learning NYC Taxi tutorial. The green and
+# yellow sources name the same columns differently, so one map covers both.
 all_columns = {
     "vendorID": "vendor",
     "lpepPickupDatetime": "pickup_datetime",
     "lpepDropoffDatetime": "dropoff_datetime",
-    "tpepPickupDamok'//'teTime": "pickup_datetime",
+    "tpepPickupDateTime": "pickup_datetime",
     "tpepDropoffDateTime": "dropoff_datetime",
+    "storeAndFwdFlag": "store_forward",
     "pickupLongitude": "pickup_longitude",
     "pickupLatitude": "pickup_latitude",
     "dropoffLongitude": "dropoff_longitude",
@@ -46,22 +71,71 @@ all_columns = {
 # These functions ensure that null data is removed from the dataset,
 # which will help increase machine learning model accuracy.
 
-def get_dict(dict_str):
-    pairs = dict_str.strip("{}").split(";")
-    new_dict = {}
-    for pair in pairs:
-        key, value = pair.strip().split(":")
-        new_dict[key.strip().strip("'")] = value.strip().strip("'")
-    return new_dict
-
-def cleanseData(data, columns, useful_columns):
-    useful_columns = [s.strip().strip("'") for s in eval(useful_columns)]
-    new_columns = get_dict(str(columns))
-    new_df = (data.dropna(how="all").rename(columns=new_columns))[useful_columns]
-    new_df.reset_index(inplace=True, drop=True)
-    return new_df
-
-taxi_data_clean = cleanseData(taxi_df, all_columns, useful_columns)
+
+def read_projected(path, columns, useful_columns):
+    """
+    Read the useful columns of a raw parquet file, renamed to their canonical names.
+
+    Only the raw columns that map onto a useful column are read, so the other
+    columns are never decoded. Useful columns the file lacks are filled with nulls.
+
+    Args:
+        path (Path): The raw parquet file.
+        columns (dict): Raw column name -> canonical column name.
+        useful_columns (list[str]): The canonical columns to keep, in order.
+
+    Returns:
+        pa.Table: The useful columns of the file.
+    """
+    names = pq.read_schema(path).names
+    raw_columns = {}
+    for name in names:
+        canonical = columns.get(name, name)
+        if canonical in useful_columns and canonical not in raw_columns:
+            raw_columns[canonical] = name
+
+    table = pq.read_table(path, columns=list(raw_columns.values()))
+    table = table.rename_columns([columns.get(name, name) for name in table.column_names])
+    arrays = [
+        table[column] if column in raw_columns else pa.nulls(table.num_rows)
+        for column in useful_columns
+    ]
+    return pa.table(arrays, names=useful_columns)
+
+
+def cleanseData(tables):
+    """
+    Combine the projected tables and drop the rows without any useful value.
+
+    Args:
+        tables (list[pa.Table]): The tables from read_projected.
+
+    Returns:
+        pa.Table: The cleansed rows of every file.
+    """
+    schema = pa.schema(
+        [
+            (column, common_arrow_type([table.schema.field(column).type for table in tables]))
+            for column in tables[0].column_names
+        ]
+    )
+    table = pa.concat_tables([table.cast(schema) for table in tables])
+
+    empty = None
+    for column in table.columns:
+        missing = pc.is_null(column)
+        empty = missing if empty is None else pc.and_(empty, missing)
+    return table.filter(pc.invert(empty))
+
+
+taxi_data_clean = cleanseData(
+    [read_projected(path, all_columns, useful_columns) for path in raw_files]
+)
+print("prepped rows: %d" % taxi_data_clean.num_rows)
+
+# Convert column by column, letting pandas take over the Arrow buffers where
+# the types allow and freeing each Arrow column once it is converted
+taxi_data_clean = taxi_data_clean.to_pandas(split_blocks=True, self_destruct=True)
 
 # Save the prepped data as an mltable
 table = MLTable.from_dataframe(taxi_data_clean)
@@ -0,0 +1,377 @@
+"""
+Single-pass data profiles of the nyc_taxi steps, logged to MLflow.
+
+A step runs inside a DataProfile, and hands every frame it already holds in
+memory to profile_frame, with the rows its filters dropped:
+
+    with DataProfile("transform", enabled=args.data_profile.lower() == "true"):
+        profile_frame(final_df, rows_in=len(chunk), failed={"no_distance": 12})
+
+Each frame is profiled with one vectorized pass per column, into running
+totals that combine across frames, so a streamed run gets the same profile as
+an in-memory run. Per column it keeps:
+
+    numbers     count, nulls, min, max, mean, standard deviation, zeros, and a
+                histogram for the columns in HISTOGRAM_RANGES
+    timestamps  invalid count and the first and last timestamp
+    categories  the count of each value, up to MAX_CATEGORIES values
+
+Per filter it keeps the rows failing it. A row can fail several filters, so
+the dropped rows are also counted once in total. When the step ends, the
+profile is logged as profile/<step>_data.json, with the row, drop and null
+counts as <step>_profile_* MLflow metrics, along with the seconds spent
+profiling. The frames are profiled inside the spans of the step, so that time
+is part of their spans as well.
+
+Frames profiled outside of a DataProfile are ignored, so the step functions
+can be called from other scripts as they are.
+"""
+import datetime
+import time
+import numpy as np
+import pandas as pd
+import mlflow
+from taxi_features import parse_timestamps
+
+# Column -> (low, high, bins) of its histogram. Values outside the range are
+# counted below or above it.
+HISTOGRAM_RANGES = {
+    "cost": (0.0, 100.0, 50),
+    "distance": (0.0, 50.0, 50),
+    "passengers": (0.0, 10.0, 10),
+    "pickup_latitude": (40.4, 41.0, 60),
+    "dropoff_latitude": (40.4, 41.0, 60),
+    "pickup_longitude": (-74.8, -73.6, 60),
+    "dropoff_longitude": (-74.8, -73.6, 60),
+    "pickup_hour": (0.0, 24.0, 24),
+    "pickup_weekday": (0.0, 7.0, 7),
+    "trip_duration": (0.0, 7200.0, 48),
+}
+
+# Text columns holding "%Y-%m-%d %H:%M:%S" timestamps
+TIMESTAMP_COLUMNS = ["pickup_datetime", "dropoff_datetime"]
+
+# Most distinct values a category column is counted for
+MAX_CATEGORIES = 32
+
+# The profile of the running step, set by DataProfile
+_active = None
+
+
+def _numbers(series):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype(np.float64)
+    return series.to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+class NumberStats:
+    """
+    Running statistics of a numeric column.
+
+    The mean and variance are combined across frames with the pairwise update
+    of Chan et al., which stays accurate where sums of squares would not.
+
+    Args:
+        histogram (tuple): The (low, high, bins) of the histogram, or None.
+    """
+
+    def __init__(self, histogram=None):
+        self.count = 0
+        self.nulls = 0
+        self.zeros = 0
+        self.minimum = None
+        self.maximum = None
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.histogram = histogram
+        if histogram is not None:
+            self.counts = np.zeros(histogram[2], dtype=np.int64)
+            self.below = 0
+            self.above = 0
+
+    def update(self, series):
+        values = _numbers(series)
+        missing = np.isnan(values)
+        nulls = int(np.count_nonzero(missing))
+        if nulls:
+            values = values[~missing]
+        self.nulls += nulls
+        if not len(values):
+            return
+
+        count = len(values)
+        mean = float(values.mean())
+        m2 = float(np.square(values - mean).sum())
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+        low, high = float(values.min()), float(values.max())
+        self.minimum = low if self.minimum is None else min(self.minimum, low)
+        self.maximum = high if self.maximum is None else max(self.maximum, high)
+        self.zeros += int(np.count_nonzero(values == 0))
+
+        if self.histogram is not None:
+            low, high, bins = self.histogram
+            counts, _ = np.histogram(values, bins=bins, range=(low, high))
+            self.counts += counts
+            self.below += int(np.count_nonzero(values < low))
+            self.above += int(np.count_nonzero(values > high))
+
+    def to_dict(self):
+        result = {
+            "kind": "number",
+            "count": self.count,
+            "nulls": self.nulls,
+            "zeros": self.zeros,
+            "min": self.minimum,
+            "max": self.maximum,
+            "mean": self.mean if self.count else None,
+            "std": float(np.sqrt(self.m2 / self.count)) if self.count else None,
+        }
+        if self.histogram is not None:
+            low, high, bins = self.histogram
+            result["histogram"] = {
+                "low": low,
+                "high": high,
+                "counts": self.counts.tolist(),
+                "below": self.below,
+                "above": self.above,
+            }
+        return result
+
+
+class TimestampStats:
+    """
+    Running statistics of a column of timestamp strings.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.nulls = 0
+        self.invalid = 0
+        self.first = None
+        self.last = None
+
+    def update(self, series):
+        missing = series.isna().to_numpy()
+        nulls = int(np.count_nonzero(missing))
+        self.nulls += nulls
+        seconds, invalid = parse_timestamps(series)
+        self.invalid += int(np.count_nonzero(invalid & ~missing))
+        if invalid.any():
+            seconds = seconds[~invalid]
+        if not len(seconds):
+            return
+        self.count += len(seconds)
+        first, last = int(seconds.min()), int(seconds.max())
+        self.first = first if self.first is None else min(self.first, first)
+        self.last = last if self.last is None else max(self.last, last)
+
+    def to_dict(self):
+        def text(value):
+            if value is None:
+                return None
+            epoch = datetime.datetime(1970, 1, 1)
+            return (epoch + datetime.timedelta(seconds=value)).isoformat(sep=" ")
+
+        return {
+            "kind": "timestamp",
+            "count": self.count,
+            "nulls": self.nulls,
+            "invalid": self.invalid,
+            "min": text(self.first),
+            "max": text(self.last),
+        }
+
+
+class CategoryStats:
+    """
+    Running counts of the values of a text or categorical column.
+
+    Counting stops once the column has more than MAX_CATEGORIES values.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.nulls = 0
+        self.values = {}
+        self.overflow = False
+
+    def update(self, series):
+        nulls = int(series.isna().sum())
+        self.nulls += nulls
+        self.count += len(series) - nulls
+        if self.overflow:
+            return
+        for value, count in series.value_counts(dropna=True, sort=False).items():
+            if count:
+                key = str(value)
+                self.values[key] = self.values.get(key, 0) + int(count)
+        if len(self.values) > MAX_CATEGORIES:
+            self.overflow = True
+            self.values = {}
+
+    def to_dict(self):
+        return {
+            "kind": "category",
+            "count": self.count,
+            "nulls": self.nulls,
+            "values": None if self.overflow else dict(sorted(self.values.items())),
+        }
+
+
+def column_stats(column, dtype):
+    """
+    Create the running statistics of a column.
+
+    Args:
+        column (str): The column name.
+        dtype: The dtype of the column.
+
+    Returns:
+        NumberStats, TimestampStats or CategoryStats: The empty statistics.
+    """
+    if column in TIMESTAMP_COLUMNS:
+        return TimestampStats()
+    if isinstance(dtype, pd.CategoricalDtype) and dtype.categories.dtype.kind not in "iuf":
+        return CategoryStats()
+    if pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
+        return NumberStats(HISTOGRAM_RANGES.get(column))
+    return CategoryStats()
+
+
+class DataProfile:
+    """
+    Profile the frames of a step and log the profile to MLflow when it ends.
+
+    Args:
+        step (str): The name of the step.
+        enabled (bool): Whether to profile at all.
+    """
+
+    def __init__(self, step, enabled=True):
+        self.step = step
+        self.enabled = enabled
+        self.rows = 0
+        self.rows_in = 0
+        self.columns = {}
+        self.failed = {}
+        self.seconds = 0.0
+
+    def __enter__(self):
+        global _active
+        if self.enabled:
+            _active = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active
+        if _active is self:
+            _active = None
+        if exc_type is None and self.enabled and self.rows_in:
+            self.log()
+        return False
+
+    def update(self, frame, rows_in=None, failed=None):
+        """
+        Add a frame to the profile.
+
+        Args:
+            frame (pd.DataFrame): The rows the step keeps.
+            rows_in (int): The number of rows before the step's filters.
+                Defaults to the rows of the frame.
+            failed (dict): Filter name -> number of rows failing it.
+        """
+        start = time.perf_counter()
+        self.rows += len(frame)
+        self.rows_in += len(frame) if rows_in is None else rows_in
+        for name, count in (failed or {}).items():
+            self.failed[name] = self.failed.get(name, 0) + int(count)
+        for column in frame.columns:
+            if column not in self.columns:
+                self.columns[column] = column_stats(column, frame[column].dtype)
+            self.columns[column].update(frame[column])
+        self.seconds += time.perf_counter() - start
+
+    def to_dict(self):
+        """
+        Get the profile.
+
+        Returns:
+            dict: The row and drop counts and the statistics of every column.
+        """
+        return {
+            "step": self.step,
+            "seconds": self.seconds,
+            "rows_in": self.rows_in,
+            "rows": self.rows,
+            "dropped": self.rows_in - self.rows,
+            "failed": dict(self.failed),
+            "columns": {column: stats.to_dict() for column, stats in self.columns.items()},
+        }
+
+    def log(self):
+        """
+        Print a summary of the profile and log it to MLflow.
+        """
+        profile = self.to_dict()
+        print(
+            "%s profile: %d rows in, %d kept, %d dropped, profiled in %.3fs"
+            % (self.step, profile["rows_in"], profile["rows"], profile["dropped"], self.seconds)
+        )
+        metrics = {
+            f"{self.step}_profile_seconds": self.seconds,
+            f"{self.step}_profile_rows_in": profile["rows_in"],
+            f"{self.step}_profile_rows": profile["rows"],
+            f"{self.step}_profile_dropped": profile["dropped"],
+        }
+        for name, count in profile["failed"].items():
+            print("  failed %-24s %d" % (name, count))
+            metrics[f"{self.step}_profile_failed_{name}"] = count
+        for column, stats in profile["columns"].items():
+            if stats["nulls"]:
+                print("  nulls  %-24s %d" % (column, stats["nulls"]))
+            metrics[f"{self.step}_profile_nulls_{column}"] = stats["nulls"]
+        mlflow.log_metrics(metrics)
+        mlflow.log_dict(profile, f"profile/{self.step}_data.json")
+
+
+def profiling():
+    """
+    Check whether a step profile is collecting frames.
+
+    Returns:
+        bool: True inside an enabled DataProfile.
+    """
+    return _active is not None
+
+
+def profile_frame(frame, rows_in=None, failed=None):
+    """
+    Add a frame to the profile of the running step, if any.
+
+    Args:
+        frame (pd.DataFrame): The rows the step keeps.
+        rows_in (int): The number of rows before the step's filters.
+        failed (dict): Filter name -> number of rows failing it.
+    """
+    if _active is not None:
+        _active.update(frame, rows_in, failed)
+
+
+def add_data_profile_arguments(parser):
+    """
+    Add the --data_profile option to a step argument parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The step argument parser.
+    """
+    parser.add_argument(
+        "--data_profile",
+        type=str,
+        default="true",
+        help="Profile the columns of the step's data and log the profile to MLflow",
+    )
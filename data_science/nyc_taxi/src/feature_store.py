@@ -0,0 +1,260 @@
+"""
+Memory-mapped feature matrix store for the nyc_taxi pipeline steps.
+
+A store holds the model input of a step output as two contiguous float32
+arrays, written next to the data files of its folder:
+
+    <stem>.features.f32   The (rows, features) matrix in FEATURE_COLUMNS order.
+    <stem>.target.f32     The target column.
+    <stem>.manifest.json  The shape, dtype, column names and file names.
+
+Opening a store reads the manifest only. The arrays are memory-mapped read-only,
+so a step starts predicting or fitting straight from the page cache, without
+parsing text or building a DataFrame, and worker processes that map the same
+store share its pages instead of each holding a copy.
+
+Every feature is a float32, uint8 or boolean value, so the float32 matrix holds
+them exactly and the model sees the same input as through feature_matrix.
+"""
+import json
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from taxi_schema import (
+    FEATURE_COLUMNS,
+    FEATURE_DTYPES,
+    TARGET_COLUMN,
+    apply_dtypes,
+    feature_matrix,
+)
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+# Little-endian float32, whatever the machine that wrote the store
+STORE_DTYPE = np.dtype("<f4")
+
+
+def manifest_path(folder, stem):
+    """
+    Get the path of the manifest of a store.
+
+    Args:
+        folder (str or Path): The folder of the step output.
+        stem (str): The output name, e.g. "transformed_data".
+
+    Returns:
+        Path: The manifest file.
+    """
+    return Path(folder) / f"{stem}{MANIFEST_SUFFIX}"
+
+
+def has_feature_store(folder, stem):
+    """
+    Check whether a step output folder holds a feature store.
+
+    Args:
+        folder (str or Path): The folder of the step output.
+        stem (str): The output name, e.g. "transformed_data".
+
+    Returns:
+        bool: True if the store manifest exists.
+    """
+    return manifest_path(folder, stem).is_file()
+
+
+def use_feature_store(enabled, folder, stem):
+    """
+    Check the input a step was asked to read, and print which one it is.
+
+    A step only reads a feature store when it is asked to, so a stale store
+    left next to newer data files is never picked up by accident.
+
+    Args:
+        enabled (bool): Whether the step was run with --feature_store true.
+        folder (str or Path): The folder of the step input.
+        stem (str): The input name, e.g. "transformed_data".
+
+    Returns:
+        bool: enabled.
+
+    Raises:
+        FileNotFoundError: If the step was asked to read a store the folder
+            does not hold.
+    """
+    if enabled and not has_feature_store(folder, stem):
+        raise FileNotFoundError(
+            f"No {stem} feature store in {folder}, write it with --feature_store true"
+        )
+    print("reading %s from its %s" % (stem, "feature store" if enabled else "data files"))
+    return enabled
+
+
+class FeatureStoreWriter:
+    """
+    Append rows to a feature store, chunk by chunk.
+
+    The arrays are written as raw bytes and the manifest last, on close, so a
+    store is only visible to readers once it is complete.
+
+    Args:
+        folder (str or Path): The folder of the step output.
+        stem (str): The output name, e.g. "transformed_data".
+        columns (list[str]): The feature columns, in model order.
+        target (str): The target column.
+    """
+
+    def __init__(self, folder, stem, columns=FEATURE_COLUMNS, target=TARGET_COLUMN):
+        self.folder = Path(folder)
+        self.stem = stem
+        self.columns = list(columns)
+        self.target = target
+        self.rows = 0
+        self.files = {
+            "features": f"{stem}.features.f32",
+            "target": f"{stem}.target.f32",
+        }
+        manifest_path(folder, stem).unlink(missing_ok=True)
+        self._features = open(self.folder / self.files["features"], "wb")
+        self._target = open(self.folder / self.files["target"], "wb")
+
+    def append(self, features, target):
+        """
+        Append rows given as arrays.
+
+        Args:
+            features (np.ndarray): A (rows, features) matrix in column order.
+            target (np.ndarray): The target of each row.
+        """
+        features = np.ascontiguousarray(features, dtype=STORE_DTYPE)
+        target = np.ascontiguousarray(target, dtype=STORE_DTYPE)
+        if features.shape != (len(target), len(self.columns)):
+            raise ValueError(
+                f"Expected a ({len(target)}, {len(self.columns)}) feature matrix, got {features.shape}"
+            )
+        features.tofile(self._features)
+        target.tofile(self._target)
+        self.rows += len(target)
+
+    def write(self, df):
+        """
+        Append the feature and target columns of a frame.
+
+        Args:
+            df (pd.DataFrame): The rows to append. It may be empty.
+        """
+        self.append(
+            feature_matrix(df, self.columns, dtype=STORE_DTYPE),
+            df[self.target].to_numpy(dtype=STORE_DTYPE),
+        )
+
+    def close(self):
+        """
+        Finish the store and write its manifest.
+
+        Returns:
+            Path: The manifest file.
+        """
+        if self._features.closed:
+            return manifest_path(self.folder, self.stem)
+        self._features.close()
+        self._target.close()
+        manifest = {
+            "rows": self.rows,
+            "dtype": STORE_DTYPE.str,
+            "columns": self.columns,
+            "target": self.target,
+            "files": self.files,
+        }
+        path = manifest_path(self.folder, self.stem)
+        with open(path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        return path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_feature_store(df, folder, stem):
+    """
+    Write the feature and target columns of a frame as a feature store.
+
+    Args:
+        df (pd.DataFrame): The feature table.
+        folder (str or Path): The folder of the step output.
+        stem (str): The output name, e.g. "transformed_data".
+
+    Returns:
+        Path: The manifest file.
+    """
+    with FeatureStoreWriter(folder, stem) as writer:
+        writer.write(df)
+    return manifest_path(folder, stem)
+
+
+class FeatureStore:
+    """
+    A feature store opened for reading, with memory-mapped arrays.
+
+    Args:
+        folder (str or Path): The folder of the step output.
+        stem (str): The output name, e.g. "transformed_data".
+
+    Attributes:
+        features (np.ndarray): The read-only (rows, features) matrix.
+        target (np.ndarray): The read-only target column.
+        columns (list[str]): The feature columns.
+        target_column (str): The name of the target column.
+    """
+
+    def __init__(self, folder, stem):
+        folder = Path(folder)
+        with open(manifest_path(folder, stem)) as f:
+            manifest = json.load(f)
+
+        self.columns = manifest["columns"]
+        self.target_column = manifest["target"]
+        rows = manifest["rows"]
+        dtype = np.dtype(manifest["dtype"])
+        self.features = self._map(folder / manifest["files"]["features"], dtype, (rows, len(self.columns)))
+        self.target = self._map(folder / manifest["files"]["target"], dtype, (rows,))
+
+    @staticmethod
+    def _map(path, dtype, shape):
+        # np.memmap cannot map an empty file
+        if shape[0] == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+    def __len__(self):
+        return len(self.target)
+
+    @property
+    def nbytes(self):
+        """The size of the mapped arrays in bytes."""
+        return self.features.nbytes + self.target.nbytes
+
+    def frame(self, start=0, stop=None):
+        """
+        Build the feature table of a range of rows, with the compact dtype plan.
+
+        Args:
+            start (int): The first row.
+            stop (int, optional): The row after the last one. Defaults to the end.
+
+        Returns:
+            pd.DataFrame: The feature columns and the target.
+        """
+        df = pd.DataFrame(
+            {column: self.features[start:stop, i] for i, column in enumerate(self.columns)}
+        )
+        df[self.target_column] = self.target[start:stop]
+        # The vendor codes become categories of integers, not of floats
+        integer_first = {
+            column: "uint8"
+            for column in df.columns
+            if FEATURE_DTYPES.get(column) == "category"
+        }
+        return apply_dtypes(df.astype(integer_first), FEATURE_DTYPES)
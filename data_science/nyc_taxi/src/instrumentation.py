@@ -0,0 +1,262 @@
+"""
+Timed spans and profiles of the nyc_taxi steps, logged to MLflow.
+
+A step runs inside a StepProfiler, and its read, compute and write phases run
+inside spans:
+
+    with StepProfiler("transform", profile=args.profile.lower() == "true"):
+        with span("read") as s:
+            df = read_frame(path)
+            s.rows_out = len(df)
+
+Each span records its wall time, rows in and out and the peak resident memory
+of the process when it ends. Spans with the same name, such as the reads of
+every chunk of a file, are summed. When the step ends, the totals are logged as
+<step>_<span>_<seconds|rows_in|rows_out|rows_per_second> MLflow metrics, every
+span is logged to profile/<step>_spans.json, and with profiling on, the cProfile
+stats of the whole step are logged as profile/<step>.prof (pstats format, for
+snakeviz or gprof2dot) with a text summary. For flame graphs, run the step
+under py-spy instead, e.g. py-spy record -o prep.svg -- python prep.py ...
+
+Spans opened outside of a StepProfiler are still timed and printed, so the
+step functions can be called from other scripts as they are.
+"""
+import cProfile
+import io
+import pstats
+import resource
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+import mlflow
+
+# The profiler of the running step, set by StepProfiler
+_active = None
+
+
+def peak_rss_mb():
+    """
+    Get the peak resident memory of the current process so far.
+
+    Returns:
+        float: The peak RSS in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak * (1 if sys.platform == "darwin" else 1024) / 1e6
+
+
+class Span:
+    """
+    One timed phase of a step.
+
+    Args:
+        name (str): The phase, e.g. read, compute or write.
+        rows_in (int): The number of rows going into the phase, if known.
+    """
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.seconds = 0.0
+        self.peak_rss_mb = 0.0
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "seconds": self.seconds,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "peak_rss_mb": self.peak_rss_mb,
+        }
+
+
+@contextmanager
+def span(name, rows_in=None):
+    """
+    Time a phase of the running step.
+
+    Args:
+        name (str): The phase, e.g. read, compute or write.
+        rows_in (int): The number of rows going into the phase, if known.
+
+    Yields:
+        Span: The span, whose rows_out can be set inside the block.
+    """
+    record = Span(name, rows_in)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        record.peak_rss_mb = peak_rss_mb()
+        if _active is not None:
+            _active.spans.append(record)
+        else:
+            print("span %s: %.3fs" % (name, record.seconds))
+
+
+def add_span(name, seconds, rows_in=None, rows_out=None):
+    """
+    Record a phase that was timed elsewhere, such as in a worker process.
+
+    Args:
+        name (str): The phase, e.g. read, compute or write.
+        seconds (float): How long the phase took.
+        rows_in (int): The number of rows going into the phase, if known.
+        rows_out (int): The number of rows coming out of the phase, if known.
+    """
+    record = Span(name, rows_in)
+    record.rows_out = rows_out
+    record.seconds = seconds
+    record.peak_rss_mb = peak_rss_mb()
+    if _active is not None:
+        _active.spans.append(record)
+
+
+def timed_frames(frames, name="read"):
+    """
+    Time how long an iterator of frames takes to produce each frame.
+
+    Args:
+        frames (iterable): The frames, e.g. the chunks of iter_frames.
+        name (str): The span the time is recorded under.
+
+    Yields:
+        pd.DataFrame: The frames, unchanged.
+    """
+    iterator = iter(frames)
+    while True:
+        with span(name) as record:
+            try:
+                frame = next(iterator)
+            except StopIteration:
+                return
+            record.rows_out = len(frame)
+        yield frame
+
+
+class StepProfiler:
+    """
+    Collect the spans of a step and log them to MLflow when it ends.
+
+    Args:
+        step (str): The name of the step.
+        profile (bool): Also run the step under cProfile and log the stats.
+    """
+
+    def __init__(self, step, profile=False):
+        self.step = step
+        self.profile = profile
+        self.spans = []
+        self.seconds = 0.0
+        self._profiler = None
+        self._start = None
+
+    def __enter__(self):
+        global _active
+        _active = self
+        self._start = time.perf_counter()
+        if self.profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active
+        if self._profiler is not None:
+            self._profiler.disable()
+        self.seconds = time.perf_counter() - self._start
+        _active = None
+        if exc_type is None:
+            self.log()
+        return False
+
+    def totals(self):
+        """
+        Sum the spans of each name.
+
+        Returns:
+            dict: Span name -> seconds, rows_in, rows_out and peak_rss_mb, in
+                the order the names first appear.
+        """
+        totals = {}
+        for record in self.spans:
+            total = totals.setdefault(
+                record.name,
+                {"seconds": 0.0, "rows_in": None, "rows_out": None, "peak_rss_mb": 0.0},
+            )
+            total["seconds"] += record.seconds
+            for field in ["rows_in", "rows_out"]:
+                value = getattr(record, field)
+                if value is not None:
+                    total[field] = (total[field] or 0) + value
+            total["peak_rss_mb"] = max(total["peak_rss_mb"], record.peak_rss_mb)
+        return totals
+
+    def log(self):
+        """
+        Print the breakdown of the step and log it as MLflow metrics and artifacts.
+        """
+        totals = self.totals()
+        metrics = {
+            f"{self.step}_seconds": self.seconds,
+            f"{self.step}_peak_rss_mb": peak_rss_mb(),
+        }
+        print("%s: %.2fs, peak RSS %.1f MB" % (self.step, self.seconds, peak_rss_mb()))
+        for name, total in totals.items():
+            metrics[f"{self.step}_{name}_seconds"] = total["seconds"]
+            rows = total["rows_out"] if total["rows_out"] is not None else total["rows_in"]
+            for field in ["rows_in", "rows_out"]:
+                if total[field] is not None:
+                    metrics[f"{self.step}_{name}_{field}"] = total[field]
+            if rows is not None:
+                metrics[f"{self.step}_{name}_rows_per_second"] = rows / max(total["seconds"], 1e-9)
+            print(
+                "  %-10s %8.2fs %5.1f%% rows in %s, rows out %s"
+                % (
+                    name,
+                    total["seconds"],
+                    100 * total["seconds"] / max(self.seconds, 1e-9),
+                    total["rows_in"],
+                    total["rows_out"],
+                )
+            )
+        mlflow.log_metrics(metrics)
+
+        breakdown = {
+            "step": self.step,
+            "seconds": self.seconds,
+            "peak_rss_mb": peak_rss_mb(),
+            "totals": totals,
+            "spans": [record.to_dict() for record in self.spans],
+        }
+        mlflow.log_dict(breakdown, f"profile/{self.step}_spans.json")
+
+        if self._profiler is not None:
+            with tempfile.TemporaryDirectory() as folder:
+                stats_path = Path(folder) / f"{self.step}.prof"
+                self._profiler.dump_stats(stats_path)
+                mlflow.log_artifact(str(stats_path), "profile")
+
+            summary = io.StringIO()
+            pstats.Stats(self._profiler, stream=summary).sort_stats("cumulative").print_stats(40)
+            mlflow.log_text(summary.getvalue(), f"profile/{self.step}_pstats.txt")
+
+
+def add_profile_arguments(parser):
+    """
+    Add the --profile option to a step argument parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The step argument parser.
+    """
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default="false",
+        help="Run the step under cProfile and log the stats to MLflow",
+    )
@@ -0,0 +1,262 @@
+"""
+Parallel sweep over candidate fare models, on one shared copy of the training data.
+
+A sweep is a JSON list of candidates, given inline or as a file:
+
+    [
+        {"estimator": "linear_regression"},
+        {"estimator": "ridge", "params": {"alpha": [0.1, 1.0, 10.0]}},
+        {"estimator": "lasso", "params": {"alpha": [0.001, 0.01]},
+         "features": ["distance", "pickup_hour", "dropoff_hour"]}
+    ]
+
+A parameter given as a list is expanded into one candidate per value, or per
+combination when several are lists. "features" restricts a candidate to a
+subset of FEATURE_COLUMNS. The model it gives still takes every feature column,
+with a zero weight on the ones left out, so predict.py and serve.py use it as is.
+
+The training rows are copied once into a shared memory block, the rows to fit on
+first and the validation rows last. The worker processes map the block and fit
+on views of it, so the data is loaded and copied once whatever the number of
+candidates. Each candidate is scored on the validation rows, and the best one
+by R^2 is refit on every training row.
+"""
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import mlflow
+from sklearn.linear_model import ElasticNet, Lasso, LinearRegression, Ridge
+from regression_metrics import RegressionMetrics
+from taxi_schema import FEATURE_COLUMNS
+
+# Estimator name in a sweep -> linear model class
+ESTIMATORS = {
+    "linear_regression": LinearRegression,
+    "ridge": Ridge,
+    "lasso": Lasso,
+    "elastic_net": ElasticNet,
+}
+
+# Rows copied into the shared block at a time
+COPY_ROWS = 1 << 16
+
+# The shared training rows of a worker process, mapped by attach_worker
+_shared = {}
+
+
+def load_sweep(sweep):
+    """
+    Read a sweep definition.
+
+    Args:
+        sweep (str): The path of a JSON file, or the JSON itself.
+
+    Returns:
+        list[dict]: The candidate entries of the sweep.
+    """
+    if os.path.isfile(sweep):
+        with open(sweep, "r") as f:
+            return json.load(f)
+    return json.loads(sweep)
+
+
+def expand_candidates(entries):
+    """
+    Expand the entries of a sweep into one candidate per parameter combination.
+
+    Args:
+        entries (list[dict]): The entries of the sweep, see the module docstring.
+
+    Returns:
+        list[dict]: Candidates with a name, estimator, params and features.
+
+    Raises:
+        ValueError: If an entry names an unknown estimator or feature column.
+    """
+    candidates = []
+    for entry in entries:
+        estimator = entry["estimator"]
+        if estimator not in ESTIMATORS:
+            raise ValueError(
+                f"Unknown estimator {estimator}, expected one of {sorted(ESTIMATORS)}"
+            )
+        features = entry.get("features") or FEATURE_COLUMNS
+        unknown = [column for column in features if column not in FEATURE_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown feature columns: {unknown}")
+        # Keep the model column order whatever the order of the entry
+        features = [column for column in FEATURE_COLUMNS if column in features]
+
+        grid = {
+            name: value if isinstance(value, list) else [value]
+            for name, value in entry.get("params", {}).items()
+        }
+        for values in itertools.product(*grid.values()):
+            params = dict(zip(grid, values))
+            name = estimator
+            if params:
+                name += "(%s)" % ", ".join(f"{key}={value}" for key, value in params.items())
+            if len(features) < len(FEATURE_COLUMNS):
+                name += "[%d features]" % len(features)
+            candidates.append(
+                {"name": name, "estimator": estimator, "params": params, "features": features}
+            )
+    return candidates
+
+
+def build_estimator(candidate):
+    """
+    Create the unfitted estimator of a candidate.
+
+    Args:
+        candidate (dict): A candidate from expand_candidates.
+
+    Returns:
+        sklearn.base.RegressorMixin: The estimator.
+    """
+    return ESTIMATORS[candidate["estimator"]](**candidate["params"])
+
+
+def widen_model(model, features):
+    """
+    Make a model fitted on a subset of the feature columns take all of them.
+
+    The left out columns get a zero weight, so the predictions do not change.
+
+    Args:
+        model (sklearn.linear_model.LinearModel): The fitted model.
+        features (list[str]): The feature columns it was fitted on.
+
+    Returns:
+        sklearn.linear_model.LinearModel: The same model, over FEATURE_COLUMNS.
+    """
+    if len(features) == len(FEATURE_COLUMNS):
+        return model
+    coef = np.zeros(len(FEATURE_COLUMNS), dtype=np.float64)
+    coef[[FEATURE_COLUMNS.index(column) for column in features]] = model.coef_
+    model.coef_ = coef
+    model.n_features_in_ = len(FEATURE_COLUMNS)
+    return model
+
+
+def _share(blocks, shape, dtype):
+    size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    block = shared_memory.SharedMemory(create=True, size=size)
+    blocks.append(block)
+    descriptor = {"name": block.name, "shape": shape, "dtype": dtype.str}
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf), descriptor
+
+
+def _release(blocks):
+    for block in blocks:
+        block.unlink()
+        try:
+            block.close()
+        except BufferError:
+            # An array still maps the block; it is freed with the array
+            pass
+
+
+def attach_worker(descriptors, fit_rows):
+    """
+    Map the shared training rows into a worker process.
+
+    Used as the initializer of the sweep worker processes.
+
+    Args:
+        descriptors (dict): Array name -> name, shape and dtype of its block.
+        fit_rows (int): The number of rows to fit on; the rest are for validation.
+    """
+    # The fits of the candidates are logged by the parent process
+    mlflow.sklearn.autolog(disable=True)
+    _shared.clear()
+    for key, descriptor in descriptors.items():
+        # Workers share the resource tracker of the parent, which unlinks the block
+        block = shared_memory.SharedMemory(name=descriptor["name"])
+        _shared[key + "_block"] = block
+        _shared[key] = np.ndarray(
+            tuple(descriptor["shape"]), dtype=descriptor["dtype"], buffer=block.buf
+        )
+    _shared["fit_rows"] = fit_rows
+
+
+def evaluate_candidate(candidate):
+    """
+    Fit a candidate on the shared fit rows and score it on the validation rows.
+
+    Args:
+        candidate (dict): A candidate from expand_candidates.
+
+    Returns:
+        dict: The candidate with its validation metrics and fit time.
+    """
+    X, y, fit_rows = _shared["X"], _shared["y"], _shared["fit_rows"]
+    columns = [FEATURE_COLUMNS.index(column) for column in candidate["features"]]
+
+    start = time.perf_counter()
+    model = build_estimator(candidate).fit(X[:fit_rows, columns], y[:fit_rows])
+    fit_seconds = time.perf_counter() - start
+
+    metrics = RegressionMetrics().update(y[fit_rows:], model.predict(X[fit_rows:, columns]))
+    result = dict(candidate, fit_seconds=fit_seconds)
+    for metric, value in metrics.to_dict().items():
+        result[f"validation_{metric}"] = float(value)
+    return result
+
+
+def run_sweep(features, target, train_rows, candidates, workers, validation_ratio, seed=42):
+    """
+    Evaluate the candidates in parallel and refit the best one.
+
+    Args:
+        features (np.ndarray): The (rows, features) matrix of all the data,
+            e.g. a memory-mapped feature store.
+        target (np.ndarray): The target of all the data.
+        train_rows (np.ndarray): The rows to train on. The rest are test rows
+            and are not touched.
+        candidates (list[dict]): The candidates from expand_candidates.
+        workers (int): The number of processes to fit the candidates with.
+        validation_ratio (float): The fraction of the train rows the candidates
+            are scored on.
+        seed (int): The seed of the fit/validation split.
+
+    Returns:
+        tuple: The best model, refit on every train row, and the results of
+            every candidate in sweep order.
+    """
+    if not candidates:
+        raise ValueError("The sweep has no candidates")
+
+    # Fit rows first and validation rows last, so workers slice without copying
+    order = np.random.default_rng(seed).permutation(train_rows)
+    fit_rows = len(order) - int(round(len(order) * validation_ratio))
+    if fit_rows <= 0 or fit_rows >= len(order):
+        raise ValueError("The validation split leaves no rows to fit or to validate on")
+
+    blocks = []
+    try:
+        X, X_descriptor = _share(blocks, (len(order), features.shape[1]), np.dtype(np.float64))
+        y, y_descriptor = _share(blocks, (len(order),), np.dtype(np.float64))
+        for first in range(0, len(order), COPY_ROWS):
+            rows = order[first : first + COPY_ROWS]
+            X[first : first + len(rows)] = features[rows]
+            y[first : first + len(rows)] = target[rows]
+
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(candidates)),
+            initializer=attach_worker,
+            initargs=({"X": X_descriptor, "y": y_descriptor}, fit_rows),
+        ) as executor:
+            results = list(executor.map(evaluate_candidate, candidates))
+
+        best = max(results, key=lambda result: result["validation_r2_score"])
+        columns = [FEATURE_COLUMNS.index(column) for column in best["features"]]
+        model = widen_model(build_estimator(best).fit(X[:, columns], y), best["features"])
+        del X, y
+    finally:
+        _release(blocks)
+    return model, results
@@ -0,0 +1,135 @@
+"""
+Sufficient statistics of a linear least squares fit, accumulated chunk by chunk.
+
+Only the row count, the column means and the centered cross-product matrices
+are kept, so memory does not depend on the number of rows. Chunks are merged
+with the pairwise update of Chan et al., which keeps the centered sums
+numerically stable where raw sums of squares of coordinates like 40.7 would
+cancel out.
+"""
+import numpy as np
+from sklearn.linear_model import LinearRegression
+
+
+class NormalEquations:
+    """
+    Running n, means and centered X'X, X'y and y'y of a regression problem.
+
+    Args:
+        n_features (int): The number of columns of X.
+    """
+
+    def __init__(self, n_features):
+        self.n_features = n_features
+        self.count = 0
+        self.x_mean = np.zeros(n_features)
+        self.y_mean = 0.0
+        self.xx = np.zeros((n_features, n_features))
+        self.xy = np.zeros(n_features)
+        self.yy = 0.0
+
+    def update(self, X, y):
+        """
+        Add a chunk of rows to the statistics.
+
+        Args:
+            X (np.ndarray): A (rows, n_features) matrix.
+            y (np.ndarray): The (rows,) targets.
+
+        Returns:
+            NormalEquations: self
+        """
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if len(y) == 0:
+            return self
+
+        chunk = NormalEquations(self.n_features)
+        chunk.count = len(y)
+        chunk.x_mean = X.mean(axis=0)
+        chunk.y_mean = y.mean()
+        Xc = X - chunk.x_mean
+        yc = y - chunk.y_mean
+        chunk.xx = Xc.T @ Xc
+        chunk.xy = Xc.T @ yc
+        chunk.yy = yc @ yc
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """
+        Combine the statistics of another set of rows into these.
+
+        Args:
+            other (NormalEquations): Statistics over other rows.
+
+        Returns:
+            NormalEquations: self
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.__dict__.update({k: np.copy(v) for k, v in other.__dict__.items()})
+            return self
+
+        count = self.count + other.count
+        weight = self.count * other.count / count
+        dx = other.x_mean - self.x_mean
+        dy = other.y_mean - self.y_mean
+
+        self.xx += other.xx + weight * np.outer(dx, dx)
+        self.xy += other.xy + weight * dx * dy
+        self.yy += other.yy + weight * dy * dy
+        self.x_mean += dx * other.count / count
+        self.y_mean += dy * other.count / count
+        self.count = count
+        return self
+
+    def solve(self, alpha=0.0):
+        """
+        Solve for the coefficients and intercept.
+
+        With alpha 0 this is ordinary least squares: the minimum norm solution
+        of the centered normal equations, which is the solution LinearRegression
+        finds, also when columns are constant or collinear. A positive alpha
+        gives the ridge solution with an unpenalized intercept.
+
+        Args:
+            alpha (float): The L2 penalty.
+
+        Returns:
+            tuple: The coefficients, the intercept and the rank of X'X.
+        """
+        xx = self.xx + alpha * np.eye(self.n_features)
+        coef, _, rank, _ = np.linalg.lstsq(xx, self.xy, rcond=None)
+        intercept = self.y_mean - self.x_mean @ coef
+        return coef, intercept, rank
+
+    def r2_score(self, coef):
+        """
+        Compute the R^2 of a coefficient vector over the accumulated rows.
+
+        Args:
+            coef (np.ndarray): The coefficients, with the intercept set to center
+                the predictions on the target mean.
+
+        Returns:
+            float: The coefficient of determination.
+        """
+        residual = self.yy - 2 * coef @ self.xy + coef @ self.xx @ coef
+        return 1.0 - residual / self.yy
+
+    def to_estimator(self):
+        """
+        Build a fitted LinearRegression from the statistics.
+
+        Returns:
+            LinearRegression: An estimator that predicts exactly like one fitted
+                in memory on the same rows, and saves like one with MLflow.
+        """
+        coef, intercept, rank = self.solve()
+        model = LinearRegression()
+        model.coef_ = coef
+        model.intercept_ = intercept
+        model.rank_ = rank
+        model.n_features_in_ = self.n_features
+        return model
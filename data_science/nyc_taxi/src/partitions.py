@@ -0,0 +1,176 @@
+"""
+Month-partitioned step outputs and the manifest of processed inputs behind them.
+
+In incremental mode a step writes its output as
+<output>/<stem>/puYear=<year>/puMonth=<month>/<part>.<ext>, one part per input
+file and month, and records every input file it processed in a manifest next to
+the output: its path, size, checksum and the parts it produced. On the next run
+into the same output folder, only inputs that are new or whose size or checksum
+changed are processed again. Parts of unchanged inputs are reused as they are,
+and parts of inputs that disappeared are deleted.
+"""
+import hashlib
+import json
+from pathlib import Path
+import pandas as pd
+from taxi_features import DATETIME_FORMAT
+
+MANIFEST_NAME = "_manifest.json"
+
+# Partition of rows whose pickup time cannot be parsed, as named by Hive
+DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def file_checksum(path, block_size=1 << 20):
+    """
+    Compute the BLAKE2b checksum of a file, reading it in blocks.
+
+    Args:
+        path (str or Path): The file to hash.
+        block_size (int): The number of bytes to read at a time.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.blake2b()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def partition_dir(year, month):
+    """
+    Get the relative folder of a month partition.
+
+    Args:
+        year (int or None): The pickup year, None for unparseable pickup times.
+        month (int or None): The pickup month.
+
+    Returns:
+        str: puYear=<year>/puMonth=<month>
+    """
+    if year is None or pd.isna(year):
+        return f"puYear={DEFAULT_PARTITION}/puMonth={DEFAULT_PARTITION}"
+    return f"puYear={int(year)}/puMonth={int(month)}"
+
+
+def split_by_month(df, column="pickup_datetime", datetime_format=DATETIME_FORMAT):
+    """
+    Split a frame into its pickup month partitions.
+
+    Args:
+        df (pd.DataFrame): The data to split.
+        column (str): The timestamp column to partition on.
+        datetime_format (str): The strftime format of the timestamp strings.
+
+    Yields:
+        tuple: The relative partition folder and the rows of that month.
+    """
+    parsed = pd.to_datetime(df[column], format=datetime_format, errors="coerce")
+    keys = [parsed.dt.year.rename("year"), parsed.dt.month.rename("month")]
+    for (year, month), part in df.groupby(keys, sort=True, dropna=False):
+        yield partition_dir(year, month), part
+
+
+class PartitionManifest:
+    """
+    The record of which input files a step output already holds.
+
+    Args:
+        output_folder (str or Path): The step output folder holding the manifest.
+        output_format (str): The format the parts are written in. The parts of
+            a manifest written for another format are deleted, so every input
+            is redone and no part of the old format is left to be read.
+    """
+
+    def __init__(self, output_folder, output_format):
+        self.output_folder = Path(output_folder)
+        self.output_format = output_format
+        self.inputs = {}
+
+        manifest_path = self.output_folder / MANIFEST_NAME
+        if manifest_path.is_file():
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+            self.inputs = manifest["inputs"]
+            if manifest.get("output_format") != output_format:
+                print(
+                    "output format changed from %s to %s, redoing every input"
+                    % (manifest.get("output_format"), output_format)
+                )
+                for key in list(self.inputs):
+                    self.forget(key)
+
+    def plan(self, input_folder, paths):
+        """
+        Compare the current input files against the manifest.
+
+        Inputs that disappeared are dropped from the manifest and their parts
+        are deleted straight away.
+
+        Args:
+            input_folder (str or Path): The folder the input paths are relative to.
+            paths (list[Path]): The current input files.
+
+        Returns:
+            tuple: The list of (path, key, fingerprint) of the inputs to process,
+                and the list of keys of the inputs whose parts are reused.
+        """
+        input_folder = Path(input_folder)
+        changed, reused = [], []
+        current = set()
+        for path in paths:
+            key = Path(path).relative_to(input_folder).as_posix()
+            current.add(key)
+            fingerprint = {"size": Path(path).stat().st_size}
+            previous = self.inputs.get(key)
+            if previous is not None and previous["size"] == fingerprint["size"]:
+                fingerprint["checksum"] = file_checksum(path)
+                if previous["checksum"] == fingerprint["checksum"]:
+                    reused.append(key)
+                    continue
+            else:
+                fingerprint["checksum"] = file_checksum(path)
+            changed.append((path, key, fingerprint))
+
+        for key in sorted(set(self.inputs) - current):
+            print("input removed: %s" % key)
+            self.forget(key)
+        return changed, reused
+
+    def forget(self, key):
+        """
+        Delete the parts written for an input and drop it from the manifest.
+
+        Args:
+            key (str): The input path relative to the input folder.
+        """
+        for output in self.inputs.pop(key, {}).get("outputs", []):
+            (self.output_folder / output).unlink(missing_ok=True)
+
+    def record(self, key, fingerprint, outputs):
+        """
+        Record that an input has been processed into a set of parts.
+
+        Args:
+            key (str): The input path relative to the input folder.
+            fingerprint (dict): The size and checksum of the input.
+            outputs (list[Path]): The parts written for the input.
+        """
+        self.inputs[key] = {
+            "path": key,
+            **fingerprint,
+            "outputs": [
+                Path(output).relative_to(self.output_folder).as_posix()
+                for output in outputs
+            ],
+        }
+
+    def save(self):
+        """
+        Write the manifest into the output folder.
+        """
+        manifest = {"output_format": self.output_format, "inputs": self.inputs}
+        with open(self.output_folder / MANIFEST_NAME, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
@@ -1,79 +1,341 @@
 import argparse
-import pandas as pd
 import os
-from pathlib import Path
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.linear_model import LinearRegression
 import mlflow
+from feature_store import FeatureStore, use_feature_store
+from instrumentation import StepProfiler, add_profile_arguments, add_span, span, timed_frames
+from taxi_io import (
+    DATA_FORMATS,
+    find_data_file,
+    find_data_files,
+    iter_frames,
+    list_data_files,
+    read_columns,
+    read_frame,
+    write_frame,
+)
+from taxi_features import TRIP_COLUMNS, trip_feature_frame
+from taxi_schema import (
+    CLEAN_DTYPES,
+    FEATURE_COLUMNS,
+    FEATURE_DTYPES,
+    TARGET_COLUMN,
+    apply_dtypes,
+    feature_matrix,
+    memory_report,
+)
 
 mlflow.sklearn.autolog()
 
+# The model of the current process, loaded once by load_model
+_model = None
 
-parser = argparse.ArgumentParser("predict")
-parser.add_argument("--model_input", type=str, help="Path of input model")
-parser.add_argument("--test_data", type=str, help="Path to test data")
-parser.add_argument("--predictions", type=str, help="Path of predictions")
-
-args = parser.parse_args()
-
-print("hello scoring world...")
-
-lines = [
-    f"Model path: {args.model_input}",
-    f"Test data path: {args.test_data}",
-    f"Predictions path: {args.predictions}",
-]
-
-for line in lines:
-    print(line)
-
-# Load and split the test data
-
-print("mounted_path files: ")
-arr = os.listdir(args.test_data)
-
-print(arr)
-test_data = pd.read_csv(Path(args.test_data) / "test_data.csv")
-testy = test_data["cost"]
-# testX = test_data.drop(['cost'], axis=1)
-testX = test_data[
-    [
-        "distance",
-        "dropoff_latitude",
-        "dropoff_longitude",
-        "passengers",
-        "pickup_latitude",
-        "pickup_longitude",
-        "store_forward",
-        "vendor",
-        "pickup_weekday",
-        "pickup_month",
-        "pickup_monthday",
-        "pickup_hour",
-        "pickup_minute",
-        "pickup_second",
-        "dropoff_weekday",
-        "dropoff_month",
-        "dropoff_monthday",
-        "dropoff_hour",
-        "dropoff_minute",
-        "dropoff_second",
+
+def load_model(model_input):
+    """
+    Load the MLflow model into the current process.
+
+    Used as the initializer of the worker processes, so each worker loads the
+    model once rather than once per chunk.
+
+    Args:
+        model_input (str): Path of the MLflow model.
+    """
+    global _model
+    _model = mlflow.sklearn.load_model(model_input)
+
+
+def test_data_plan(path):
+    """
+    Choose the columns and dtypes to read a test data file with.
+
+    Args:
+        path (Path): A test data file.
+
+    Returns:
+        tuple: The columns and the dtype plan. Files with pickup_datetime hold
+            prepped trips, whose features are computed when they are predicted;
+            other files hold the feature table written by train.py.
+    """
+    if "pickup_datetime" in read_columns(path):
+        return TRIP_COLUMNS + [TARGET_COLUMN], CLEAN_DTYPES
+    return FEATURE_COLUMNS + [TARGET_COLUMN], FEATURE_DTYPES
+
+
+def predict_frame(model, test_data):
+    """
+    Predict the cost of the trips in a frame.
+
+    Args:
+        model (LinearRegression): The trained model.
+        test_data (pd.DataFrame): The feature columns and the actual cost, or
+            prepped trips and their cost. Prepped trips go through the same
+            trip_features as the training data, and unusable trips are dropped.
+
+    Returns:
+        pd.DataFrame: The feature columns, predicted_cost and actual_cost.
+    """
+    if "pickup_datetime" in test_data.columns:
+        test_data = trip_feature_frame(test_data, carry=[TARGET_COLUMN])
+    else:
+        test_data = apply_dtypes(test_data, FEATURE_DTYPES)
+    output_data = test_data[FEATURE_COLUMNS].copy()
+    output_data["predicted_cost"] = model.predict(feature_matrix(output_data))
+    output_data["actual_cost"] = test_data[TARGET_COLUMN]
+    return output_data
+
+
+def predict_store(model, store, start=0, stop=None):
+    """
+    Predict the cost of a range of trips of a feature store.
+
+    The model predicts straight from the memory-mapped matrix; only the output
+    table is built in memory.
+
+    Args:
+        model (LinearRegression): The trained model.
+        store (FeatureStore): The test data as a feature store.
+        start (int): The first row.
+        stop (int, optional): The row after the last one. Defaults to the end.
+
+    Returns:
+        pd.DataFrame: The feature columns, predicted_cost and actual_cost.
+    """
+    output_data = store.frame(start, stop)
+    actual_cost = output_data.pop(store.target_column)
+    output_data["predicted_cost"] = model.predict(store.features[start:stop])
+    output_data["actual_cost"] = actual_cost
+    return output_data
+
+
+def predict_shard(test_data, predictions, stem, output_format):
+    """
+    Predict a chunk of trips and write it to its own predictions shard.
+
+    Args:
+        test_data (pd.DataFrame): A chunk of the test data.
+        predictions (str): The predictions output folder.
+        stem (str): The shard file name without extension.
+        output_format (str): The format of the shard file.
+
+    Returns:
+        tuple: The shard path, its number of rows and the seconds spent
+            predicting and writing it.
+    """
+    start = time.perf_counter()
+    output_data = predict_frame(_model, test_data)
+    compute_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    path = write_frame(output_data, predictions, stem, output_format)
+    write_seconds = time.perf_counter() - start
+    return path, len(output_data), compute_seconds, write_seconds
+
+
+def predict_store_shard(test_data, first, last, predictions, stem, output_format):
+    """
+    Predict a range of rows of the test data feature store into its own shard.
+
+    Only the row range is sent to the worker, which maps the store itself, so
+    every worker reads the same pages of the page cache.
+
+    Args:
+        test_data (str): The test data folder holding the feature store.
+        first (int): The first row of the range.
+        last (int): The row after the last one.
+        predictions (str): The predictions output folder.
+        stem (str): The shard file name without extension.
+        output_format (str): The format of the shard file.
+
+    Returns:
+        tuple: The shard path, its number of rows and the seconds spent
+            predicting and writing it.
+    """
+    start = time.perf_counter()
+    output_data = predict_store(_model, FeatureStore(test_data, "test_data"), first, last)
+    compute_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    path = write_frame(output_data, predictions, stem, output_format)
+    write_seconds = time.perf_counter() - start
+    return path, len(output_data), compute_seconds, write_seconds
+
+
+def predict_in_memory(args):
+    """
+    Predict the whole test data at once into a single predictions file.
+
+    Args:
+        args (argparse.Namespace): The parsed step arguments.
+    """
+    if use_feature_store(
+        args.feature_store.lower() == "true", args.test_data, "test_data"
+    ):
+        with span("read") as record:
+            test_data = FeatureStore(args.test_data, "test_data")
+            record.rows_out = len(test_data)
+        print("feature store: %d rows, %.1f MB mapped" % (len(test_data), test_data.nbytes / 1e6))
+        predict = predict_store
+    else:
+        with span("read") as record:
+            path = find_data_file(args.test_data, "test_data")
+            columns, dtypes = test_data_plan(path)
+            test_data = apply_dtypes(read_frame(path, columns=columns, dtype=dtypes), dtypes)
+            record.rows_out = len(test_data)
+
+        report = memory_report(test_data)
+        print("test data bytes per row: %.1f" % report["bytes_per_row"])
+        mlflow.log_metric("test_data_bytes_per_row", report["bytes_per_row"])
+        mlflow.log_dict(report, "memory_report/test_data.json")
+        print(test_data.shape)
+        predict = predict_frame
+
+    with span("load_model"):
+        load_model(args.model_input)
+
+    # Save the output data with feature columns, predicted cost, and actual cost
+    with span("compute", rows_in=len(test_data)) as record:
+        output_data = predict(_model, test_data)
+        record.rows_out = len(output_data)
+    print(output_data.shape)
+    with span("write", rows_in=len(output_data)):
+        write_frame(output_data, args.predictions, "predictions", args.output_format)
+
+
+def predict_batches(args, workers):
+    """
+    Predict the test data in chunks across a pool of worker processes.
+
+    The chunks are read one at a time and at most two per worker are in flight,
+    so memory does not depend on the size of the test data. Each chunk is
+    written by its worker to predictions_<index>, so the shards sort in the
+    order of the test data. The compute and write spans add up the time spent
+    in every worker. When the test data is a feature store, the workers are
+    only sent row ranges and map the store themselves.
+
+    Args:
+        args (argparse.Namespace): The parsed step arguments.
+        workers (int): The number of processes to predict with.
+    """
+
+    def read_chunks():
+        for path in find_data_files(args.test_data, "test_data"):
+            columns, dtypes = test_data_plan(path)
+            chunks = iter_frames(path, args.chunk_size, columns=columns, dtype=dtypes)
+            for chunk in timed_frames(chunks):
+                yield predict_shard, chunk
+
+    def store_ranges():
+        rows = len(FeatureStore(args.test_data, "test_data"))
+        for first in range(0, rows, args.chunk_size):
+            last = min(first + args.chunk_size, rows)
+            yield predict_store_shard, args.test_data, first, last
+
+    if use_feature_store(
+        args.feature_store.lower() == "true", args.test_data, "test_data"
+    ):
+        tasks = store_ranges()
+    else:
+        tasks = read_chunks()
+
+    print("predicting in chunks of %d rows with %d workers ..." % (args.chunk_size, workers))
+    start = time.perf_counter()
+    rows = 0
+
+    def collect(future):
+        _, shard_rows, compute_seconds, write_seconds = future.result()
+        add_span("compute", compute_seconds, rows_in=shard_rows, rows_out=shard_rows)
+        add_span("write", write_seconds, rows_in=shard_rows)
+        return shard_rows
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=load_model, initargs=(args.model_input,)
+    ) as executor:
+        pending = deque()
+        for index, (function, *task) in enumerate(tasks):
+            if len(pending) >= 2 * workers:
+                rows += collect(pending.popleft())
+            pending.append(
+                executor.submit(
+                    function,
+                    *task,
+                    args.predictions,
+                    "predictions_%05d" % index,
+                    args.output_format,
+                )
+            )
+        for future in pending:
+            rows += collect(future)
+
+    seconds = time.perf_counter() - start
+    print("predicted %d rows in %.2fs: %.0f rows/s" % (rows, seconds, rows / max(seconds, 1e-9)))
+    mlflow.log_metric("predict_rows_per_second", rows / max(seconds, 1e-9))
+
+
+def main():
+    """
+    Predict the cost of the test trips with the trained model.
+    """
+    parser = argparse.ArgumentParser("predict")
+    parser.add_argument("--model_input", type=str, help="Path of input model")
+    parser.add_argument("--test_data", type=str, help="Path to test data")
+    parser.add_argument("--predictions", type=str, help="Path of predictions")
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="csv",
+        choices=list(DATA_FORMATS),
+        help="Format of the predictions file",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=0,
+        help="Predict in chunks of this many rows, one predictions file per chunk (0 predicts all the data at once)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to predict the chunks with (0 uses every core)",
+    )
+    parser.add_argument(
+        "--feature_store",
+        type=str,
+        default="false",
+        help="Read the test data from the feature store train wrote with --feature_store true",
+    )
+    add_profile_arguments(parser)
+
+    args = parser.parse_args()
+
+    print("hello scoring world...")
+
+    lines = [
+        f"Model path: {args.model_input}",
+        f"Test data path: {args.test_data}",
+        f"Predictions path: {args.predictions}",
+        f"Chunk size: {args.chunk_size}",
+        f"Workers: {args.workers}",
+        f"Feature store: {args.feature_store}",
     ]
-]
-print(testX.shape)
-print(testX.columns)
 
-# load mlflow model
-model = mlflow.sklearn.load_model(args.model_input)
+    for line in lines:
+        print(line)
 
-# Make predictions on testX data and record them in a column named predicted_cost
-predictions = model.predict(testX)
-testX["predicted_cost"] = predictions
-print(testX.shape)
+    print("mounted_path files: ")
+    arr = list_data_files(args.test_data)
+    print(arr)
 
-# Compare predictions to actuals (testy)
-output_data = pd.DataFrame(testX)
-output_data["actual_cost"] = testy
+    with StepProfiler("predict", profile=args.profile.lower() == "true"):
+        if args.chunk_size > 0:
+            predict_batches(args, args.workers or os.cpu_count())
+        else:
+            predict_in_memory(args)
 
 
-# Save the output data with feature columns, predicted cost, and actual cost in csv file
-output_data = output_data.to_csv((Path(args.predictions) / "predictions.csv"))
\ No newline at end of file
+if __name__ == "__main__":
+    main()
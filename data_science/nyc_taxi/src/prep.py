@@ -4,135 +4,324 @@ from typing_extensions import Concatenate
 from uuid import uuid4
 from datetime import datetime
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from sklearn.linear_model import LinearRegression
 from sklearn.model_selection import train_test_split
 import pickle
+from taxi_io import (
+    DATA_FORMATS,
+    FrameWriter,
+    iter_frames,
+    list_data_files,
+    read_columns,
+    read_projected,
+    write_frame,
+)
+from data_profile import DataProfile, add_data_profile_arguments, profile_frame
+from instrumentation import StepProfiler, add_profile_arguments, span, timed_frames
+from partitions import PartitionManifest, split_by_month
+from step_cache import add_cache_arguments, run_cached
+from taxi_schema import (
+    CLEAN_COLUMNS,
+    CLEAN_DTYPES,
+    SOURCE_SCHEMAS,
+    detect_source,
+    source_dtypes,
+)
+
+def group_by_source(arr):
+    """
+    Detect the taxi source of each raw file from its header.
+
+    Args:
+        arr (list[Path]): The raw data files.
+
+    Returns:
+        dict: Source name -> list of raw files from that source, for every
+            source in SOURCE_SCHEMAS.
+    """
+    files = {source: [] for source in SOURCE_SCHEMAS}
+    for path in arr:
+        source = detect_source(read_columns(path))
+        print("file: %s source: %s" % (path.name, source))
+        files[source].append(path)
+    return files
 
-parser = argparse.ArgumentParser("prep")
-parser.add_argument("--raw_data", type=str, help="Path to raw data")
-parser.add_argument("--prep_data", type=str, help="Path of prepped data")
-
-args = parser.parse_args()
-
-print("hello training world...")
-
-lines = [
-    f"Raw data path: {args.raw_data}",
-    f"Data output path: {args.prep_data}",
-]
-
-for line in lines:
-    print(line)
-
-print("mounted_path files: ")
-arr = os.listdir(args.raw_data)
-print(arr)
-
-df_list = []
-for filename in arr:
-    print("reading file: %s ..." % filename)
-    with open(os.path.join(args.raw_data, filename), "r") as handle:
-        # print (handle.read())
-        # ('input_df_%s' % filename) = pd.read_csv((Path(args.training_data) / filename))
-        input_df = pd.read_csv((Path(args.raw_data) / filename))
-        df_list.append(input_df)
-
-
-# Prep the green and yellow taxi data
-green_data = df_list[0]
-yellow_data = df_list[1]
-
-# Define useful columns needed for the Azure Machine Learning NYC Taxi tutorial
-
-useful_columns = str(
-    [
-        "cost",
-        "distance",
-        "dropoff_datetime",
-        "dropoff_latitude",
-        "dropoff_longitude",
-        "passengers",
-        "pickup_datetime",
-        "pickup_latitude",
-        "pickup_longitude",
-        "store_forward",
-        "vendor",
-    ]
-).replace(",", ";")
-print(useful_columns)
-
-# Rename columns as per Azure Machine Learning NYC Taxi tutorial
-green_columns = str(
-    {
-        "vendorID": "vendor",
-        "lpepPickupDatetime": "pickup_datetime",
-        "lpepDropoffDatetime": "dropoff_datetime",
-        "storeAndFwdFlag": "store_forward",
-        "pickupLongitude": "pickup_longitude",
-        "pickupLatitude": "pickup_latitude",
-        "dropoffLongitude": "dropoff_longitude",
-        "dropoffLatitude": "dropoff_latitude",
-        "passengerCount": "passengers",
-        "fareAmount": "cost",
-        "tripDistance": "distance",
-    }
-).replace(",", ";")
-
-yellow_columns = str(
-    {
-        "vendorID": "vendor",
-        "tpepPickupDateTime": "pickup_datetime",
-        "tpepDropoffDateTime": "dropoff_datetime",
-        "storeAndFwdFlag": "store_forward",
-        "startLon": "pickup_longitude",
-        "startLat": "pickup_latitude",
-        "endLon": "dropoff_longitude",
-        "endLat": "dropoff_latitude",
-        "passengerCount": "passengers",
-        "fareAmount": "cost",
-        "tripDistance": "distance",
-    }
-).replace(",", ";")
-
-print("green_columns: " + green_columns)
-print("yellow_columns: " + yellow_columns)
 
 # These functions ensure that null data is removed from the dataset,
 # which will help increase machine learning model accuracy.
 
 
-def get_dict(dict_str):
-    pairs = dict_str.strip("{}").split(";")
-    new_dict = {}
-    for pair in pairs:
-        print(pair)
-        key, value = pair.strip().split(":")
-        new_dict[key.strip().strip("'")] = value.strip().strip("'")
-    return new_dict
+def cleanseData(data, source):
+    """
+    Drop empty rows and map the raw columns of a source onto the canonical schema.
 
+    Args:
+        data (pd.DataFrame): Raw data read from a file of the given source.
+        source (str): The name of the source in SOURCE_SCHEMAS.
 
-def cleanseData(data, columns, useful_columns):
-    useful_columns = [
-        s.strip().strip("'") for s in useful_columns.strip("[]").split(";")
+    Returns:
+        pd.DataFrame: The cleansed data, with the CLEAN_COLUMNS in order.
+    """
+    new_df = (data.dropna(how="all").rename(columns=SOURCE_SCHEMAS[source]))[
+        CLEAN_COLUMNS
     ]
-    new_columns = get_dict(columns)
-
-    new_df = (data.dropna(how="all").rename(columns=new_columns))[useful_columns]
+    new_df = new_df.astype(CLEAN_DTYPES)
 
     new_df.reset_index(inplace=True, drop=True)
     return new_df
 
 
-green_data_clean = cleanseData(green_data, green_columns, useful_columns)
-yellow_data_clean = cleanseData(yellow_data, yellow_columns, useful_columns)
+def read_and_cleanse(path, source, use_threads=True):
+    """
+    Read and cleanse a single raw file.
 
-# Append yellow data to green data
-combined_df = green_data_clean.append(yellow_data_clean, ignore_index=True)
-combined_df.reset_index(inplace=True, drop=True)
+    This is the unit of work handed to each process of the ingest pool.
 
-output_green = green_data_clean.to_csv((Path(args.prep_data) / "green_prep_data.csv"))
-output_yellow = yellow_data_clean.to_csv(
-    (Path(args.prep_data) / "yellow_prep_data.csv")
-)
-merged_data = combined_df.to_csv((Path(args.prep_data) / "merged_data.csv"))
+    Args:
+        path (Path): The raw data file.
+        source (str): The name of the source in SOURCE_SCHEMAS.
+        use_threads (bool): Let the Arrow reader use multiple threads.
+
+    Returns:
+        tuple: The cleansed DataFrame and the seconds it took to produce it.
+    """
+    start = time.perf_counter()
+    input_df = read_projected(path, source_dtypes(source), use_threads=use_threads)
+    clean_df = cleanseData(input_df, source)
+    return clean_df, time.perf_counter() - start
+
+
+def ingest_files(tasks, workers=1):
+    """
+    Read and cleanse raw files, in a process pool when there is more than one worker.
+
+    Args:
+        tasks (list[tuple]): The (path, source) of each raw file.
+        workers (int): The number of processes to ingest the files with.
+
+    Returns:
+        list[pd.DataFrame]: The cleansed data of each file, in task order.
+    """
+    paths = [path for path, _ in tasks]
+    sources = [source for _, source in tasks]
+
+    print("reading %d files with %d workers ..." % (len(tasks), workers))
+    start = time.perf_counter()
+    with span("read") as record:
+        if workers > 1:
+            # One process per file already uses every core, so the Arrow reader
+            # inside each process runs single threaded
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(
+                    executor.map(read_and_cleanse, paths, sources, [False] * len(tasks))
+                )
+        else:
+            results = [read_and_cleanse(path, source) for path, source in tasks]
+        record.rows_out = sum(len(clean_df) for clean_df, _ in results)
+
+    df_list = []
+    for (path, source), (clean_df, seconds) in zip(tasks, results):
+        megabytes = path.stat().st_size / 1e6
+        print(
+            "read file: %s (%s) %d rows in %.2fs: %.0f rows/s, %.1f MB/s"
+            % (
+                path.name,
+                source,
+                len(clean_df),
+                seconds,
+                len(clean_df) / max(seconds, 1e-9),
+                megabytes / max(seconds, 1e-9),
+            )
+        )
+        profile_frame(clean_df)
+        df_list.append(clean_df)
+    print("ingest wall time: %.2fs" % (time.perf_counter() - start))
+    return df_list
+
+
+def prep_in_memory(files, prep_data, output_format, workers=1):
+    """
+    Load every raw file fully, cleanse it and write the prepped data.
+
+    Only the raw columns of each source are read, with their final dtypes.
+    With more than one worker the files are read and cleansed in a process
+    pool, one file per task, and the results are concatenated once at the end.
+
+    Args:
+        files (dict): Source name -> list of raw files, from group_by_source.
+        prep_data (str): The folder to write the prepped data to.
+        output_format (str): The format of the prepped data files.
+        workers (int): The number of processes to ingest the files with.
+    """
+    tasks = [(path, source) for source, paths in files.items() for path in paths]
+    results = ingest_files(tasks, workers)
+
+    df_list = {source: [] for source in files}
+    for (path, source), clean_df in zip(tasks, results):
+        df_list[source].append(clean_df)
+
+    with span("write", rows_in=sum(len(clean_df) for clean_df in results)):
+        for source, source_frames in df_list.items():
+            if source_frames:
+                source_df = pd.concat(source_frames, ignore_index=True)
+                write_frame(source_df, prep_data, f"{source}_prep_data", output_format)
+
+        # Append the sources one after another, green data first
+        combined_df = pd.concat(results, ignore_index=True)
+        write_frame(combined_df, prep_data, "merged_data", output_format)
+
+
+def prep_incremental(files, raw_data, prep_data, output_format, workers=1):
+    """
+    Cleanse only new or changed raw files into a month-partitioned merged_data.
+
+    Each raw file is written as one part per pickup month under
+    merged_data/puYear=<year>/puMonth=<month>, and recorded in the manifest of
+    prep_data. Raw files whose size and checksum match the manifest keep their
+    existing parts. The per-source outputs are not written in this mode.
+
+    Args:
+        files (dict): Source name -> list of raw files, from group_by_source.
+        raw_data (str): The folder holding the raw files.
+        prep_data (str): The folder to write the prepped data to. It has to be
+            the same folder as in the previous run for its parts to be reused.
+        output_format (str): The format of the prepped data files.
+        workers (int): The number of processes to ingest the files with.
+    """
+    sources = {path: source for source, paths in files.items() for path in paths}
+    manifest = PartitionManifest(prep_data, output_format)
+    changed, reused = manifest.plan(raw_data, list(sources))
+    print("raw files reused: %d, to process: %d" % (len(reused), len(changed)))
+
+    tasks = [(path, sources[path]) for path, _, _ in changed]
+    results = ingest_files(tasks, workers)
+
+    for (path, key, fingerprint), clean_df in zip(changed, results):
+        with span("write", rows_in=len(clean_df)):
+            manifest.forget(key)
+            part_name = key.replace("/", "_").replace(".", "_")
+            outputs = []
+            for partition, part in split_by_month(clean_df):
+                folder = Path(prep_data) / "merged_data" / partition
+                folder.mkdir(parents=True, exist_ok=True)
+                outputs.append(write_frame(part, folder, part_name, output_format))
+            manifest.record(key, fingerprint, outputs)
+        print("file: %s written to %d month partitions" % (key, len(outputs)))
+    manifest.save()
+
+
+def prep_streaming(files, prep_data, output_format, chunk_size):
+    """
+    Cleanse the raw files chunk by chunk and append each chunk to the outputs.
+
+    Peak memory is bounded by chunk_size instead of the size of the raw data.
+    The output files are identical to the ones written by prep_in_memory.
+
+    Args:
+        files (dict): Source name -> list of raw files, from group_by_source.
+        prep_data (str): The folder to write the prepped data to.
+        output_format (str): The format of the prepped data files.
+        chunk_size (int): The number of raw rows to process at a time.
+    """
+    with FrameWriter(prep_data, "merged_data", output_format) as merged_writer:
+        for source, paths in files.items():
+            if not paths:
+                continue
+
+            dtypes = source_dtypes(source)
+            with FrameWriter(prep_data, f"{source}_prep_data", output_format) as writer:
+                for path in paths:
+                    print("reading file: %s in chunks of %d rows ..." % (path.name, chunk_size))
+                    chunks = iter_frames(path, chunk_size, columns=list(dtypes), dtype=dtypes)
+                    for chunk in timed_frames(chunks):
+                        with span("compute", rows_in=len(chunk)) as record:
+                            chunk_clean = cleanseData(chunk, source)
+                            record.rows_out = len(chunk_clean)
+                        profile_frame(chunk_clean)
+                        with span("write", rows_in=len(chunk_clean)):
+                            writer.write(chunk_clean)
+                            merged_writer.write(chunk_clean)
+            print("%s rows written: %d" % (source, writer.rows))
+    print("merged rows written: %d" % merged_writer.rows)
+
+
+def main():
+    """
+    Prep the raw green and yellow taxi data for feature engineering.
+    """
+    parser = argparse.ArgumentParser("prep")
+    parser.add_argument("--raw_data", type=str, help="Path to raw data")
+    parser.add_argument("--prep_data", type=str, help="Path of prepped data")
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="csv",
+        choices=list(DATA_FORMATS),
+        help="Format of the prepped data files",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=0,
+        help="Stream the raw data in chunks of this many rows (0 loads it all at once)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to load the raw files with when not streaming (0 uses every core)",
+    )
+    parser.add_argument(
+        "--incremental",
+        type=str,
+        default="false",
+        help="Write month-partitioned output and only process new or changed raw files",
+    )
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
+    add_data_profile_arguments(parser)
+
+    args = parser.parse_args()
+
+    print("hello training world...")
+
+    lines = [
+        f"Raw data path: {args.raw_data}",
+        f"Data output path: {args.prep_data}",
+        f"Chunk size: {args.chunk_size}",
+        f"Workers: {args.workers}",
+        f"Incremental: {args.incremental}",
+    ]
+
+    for line in lines:
+        print(line)
+
+    print("mounted_path files: ")
+    arr = list_data_files(args.raw_data)
+    print(arr)
+
+    def compute():
+        files = group_by_source(arr)
+        workers = args.workers or os.cpu_count()
+
+        if args.incremental.lower() == "true":
+            prep_incremental(files, args.raw_data, args.prep_data, args.output_format, workers)
+        elif args.chunk_size > 0:
+            prep_streaming(files, args.prep_data, args.output_format, args.chunk_size)
+        else:
+            prep_in_memory(files, args.prep_data, args.output_format, workers)
+
+    # The worker count does not change the output, so it is not part of the cache key
+    with StepProfiler("prep", profile=args.profile.lower() == "true"), DataProfile(
+        "prep", enabled=args.data_profile.lower() == "true"
+    ):
+        run_cached(
+            "prep", __file__, args, ["raw_data"], ["prep_data"], compute, ignore=["workers"]
+        )
+
+
+if __name__ == "__main__":
+    main()
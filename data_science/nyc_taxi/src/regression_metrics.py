@@ -0,0 +1,97 @@
+"""
+Regression metrics accumulated chunk by chunk, in one pass over the predictions.
+
+Only the row count and a few running means are kept, so memory does not depend
+on the number of predictions. Each chunk is reduced to its own means, and the
+chunks are merged with the pairwise update of Chan et al., which avoids the
+cancellation of large raw sums of squares.
+"""
+import numpy as np
+
+
+class RegressionMetrics:
+    """
+    Running MSE, MAE, RMSE and R^2 of predictions against actual values.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.squared_error = 0.0
+        self.absolute_error = 0.0
+        self.actual_mean = 0.0
+        self.actual_m2 = 0.0
+
+    def update(self, actuals, predictions):
+        """
+        Add a chunk of predictions to the metrics.
+
+        Args:
+            actuals (array-like): The actual values.
+            predictions (array-like): The predicted values.
+
+        Returns:
+            RegressionMetrics: self
+        """
+        actuals = np.asarray(actuals, dtype=np.float64)
+        predictions = np.asarray(predictions, dtype=np.float64)
+        if len(actuals) == 0:
+            return self
+
+        errors = actuals - predictions
+        chunk = RegressionMetrics()
+        chunk.count = len(actuals)
+        chunk.squared_error = np.mean(errors * errors)
+        chunk.absolute_error = np.mean(np.abs(errors))
+        chunk.actual_mean = actuals.mean()
+        centered = actuals - chunk.actual_mean
+        chunk.actual_m2 = centered @ centered
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """
+        Combine the metrics of another set of predictions into these.
+
+        Args:
+            other (RegressionMetrics): Metrics over other predictions.
+
+        Returns:
+            RegressionMetrics: self
+        """
+        if other.count == 0:
+            return self
+
+        count = self.count + other.count
+        share = other.count / count
+        delta = other.actual_mean - self.actual_mean
+
+        self.squared_error += (other.squared_error - self.squared_error) * share
+        self.absolute_error += (other.absolute_error - self.absolute_error) * share
+        self.actual_m2 += other.actual_m2 + delta * delta * self.count * share
+        self.actual_mean += delta * share
+        self.count = count
+        return self
+
+    def to_dict(self):
+        """
+        Get the metrics over every prediction added so far.
+
+        Returns:
+            dict: count, mean_squared_error, root_mean_squared_error,
+                mean_absolute_error and r2_score.
+        """
+        if self.count == 0:
+            raise ValueError("No predictions to score")
+
+        residual_sum = self.squared_error * self.count
+        if self.actual_m2 > 0:
+            r2 = 1.0 - residual_sum / self.actual_m2
+        else:
+            # As in sklearn, a constant target is perfectly predicted or not at all
+            r2 = 1.0 if residual_sum == 0 else 0.0
+        return {
+            "count": self.count,
+            "mean_squared_error": self.squared_error,
+            "root_mean_squared_error": np.sqrt(self.squared_error),
+            "mean_absolute_error": self.absolute_error,
+            "r2_score": r2,
+        }
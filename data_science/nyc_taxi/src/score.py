@@ -1,71 +1,132 @@
 import argparse
-import pandas as pd
-import os
 from pathlib import Path
 from sklearn.linear_model import LinearRegression
-from sklearn.metrics import mean_squared_error, r2_score
 import mlflow
+from instrumentation import StepProfiler, add_profile_arguments, span, timed_frames
+from regression_metrics import RegressionMetrics
+from taxi_io import iter_frames, list_data_files
 
 mlflow.sklearn.autolog()
 
-parser = argparse.ArgumentParser("score")
-parser.add_argument(
-    "--predictions", type=str, help="Path of predictions and actual data"
-)
-parser.add_argument("--model", type=str, help="Path to model")
-parser.add_argument("--score_report", type=str, help="Path to score report")
 
-
-args = parser.parse_args()
-
-print("hello scoring world...")
-
-lines = [
-    f"Model path: {args.model}",
-    f"Predictions path: {args.predictions}",
-    f"Scoring output path: {args.score_report}",
-]
-
-for line in lines:
-    print(line)
-
-# Load the test data with predicted values
-
-print("mounted_path files: ")
-arr = os.listdir(args.predictions)
-
-print(arr)
-df_list = []
-for filename in arr:
-    print("reading file: %s ..." % filename)
-    with open(os.path.join(args.predictions, filename), "r") as handle:
-        # print (handle.read())
-        input_df = pd.read_csv((Path(args.predictions) / filename))
-        df_list.append(input_df)
-
-test_data = df_list[0]
-
-# Load the model from input port
-model = mlflow.sklearn.load_model(args.model)
-
-# Print the results of scoring the predictions against actual values in the test data
-# The coefficients
-print("Coefficients: \n", model.coef_)
-
-actuals = test_data["actual_cost"]
-predictions = test_data["predicted_cost"]
-
-# The mean squared error
-print("Mean squared error: %.2f" % mean_squared_error(actuals, predictions))
-# The coefficient of determination: 1 is perfect prediction
-print("Coefficient of determination: %.2f" % r2_score(actuals, predictions))
-print("Model: ", model)
-
-# Print score report to a text file
-(Path(args.score_report) / "score.txt").write_text(
-    "Scored with the following model:\n{}".format(model)
-)
-with open((Path(args.score_report) / "score.txt"), "a") as f:
-    f.write("\n Coefficients: \n %s \n" % str(model.coef_))
-    f.write("Mean squared error: %.2f \n" % mean_squared_error(actuals, predictions))
-    f.write("Coefficient of determination: %.2f \n" % r2_score(actuals, predictions))
\ No newline at end of file
+def score_predictions(test_data):
+    """
+    Score predicted costs against the actual costs.
+
+    Args:
+        test_data (pd.DataFrame): The actual_cost and predicted_cost columns.
+
+    Returns:
+        dict: The metrics, from RegressionMetrics.to_dict.
+    """
+    metrics = RegressionMetrics()
+    metrics.update(test_data["actual_cost"], test_data["predicted_cost"])
+    return metrics.to_dict()
+
+
+def write_score_report(model, metrics, score_report):
+    """
+    Print the scores and write them with the model to score.txt.
+
+    Args:
+        model (LinearRegression): The scored model.
+        metrics (dict): The scores, from RegressionMetrics.to_dict.
+        score_report (str): The folder to write score.txt to.
+    """
+    lines = [
+        "Mean squared error: %.2f" % metrics["mean_squared_error"],
+        "Root mean squared error: %.2f" % metrics["root_mean_squared_error"],
+        "Mean absolute error: %.2f" % metrics["mean_absolute_error"],
+        # The coefficient of determination: 1 is perfect prediction
+        "Coefficient of determination: %.2f" % metrics["r2_score"],
+    ]
+
+    # The coefficients
+    print("Coefficients: \n", model.coef_)
+    print("Scored predictions: %d" % metrics["count"])
+    for line in lines:
+        print(line)
+    print("Model: ", model)
+
+    # Print score report to a text file
+    (Path(score_report) / "score.txt").write_text(
+        "Scored with the following model:\n{}".format(model)
+    )
+    with open((Path(score_report) / "score.txt"), "a") as f:
+        f.write("\n Coefficients: \n %s \n" % str(model.coef_))
+        f.write("Scored predictions: %d \n" % metrics["count"])
+        for line in lines:
+            f.write("%s \n" % line)
+
+
+def score(args):
+    """
+    Score every predictions file chunk by chunk and write the score report.
+
+    The metrics are accumulated in one pass over all the shards, so memory
+    depends on the chunk size only.
+
+    Args:
+        args (argparse.Namespace): The parsed step arguments.
+    """
+    print("mounted_path files: ")
+    arr = list_data_files(args.predictions)
+    print(arr)
+
+    metrics = RegressionMetrics()
+    for path in arr:
+        print("reading file: %s in chunks of %d rows ..." % (path.name, args.chunk_size))
+        chunks = iter_frames(path, args.chunk_size, columns=["actual_cost", "predicted_cost"])
+        for chunk in timed_frames(chunks):
+            with span("compute", rows_in=len(chunk)):
+                metrics.update(chunk["actual_cost"], chunk["predicted_cost"])
+    scores = metrics.to_dict()
+
+    # Load the model from input port
+    with span("load_model"):
+        model = mlflow.sklearn.load_model(args.model)
+
+    with span("write"):
+        mlflow.log_metrics(
+            {name: value for name, value in scores.items() if name != "count"}
+        )
+        write_score_report(model, scores, args.score_report)
+
+
+def main():
+    """
+    Score the predictions of the model against the actual costs.
+    """
+    parser = argparse.ArgumentParser("score")
+    parser.add_argument(
+        "--predictions", type=str, help="Path of predictions and actual data"
+    )
+    parser.add_argument("--model", type=str, help="Path to model")
+    parser.add_argument("--score_report", type=str, help="Path to score report")
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=1000000,
+        help="Number of predictions to read at a time",
+    )
+    add_profile_arguments(parser)
+
+    args = parser.parse_args()
+
+    print("hello scoring world...")
+
+    lines = [
+        f"Model path: {args.model}",
+        f"Predictions path: {args.predictions}",
+        f"Scoring output path: {args.score_report}",
+    ]
+
+    for line in lines:
+        print(line)
+
+    with StepProfiler("score", profile=args.profile.lower() == "true"):
+        score(args)
+
+
+if __name__ == "__main__":
+    main()
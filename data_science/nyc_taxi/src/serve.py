@@ -0,0 +1,324 @@
+"""
+Local HTTP scoring service for the taxi fare model.
+
+The MLflow model written by train.py is loaded once. Trips posted to /score
+are queued, and a single batching thread groups the queued trips of concurrent
+requests into one vectorized predict call, of at most --max_batch_size trips,
+waiting at most --max_wait_ms for a batch to fill up.
+
+Endpoints:
+    POST /score    {"trips": [{<column>: <value>, ...}, ...]}, or a single trip
+                   object. A trip is either a prepped trip with the TRIP_COLUMNS,
+                   turned into features by record_features exactly as the
+                   training data was, or already computed FEATURE_COLUMNS.
+                   Returns {"predicted_cost": [...]}.
+    GET  /metrics  Request, trip and batch counters, throughput and the p50/p99
+                   request latency in milliseconds over the recent requests.
+    GET  /health   {"status": "ok"} once the model is loaded.
+
+Usage:
+    python serve.py --model_input <model folder> --port 8080
+"""
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import mlflow
+from taxi_features import record_features
+from taxi_schema import FEATURE_COLUMNS
+
+
+class PendingTrips:
+    """
+    The trips of one request, waiting for their predictions.
+
+    Args:
+        features (np.ndarray): A (trips, features) matrix.
+    """
+
+    def __init__(self, features):
+        self.features = features
+        self.predictions = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Group the trips of concurrent requests into vectorized predict calls.
+
+    Args:
+        model (LinearRegression): The fare model.
+        max_batch_size (int): The most trips predicted in one call. A request
+            with more trips is still predicted in a single call.
+        max_wait_ms (float): How long the first queued request of a batch
+            waits for others to join it.
+        latency_window (int): The number of recent request latencies kept for
+            the percentiles.
+    """
+
+    def __init__(self, model, max_batch_size=256, max_wait_ms=2.0, latency_window=10000):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=latency_window)
+        self.counters = {"requests": 0, "trips": 0, "batches": 0, "errors": 0}
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def predict(self, features):
+        """
+        Queue trips for the next batch and wait for their predictions.
+
+        Args:
+            features (np.ndarray): A (trips, features) matrix.
+
+        Returns:
+            np.ndarray: The predicted costs.
+        """
+        start = time.perf_counter()
+        pending = PendingTrips(features)
+        self.queue.put(pending)
+        pending.done.wait()
+
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+            self.counters["requests"] += 1
+            if pending.error is not None:
+                self.counters["errors"] += 1
+        if pending.error is not None:
+            raise pending.error
+        return pending.predictions
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        size = len(batch[0].features)
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                pending = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(pending)
+            size += len(pending.features)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                predictions = self.model.predict(
+                    np.concatenate([pending.features for pending in batch])
+                )
+            except Exception as error:
+                if len(batch) == 1:
+                    batch[0].error = error
+                    batch[0].done.set()
+                else:
+                    # Predict each request on its own, so the error only
+                    # reaches the request that caused it
+                    for pending in batch:
+                        self._predict_alone(pending)
+                continue
+
+            offset = 0
+            for pending in batch:
+                pending.predictions = predictions[offset : offset + len(pending.features)]
+                offset += len(pending.features)
+                pending.done.set()
+            with self.lock:
+                self.counters["batches"] += 1
+                self.counters["trips"] += len(predictions)
+
+    def _predict_alone(self, pending):
+        try:
+            pending.predictions = self.model.predict(pending.features)
+        except Exception as error:
+            pending.error = error
+        else:
+            with self.lock:
+                self.counters["batches"] += 1
+                self.counters["trips"] += len(pending.predictions)
+        pending.done.set()
+
+    def metrics(self):
+        """
+        Get the counters, throughput and latency percentiles so far.
+
+        Returns:
+            dict: The service metrics.
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            latencies = np.array(self.latencies)
+        seconds = time.perf_counter() - self.started
+        metrics = {
+            **counters,
+            "uptime_seconds": seconds,
+            "requests_per_second": counters["requests"] / seconds,
+            "trips_per_second": counters["trips"] / seconds,
+            "mean_batch_size": counters["trips"] / max(counters["batches"], 1),
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+        if len(latencies):
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+            metrics.update({"latency_p50_ms": p50, "latency_p99_ms": p99})
+        return metrics
+
+
+class ScoringServer(ThreadingHTTPServer):
+    """
+    A thread per connection, with room in the listen backlog for many clients.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def parse_trips(body):
+    """
+    Turn a /score request body into a feature matrix.
+
+    Args:
+        body (bytes): The JSON request body.
+
+    Returns:
+        np.ndarray: A float32 (trips, features) matrix in FEATURE_COLUMNS order.
+
+    Raises:
+        ValueError: If the body is not valid JSON, or a trip misses a column,
+            is not usable or has a missing or non-finite feature.
+    """
+    payload = json.loads(body)
+    trips = payload["trips"] if isinstance(payload, dict) and "trips" in payload else payload
+    if isinstance(trips, dict):
+        trips = [trips]
+    if not trips:
+        raise ValueError("No trips to score")
+
+    # The same float32 matrix as feature_matrix builds for batch prediction
+    features = np.empty((len(trips), len(FEATURE_COLUMNS)), dtype=np.float32)
+    for row, trip in enumerate(trips):
+        if "pickup_datetime" in trip:
+            try:
+                features[row] = record_features(trip)
+            except (KeyError, ValueError) as error:
+                raise ValueError(f"Trip {row} cannot be scored: {error}")
+            continue
+        missing = [column for column in FEATURE_COLUMNS if column not in trip]
+        if missing:
+            raise ValueError(f"Trip {row} is missing features: {missing}")
+        features[row] = [trip[column] for column in FEATURE_COLUMNS]
+
+    # Reject bad trips here, as the model would fail the whole batch they join
+    finite = np.isfinite(features)
+    if not finite.all():
+        row = int(np.flatnonzero(~finite.all(axis=1))[0])
+        columns = [column for column, ok in zip(FEATURE_COLUMNS, finite[row]) if not ok]
+        raise ValueError(f"Trip {row} has missing or non-finite features: {columns}")
+    return features
+
+
+def make_handler(batcher):
+    """
+    Build the request handler class of the service.
+
+    Args:
+        batcher (MicroBatcher): The batcher the predictions go through.
+
+    Returns:
+        type: A BaseHTTPRequestHandler subclass.
+    """
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+        # Keep the connection open between requests of the same client, and
+        # send small responses straight away instead of waiting for an ACK
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._send(200, batcher.metrics())
+            elif self.path == "/health":
+                self._send(200, {"status": "ok"})
+            else:
+                self._send(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/score":
+                self._send(404, {"error": f"Unknown path {self.path}"})
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                features = parse_trips(body)
+            except (ValueError, TypeError, KeyError) as error:
+                self._send(400, {"error": str(error)})
+                return
+            try:
+                predictions = batcher.predict(features)
+            except Exception as error:
+                self._send(500, {"error": str(error)})
+                return
+            self._send(200, {"predicted_cost": predictions.tolist()})
+
+        def log_message(self, format, *args):
+            # Per-request logging would dominate the latency
+            pass
+
+    return ScoringHandler
+
+
+def main():
+    """
+    Serve the fare model over HTTP until interrupted.
+    """
+    parser = argparse.ArgumentParser("serve")
+    parser.add_argument("--model_input", type=str, help="Path of input model")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument(
+        "--max_batch_size", type=int, default=256, help="Most trips predicted in one call"
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=2.0,
+        help="Longest time a request waits for others to share its batch",
+    )
+    args = parser.parse_args()
+
+    model = mlflow.sklearn.load_model(args.model_input)
+    batcher = MicroBatcher(model, args.max_batch_size, args.max_wait_ms)
+    server = ScoringServer((args.host, args.port), make_handler(batcher))
+
+    print("serving %s on http://%s:%d" % (args.model_input, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.metrics(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
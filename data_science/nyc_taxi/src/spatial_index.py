@@ -0,0 +1,315 @@
+"""
+Vectorized spatial index of the pickup and dropoff coordinates.
+
+Every function works on whole NumPy arrays of coordinates, so the location
+features of millions of trips are computed without a Python loop:
+
+- SpatialGrid maps coordinates onto the cells of a regular grid over a bounding
+  box, with cells of about the same size in kilometres on both axes.
+- geohash encodes coordinates as integer geohashes.
+- haversine_km gives the great-circle distance between two sets of coordinates.
+
+spatial_features combines them into the location columns transform.py adds to
+the transformed data. They are kept there for analysis of the trips; train.py
+only reads FEATURE_COLUMNS, so they are not model inputs.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from taxi_features import COORDINATE_BOUNDS
+
+# Mean radius of the Earth, as used by the haversine formula
+EARTH_RADIUS_KM = 6371.0088
+
+# Length of a degree of latitude
+KM_PER_DEGREE = 2 * np.pi * EARTH_RADIUS_KM / 360
+
+# The box holding every pickup and dropoff allowed by COORDINATE_BOUNDS:
+# (min latitude, max latitude, min longitude, max longitude)
+CITY_BOUNDS = (
+    min(low for column, (low, _) in COORDINATE_BOUNDS.items() if column.endswith("latitude")),
+    max(high for column, (_, high) in COORDINATE_BOUNDS.items() if column.endswith("latitude")),
+    min(low for column, (low, _) in COORDINATE_BOUNDS.items() if column.endswith("longitude")),
+    max(high for column, (_, high) in COORDINATE_BOUNDS.items() if column.endswith("longitude")),
+)
+
+# Columns added by spatial_features, and their dtypes
+SPATIAL_DTYPES = {
+    "pickup_cell": "int32",
+    "dropoff_cell": "int32",
+    "cell_pair": "int64",
+    "haversine_distance": "float32",
+}
+
+# Rows of trips spatial_features computes at a time
+BLOCK_ROWS = 1 << 14
+
+class SpatialGrid:
+    """
+    A regular grid of square cells over a bounding box.
+
+    Cells are numbered row by row from the south-west corner. The width of a
+    cell in degrees of longitude is scaled by the latitude of the middle of the
+    box, so cells are close to square on the ground.
+
+    Args:
+        bounds (tuple): (min latitude, max latitude, min longitude, max longitude).
+        cell_km (float): The side of a cell in kilometres.
+    """
+
+    def __init__(self, bounds=CITY_BOUNDS, cell_km=1.0):
+        min_lat, max_lat, min_lon, max_lon = bounds
+        if not (min_lat < max_lat and min_lon < max_lon):
+            raise ValueError(f"Invalid bounds: {bounds}")
+        if cell_km <= 0:
+            raise ValueError(f"Invalid cell size: {cell_km} km")
+
+        self.bounds = tuple(bounds)
+        self.cell_km = cell_km
+        self.lat_step = cell_km / KM_PER_DEGREE
+        self.lon_step = self.lat_step / np.cos(np.radians((min_lat + max_lat) / 2))
+        self.rows = int(np.ceil((max_lat - min_lat) / self.lat_step))
+        self.columns = int(np.ceil((max_lon - min_lon) / self.lon_step))
+
+    @property
+    def n_cells(self):
+        """The number of cells of the grid."""
+        return self.rows * self.columns
+
+    def cells(self, latitude, longitude):
+        """
+        Find the cell of each coordinate.
+
+        Args:
+            latitude (np.ndarray): The latitudes.
+            longitude (np.ndarray): The longitudes.
+
+        Returns:
+            np.ndarray: The int32 cell numbers, -1 for coordinates outside the
+                bounds or missing.
+        """
+        min_lat, max_lat, min_lon, max_lon = self.bounds
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+
+        row = np.floor((latitude - min_lat) / self.lat_step)
+        column = np.floor((longitude - min_lon) / self.lon_step)
+        # NaN coordinates compare False, so they are outside too
+        inside = (
+            (latitude >= min_lat)
+            & (latitude <= max_lat)
+            & (longitude >= min_lon)
+            & (longitude <= max_lon)
+        )
+        # The upper bounds themselves belong to the last row and column
+        np.minimum(row, self.rows - 1, out=row)
+        np.minimum(column, self.columns - 1, out=column)
+
+        row *= self.columns
+        row += column
+        return np.where(inside, row, -1).astype(np.int32)
+
+    def centers(self, cells):
+        """
+        Get the coordinates of the centers of cells.
+
+        Args:
+            cells (np.ndarray): Cell numbers from cells.
+
+        Returns:
+            tuple: The latitudes and longitudes of the centers, NaN for -1.
+        """
+        cells = np.asarray(cells)
+        row, column = np.divmod(cells, self.columns)
+        latitude = self.bounds[0] + (row + 0.5) * self.lat_step
+        longitude = self.bounds[2] + (column + 0.5) * self.lon_step
+        outside = cells < 0
+        return np.where(outside, np.nan, latitude), np.where(outside, np.nan, longitude)
+
+
+def _spread_bits(values):
+    """
+    Move the low 32 bits of each value to the even bit positions of a uint64.
+    """
+    values = values.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in [
+        (16, 0x0000FFFF0000FFFF),
+        (8, 0x00FF00FF00FF00FF),
+        (4, 0x0F0F0F0F0F0F0F0F),
+        (2, 0x3333333333333333),
+        (1, 0x5555555555555555),
+    ]:
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def geohash(latitude, longitude, precision=6):
+    """
+    Encode coordinates as integer geohashes.
+
+    The bits are those of the geohash text of the same precision, 5 per
+    character, starting with a longitude bit, so a prefix of the text is a
+    right shift of the integer.
+
+    Args:
+        latitude (np.ndarray): The latitudes.
+        longitude (np.ndarray): The longitudes.
+        precision (int): The number of geohash characters, from 1 to 12.
+
+    Returns:
+        np.ndarray: The uint64 geohashes.
+    """
+    if not 1 <= precision <= 12:
+        raise ValueError(f"Invalid geohash precision: {precision}")
+    bits = 5 * precision
+    lon_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+
+    def quantize(values, low, high, n_bits):
+        scaled = (np.asarray(values, dtype=np.float64) - low) / (high - low) * (1 << n_bits)
+        return np.clip(np.floor(scaled), 0, (1 << n_bits) - 1).astype(np.uint64)
+
+    lon = _spread_bits(quantize(longitude, -180.0, 180.0, lon_bits))
+    lat = _spread_bits(quantize(latitude, -90.0, 90.0, lat_bits))
+    # The first bit is a longitude bit: it lands on an even position when the
+    # total number of bits is odd, and on an odd one when it is even
+    if bits % 2:
+        return lon | (lat << np.uint64(1))
+    return (lon << np.uint64(1)) | lat
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    """
+    Compute the great-circle distance between pairs of coordinates.
+
+    Args:
+        latitude1 (np.ndarray): The latitudes of the first points.
+        longitude1 (np.ndarray): The longitudes of the first points.
+        latitude2 (np.ndarray): The latitudes of the second points.
+        longitude2 (np.ndarray): The longitudes of the second points.
+
+    Returns:
+        np.ndarray: The float64 distances in kilometres.
+    """
+    latitude1 = np.radians(np.asarray(latitude1, dtype=np.float64))
+    latitude2 = np.radians(np.asarray(latitude2, dtype=np.float64))
+    half_dlat = (latitude2 - latitude1) * 0.5
+    half_dlon = np.radians(
+        np.asarray(longitude2, dtype=np.float64) - np.asarray(longitude1, dtype=np.float64)
+    )
+    half_dlon *= 0.5
+
+    # a = sin^2(dlat / 2) + cos(lat1) cos(lat2) sin^2(dlon / 2), in place
+    np.sin(half_dlat, out=half_dlat)
+    half_dlat *= half_dlat
+    np.sin(half_dlon, out=half_dlon)
+    half_dlon *= half_dlon
+    np.cos(latitude1, out=latitude1)
+    np.cos(latitude2, out=latitude2)
+    latitude1 *= latitude2
+    latitude1 *= half_dlon
+    latitude1 += half_dlat
+
+    np.sqrt(latitude1, out=latitude1)
+    np.arcsin(latitude1, out=latitude1)
+    latitude1 *= 2 * EARTH_RADIUS_KM
+    return latitude1
+
+
+def _block_features(coordinates, grid, geohash_precision):
+    """
+    Compute the location features of a block of trips, see spatial_features.
+    """
+    coordinates = {
+        column: np.asarray(values, dtype=np.float64) for column, values in coordinates.items()
+    }
+    pickup = grid.cells(coordinates["pickup_latitude"], coordinates["pickup_longitude"])
+    dropoff = grid.cells(coordinates["dropoff_latitude"], coordinates["dropoff_longitude"])
+
+    cell_pair = pickup.astype(np.int64)
+    cell_pair *= grid.n_cells
+    cell_pair += dropoff
+    cell_pair[(pickup < 0) | (dropoff < 0)] = -1
+
+    features = {
+        "pickup_cell": pickup,
+        "dropoff_cell": dropoff,
+        "cell_pair": cell_pair,
+        "haversine_distance": haversine_km(
+            coordinates["pickup_latitude"],
+            coordinates["pickup_longitude"],
+            coordinates["dropoff_latitude"],
+            coordinates["dropoff_longitude"],
+        ),
+    }
+    if geohash_precision:
+        for end in ["pickup", "dropoff"]:
+            features[f"{end}_geohash"] = geohash(
+                coordinates[f"{end}_latitude"],
+                coordinates[f"{end}_longitude"],
+                geohash_precision,
+            )
+    return features
+
+
+def spatial_features(trips, grid, geohash_precision=0, threads=1):
+    """
+    Compute the location features of trips.
+
+    The trips are processed in blocks of BLOCK_ROWS, so the temporary arrays
+    stay in the CPU cache, and the blocks are spread over threads: NumPy
+    releases the GIL inside its array operations.
+
+    Args:
+        trips (pd.DataFrame): Trips with pickup and dropoff coordinates.
+        grid (SpatialGrid): The grid the coordinates are indexed on.
+        geohash_precision (int): Also add the pickup and dropoff geohashes, as
+            integers of this many characters. 0 leaves them out.
+        threads (int): The number of threads to compute the blocks with.
+
+    Returns:
+        dict: Column name -> array: the pickup_cell and dropoff_cell of the grid,
+            the cell_pair of the trip, -1 when either end is outside the grid,
+            the haversine_distance in kilometres, and the pickup_geohash and
+            dropoff_geohash if asked for.
+    """
+    coordinates = {
+        column: np.asarray(trips[column])
+        for column in ["pickup_latitude", "pickup_longitude", "dropoff_latitude", "dropoff_longitude"]
+    }
+    dtypes = dict(SPATIAL_DTYPES)
+    if geohash_precision:
+        dtypes.update({"pickup_geohash": "uint64", "dropoff_geohash": "uint64"})
+    features = {column: np.empty(len(trips), dtype=dtype) for column, dtype in dtypes.items()}
+
+    def fill(start):
+        block = {column: values[start : start + BLOCK_ROWS] for column, values in coordinates.items()}
+        for column, values in _block_features(block, grid, geohash_precision).items():
+            features[column][start : start + BLOCK_ROWS] = values
+
+    starts = range(0, len(trips), BLOCK_ROWS)
+    if threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(fill, starts))
+    else:
+        for start in starts:
+            fill(start)
+    return features
+
+
+def parse_bounds(text):
+    """
+    Parse the bounds of a grid from a command line argument.
+
+    Args:
+        text (str): "min_lat,max_lat,min_lon,max_lon", or "city" (or empty)
+            for CITY_BOUNDS.
+
+    Returns:
+        tuple: The bounds.
+    """
+    if not text or text.lower() == "city":
+        return CITY_BOUNDS
+    bounds = tuple(float(value) for value in text.split(","))
+    if len(bounds) != 4:
+        raise ValueError(f"Expected min_lat,max_lat,min_lon,max_lon, got {text}")
+    return bounds
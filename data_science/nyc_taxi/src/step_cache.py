@@ -0,0 +1,240 @@
+"""
+Content-addressed cache of step outputs for the nyc_taxi scripts.
+
+A step is keyed by a hash of the content of its input folders, the source of
+its script and of the local modules it imports, and its arguments. When the key
+is found in the cache, the cached output folders are copied into place instead
+of running the step. The cache is bounded in size and evicts the least recently
+used entries first.
+"""
+import hashlib
+import json
+import shutil
+import sys
+import time
+from pathlib import Path
+from partitions import file_checksum
+
+ENTRY_NAME = "_entry.json"
+
+
+def hash_folder(digest, folder):
+    """
+    Add the relative paths and contents of every file in a folder to a digest.
+
+    Args:
+        digest (hashlib._Hash): The digest to update.
+        folder (str or Path): The folder to hash.
+    """
+    folder = Path(folder)
+    paths = [folder] if folder.is_file() else sorted(folder.rglob("*"))
+    for path in paths:
+        if path.is_file():
+            digest.update(path.relative_to(folder).as_posix().encode())
+            digest.update(file_checksum(path).encode())
+
+
+def local_modules(script):
+    """
+    List the script and the already imported modules that live next to it.
+
+    Args:
+        script (str or Path): The step script.
+
+    Returns:
+        list[Path]: The source files, in a stable order.
+    """
+    script = Path(script).resolve()
+    sources = {script}
+    for module in list(sys.modules.values()):
+        module_file = getattr(module, "__file__", None)
+        if module_file and Path(module_file).resolve().parent == script.parent:
+            sources.add(Path(module_file).resolve())
+    return sorted(source for source in sources if source.suffix == ".py")
+
+
+class StepCache:
+    """
+    A size-bounded, least recently used cache of step output folders.
+
+    Args:
+        cache_dir (str or Path): The folder holding the cache entries.
+        max_bytes (int): The total size the cache is trimmed to after each store.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, step, script, inputs, arguments):
+        """
+        Compute the cache key of a step run.
+
+        Args:
+            step (str): The name of the step.
+            script (str or Path): The step script.
+            inputs (list[str]): The input folders or files of the step.
+            arguments (dict): The arguments that change the step output.
+
+        Returns:
+            str: The hex digest identifying the run.
+        """
+        digest = hashlib.blake2b()
+        digest.update(step.encode())
+        for source in local_modules(script):
+            digest.update(source.name.encode())
+            digest.update(source.read_bytes())
+        for folder in inputs:
+            hash_folder(digest, folder)
+        digest.update(json.dumps(arguments, sort_keys=True, default=str).encode())
+        return digest.hexdigest()[:32]
+
+    def restore(self, key, outputs):
+        """
+        Copy a cached entry into the step output folders.
+
+        Args:
+            key (str): The cache key of the run.
+            outputs (dict): Output name -> output folder.
+
+        Returns:
+            dict: The cache entry metadata, or None on a miss.
+        """
+        entry_dir = self.cache_dir / key
+        entry_path = entry_dir / ENTRY_NAME
+        if not entry_path.is_file():
+            return None
+
+        with open(entry_path, "r") as f:
+            entry = json.load(f)
+        for name, folder in outputs.items():
+            shutil.copytree(entry_dir / name, folder, dirs_exist_ok=True)
+
+        entry["last_used"] = time.time()
+        with open(entry_path, "w") as f:
+            json.dump(entry, f)
+        return entry
+
+    def store(self, key, step, outputs, seconds):
+        """
+        Copy the step output folders into a new cache entry, then evict.
+
+        Args:
+            key (str): The cache key of the run.
+            step (str): The name of the step.
+            outputs (dict): Output name -> output folder.
+            seconds (float): How long the step took to compute.
+        """
+        entry_dir = self.cache_dir / key
+        staging_dir = self.cache_dir / f"{key}.tmp"
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        for name, folder in outputs.items():
+            shutil.copytree(folder, staging_dir / name)
+
+        size = sum(path.stat().st_size for path in staging_dir.rglob("*") if path.is_file())
+        entry = {
+            "step": step,
+            "bytes": size,
+            "seconds": seconds,
+            "created": time.time(),
+            "last_used": time.time(),
+        }
+        with open(staging_dir / ENTRY_NAME, "w") as f:
+            json.dump(entry, f)
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        staging_dir.rename(entry_dir)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        entries = []
+        for entry_path in self.cache_dir.glob(f"*/{ENTRY_NAME}"):
+            with open(entry_path, "r") as f:
+                entries.append((json.load(f), entry_path.parent))
+
+        total = sum(entry["bytes"] for entry, _ in entries)
+        removed = 0
+        for entry, entry_dir in sorted(entries, key=lambda item: item[0]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            print("cache evict: %s (%s, %d bytes)" % (entry_dir.name, entry["step"], entry["bytes"]))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= entry["bytes"]
+            removed += 1
+        return removed
+
+
+def add_cache_arguments(parser):
+    """
+    Add the --cache_dir and --cache_max_gb options to a step argument parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The step argument parser.
+    """
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="",
+        help="Folder of the step cache (empty disables the cache)",
+    )
+    parser.add_argument(
+        "--cache_max_gb",
+        type=float,
+        default=10.0,
+        help="Size the step cache is trimmed to, in GB",
+    )
+
+
+def run_cached(step, script, args, inputs, outputs, compute, ignore=()):
+    """
+    Run a step, or restore its outputs from the cache if it already ran.
+
+    Arguments named in inputs and outputs are folders. Input folders are hashed
+    by content and output folder paths do not affect the key, so a rerun into a
+    fresh output folder still hits the cache.
+
+    Args:
+        step (str): The name of the step.
+        script (str): The step script, usually __file__.
+        args (argparse.Namespace): The parsed step arguments.
+        inputs (list[str]): The names of the input folder arguments.
+        outputs (list[str]): The names of the output folder arguments.
+        compute (callable): Runs the step and writes its outputs.
+        ignore (tuple[str]): Arguments that do not change the outputs, such as
+            the number of workers, and so are left out of the key.
+    """
+    if not getattr(args, "cache_dir", ""):
+        compute()
+        return
+
+    cache = StepCache(args.cache_dir, int(args.cache_max_gb * 1e9))
+    # Profiling does not change the outputs either
+    excluded = set(inputs) | set(outputs) | set(ignore)
+    excluded |= {"cache_dir", "cache_max_gb", "profile", "data_profile"}
+    arguments = {name: value for name, value in vars(args).items() if name not in excluded}
+
+    start = time.perf_counter()
+    key = cache.key(step, script, [getattr(args, name) for name in inputs], arguments)
+    output_folders = {name: getattr(args, name) for name in outputs}
+
+    entry = cache.restore(key, output_folders)
+    if entry is not None:
+        print(
+            "cache hit: %s %s restored in %.2fs, saved %.2fs of compute"
+            % (step, key, time.perf_counter() - start, entry["seconds"])
+        )
+        return
+
+    print("cache miss: %s %s" % (step, key))
+    compute_start = time.perf_counter()
+    compute()
+    seconds = time.perf_counter() - compute_start
+    cache.store(key, step, output_folders, seconds)
+    print("cache store: %s %s after %.2fs of compute" % (step, key, seconds))
@@ -0,0 +1,411 @@
+"""
+Vectorized feature engineering for the nyc_taxi pipeline steps.
+
+trip_features is the single definition of how a prepped trip becomes a model
+input. It works on NumPy arrays, so transform.py applies it to millions of
+trips at once and predict.py and serve.py apply it to a handful, with the same
+code and therefore the same features.
+"""
+import numpy as np
+import pandas as pd
+from taxi_schema import FEATURE_COLUMNS, FEATURE_DTYPES, apply_dtypes
+
+# Format of the pickup and dropoff timestamps in the raw taxi data
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Calendar features derived from each timestamp column, in output order
+CALENDAR_FEATURES = ["weekday", "month", "monthday", "hour", "minute", "second"]
+
+SECONDS_PER_DAY = 86400
+
+# Bounds of the pickup and dropoff coordinates of trips inside the city
+COORDINATE_BOUNDS = {
+    "pickup_longitude": (-74.09, -73.72),
+    "pickup_latitude": (40.53, 40.88),
+    "dropoff_longitude": (-74.72, -73.72),
+    "dropoff_latitude": (40.53, 40.88),
+}
+
+# store_forward values meaning the trip was not held in the vehicle memory
+STORE_FORWARD_NO = ["N", "0"]
+
+# Columns of a prepped trip that its features are computed from
+TRIP_COLUMNS = [
+    "distance",
+    "dropoff_latitude",
+    "dropoff_longitude",
+    "passengers",
+    "pickup_latitude",
+    "pickup_longitude",
+    "store_forward",
+    "vendor",
+    "pickup_datetime",
+    "dropoff_datetime",
+]
+
+# Positions of the digits of a "%Y-%m-%d %H:%M:%S" timestamp
+_DIGITS = np.array([0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18])
+_SEPARATORS = {4: ord("-"), 7: ord("-"), 10: ord(" "), 13: ord(":"), 16: ord(":")}
+_DAYS_IN_MONTH = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+# The same constants as Python scalars, for record_features. The bounds are
+# rounded to float32 as NumPy does when it compares them with float32 arrays.
+_MONTH_DAYS = tuple(_DAYS_IN_MONTH.tolist())
+_BOUNDS_FLOAT32 = {
+    column: (float(np.float32(low)), float(np.float32(high)))
+    for column, (low, high) in COORDINATE_BOUNDS.items()
+}
+
+
+def epoch_seconds(values, datetime_format=DATETIME_FORMAT):
+    """
+    Parse timestamps into int64 seconds since 1970-01-01.
+
+    Args:
+        values (pd.Series): Timestamp strings, or an already parsed datetime column.
+        datetime_format (str): The strftime format of the strings.
+
+    Returns:
+        tuple: The int64 epoch seconds and a boolean mask of the values that
+            could not be parsed. Masked entries hold an undefined value.
+    """
+    if not pd.api.types.is_datetime64_any_dtype(values):
+        values = pd.to_datetime(values, format=datetime_format, errors="coerce")
+    parsed = values.to_numpy(dtype="datetime64[s]")
+    return parsed.view("int64"), np.isnat(parsed)
+
+
+def days_from_civil(year, month, day):
+    """
+    Count the days from 1970-01-01 to proleptic Gregorian dates.
+
+    The inverse of the date arithmetic in calendar_fields, and like it usable
+    on ints as well as arrays.
+
+    Args:
+        year (int or np.ndarray): Years.
+        month (int or np.ndarray): Months, 1 to 12.
+        day (int or np.ndarray): Days of the month.
+
+    Returns:
+        int or np.ndarray: Days since 1970-01-01.
+    """
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + 9 - 12 * (month > 2)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def parse_timestamps(values, datetime_format=DATETIME_FORMAT):
+    """
+    Parse timestamps into int64 seconds since 1970-01-01, as epoch_seconds does.
+
+    Strings in the exact "%Y-%m-%d %H:%M:%S" layout are parsed from their bytes
+    with integer arithmetic. Anything else, such as missing values, other
+    layouts or impossible dates, goes through epoch_seconds, so the result is
+    the same as parsing everything with pandas, only faster.
+
+    Args:
+        values (array-like): Timestamp strings, or an already parsed datetime column.
+        datetime_format (str): The strftime format of the strings.
+
+    Returns:
+        tuple: The int64 epoch seconds and a boolean mask of the values that
+            could not be parsed. Masked entries hold an undefined value.
+    """
+    if isinstance(values, pd.Series) and values.dtype != object:
+        return epoch_seconds(values, datetime_format)
+    values = np.asarray(values)
+    if datetime_format != DATETIME_FORMAT or values.dtype.kind not in "OUS":
+        return epoch_seconds(pd.Series(values), datetime_format)
+
+    try:
+        # One byte more than the layout, which stays 0 for strings of the right length
+        text = np.ascontiguousarray(values.astype("S20"))
+    except (UnicodeEncodeError, ValueError):
+        return epoch_seconds(pd.Series(values), datetime_format)
+    chars = text.view(np.uint8).reshape(len(text), 20)
+
+    digits = (chars[:, _DIGITS] - ord("0")).astype(np.int64)
+    valid = (digits <= 9).all(axis=1) & (chars[:, 19] == 0)
+    for position, separator in _SEPARATORS.items():
+        valid &= chars[:, position] == separator
+
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    day = digits[:, 6] * 10 + digits[:, 7]
+    hour = digits[:, 8] * 10 + digits[:, 9]
+    minute = digits[:, 10] * 10 + digits[:, 11]
+    second = digits[:, 12] * 10 + digits[:, 13]
+
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = _DAYS_IN_MONTH[np.clip(month, 0, 12)] + ((month == 2) & leap)
+    # Years outside the range of datetime64[ns] are left to pandas
+    valid &= (year > 1677) & (year < 2262) & (month >= 1) & (month <= 12)
+    valid &= (day >= 1) & (day <= month_days) & (hour < 24) & (minute < 60) & (second < 60)
+
+    seconds = (
+        days_from_civil(year, month, day) * SECONDS_PER_DAY
+        + hour * 3600
+        + minute * 60
+        + second
+    )
+    invalid = np.zeros(len(values), dtype=bool)
+    if not valid.all():
+        others = ~valid
+        seconds[others], invalid[others] = epoch_seconds(
+            pd.Series(values[others]), datetime_format
+        )
+    return seconds, invalid
+
+
+def calendar_fields(seconds):
+    """
+    Split epoch seconds into calendar fields with integer arithmetic only.
+
+    The month and day of the month come from the days-to-civil-date algorithm
+    of the proleptic Gregorian calendar, so no datetime objects are created.
+    Only operators are used, so the same code serves a single int and an array.
+
+    Args:
+        seconds (int or np.ndarray): Seconds since 1970-01-01.
+
+    Returns:
+        dict: Feature name -> value, for every name in CALENDAR_FEATURES.
+            weekday is 0 for Monday, as in pandas.
+    """
+    days = seconds // SECONDS_PER_DAY
+    second_of_day = seconds - days * SECONDS_PER_DAY
+
+    # 1970-01-01 was a Thursday
+    weekday = (days + 3) % 7
+
+    # Shift the epoch to 0000-03-01 so that leap days fall at the end of a year
+    z = days + 719468
+    era = z // 146097
+    day_of_era = z - era * 146097
+    year_of_era = (
+        day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096
+    ) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    month_index = (5 * day_of_year + 2) // 153
+    monthday = day_of_year - (153 * month_index + 2) // 5 + 1
+    month = month_index + 3 - 12 * (month_index >= 10)
+
+    hour = second_of_day // 3600
+    minute = second_of_day // 60 % 60
+    second = second_of_day % 60
+
+    return {
+        "weekday": weekday,
+        "month": month,
+        "monthday": monthday,
+        "hour": hour,
+        "minute": minute,
+        "second": second,
+    }
+
+
+def calendar_features(seconds):
+    """
+    Split an array of epoch seconds into uint8 calendar feature arrays.
+
+    Args:
+        seconds (np.ndarray): int64 seconds since 1970-01-01.
+
+    Returns:
+        dict: Feature name -> uint8 array, for every name in CALENDAR_FEATURES.
+    """
+    return {
+        name: np.asarray(values).astype(np.uint8)
+        for name, values in calendar_fields(seconds).items()
+    }
+
+
+def _float_values(values):
+    """
+    Turn a column of numbers, possibly with missing values, into a float64 array.
+    """
+    if isinstance(values, pd.Series):
+        return values.to_numpy(dtype=np.float64, na_value=np.nan)
+    return np.asarray(values, dtype=np.float64)
+
+
+def trip_features(trips, datetime_format=DATETIME_FORMAT, failed=None):
+    """
+    Compute the model features of prepped trips, and which trips are usable.
+
+    A trip is usable when its coordinates are inside COORDINATE_BOUNDS, both
+    timestamps parse, its distance is positive and its passenger count and vendor
+    are known.
+    A missing distance counts as 0 and store_forward is False for the values in
+    STORE_FORWARD_NO and for missing values.
+
+    Args:
+        trips (pd.DataFrame or dict): The TRIP_COLUMNS of the trips, as columns
+            of a frame or arrays of a dict.
+        datetime_format (str): The strftime format of the timestamp strings.
+        failed (dict, optional): Filled with check -> number of trips failing
+            it, for the data profile. A trip can fail several checks.
+
+    Returns:
+        tuple: Feature name -> array, for FEATURE_COLUMNS and trip_duration,
+            and the boolean mask of the usable trips. The features of trips
+            that are not usable hold undefined values.
+    """
+    features = {}
+    valid = None
+    checks = {}
+    for column, (low, high) in COORDINATE_BOUNDS.items():
+        values = _float_values(trips[column]).astype(np.float32)
+        inside = (values >= low) & (values <= high)
+        valid = inside if valid is None else valid & inside
+        checks[f"{column}_outside_city"] = inside
+        features[column] = values
+
+    distance = _float_values(trips["distance"])
+    features["distance"] = np.where(np.isnan(distance), 0, distance).astype(np.float32)
+    checks["no_distance"] = features["distance"] > 0
+    valid &= checks["no_distance"]
+
+    features["passengers"] = _float_values(trips["passengers"])
+    checks["no_passengers"] = ~np.isnan(features["passengers"])
+    valid &= checks["no_passengers"]
+
+    store_forward = np.asarray(trips["store_forward"], dtype=object)
+    features["store_forward"] = ~(np.isin(store_forward, STORE_FORWARD_NO) | pd.isna(store_forward))
+    features["vendor"] = _float_values(trips["vendor"])
+    checks["no_vendor"] = ~np.isnan(features["vendor"])
+    valid &= checks["no_vendor"]
+
+    pickup, pickup_invalid = parse_timestamps(trips["pickup_datetime"], datetime_format)
+    dropoff, dropoff_invalid = parse_timestamps(trips["dropoff_datetime"], datetime_format)
+    checks["bad_timestamp"] = ~(pickup_invalid | dropoff_invalid)
+    valid &= checks["bad_timestamp"]
+    if failed is not None:
+        for check, passed in checks.items():
+            failed[check] = failed.get(check, 0) + len(passed) - int(np.count_nonzero(passed))
+    for prefix, seconds in [("pickup", pickup), ("dropoff", dropoff)]:
+        for name, values in calendar_features(seconds).items():
+            features[f"{prefix}_{name}"] = values
+    features["trip_duration"] = (dropoff - pickup).astype(np.int32)
+    return features, valid
+
+
+def trip_feature_frame(trips, carry=(), datetime_format=DATETIME_FORMAT, failed=None):
+    """
+    Build the feature table of the usable trips of a frame.
+
+    Args:
+        trips (pd.DataFrame): Prepped trips with at least the TRIP_COLUMNS.
+        carry (list[str]): Columns copied over unchanged in front of the
+            features, such as the cost.
+        datetime_format (str): The strftime format of the timestamp strings.
+        failed (dict, optional): Filled with the trips failing each check, see
+            trip_features.
+
+    Returns:
+        pd.DataFrame: The carried columns, FEATURE_COLUMNS and trip_duration of
+            the usable trips, with the FEATURE_DTYPES plan.
+    """
+    features, valid = trip_features(trips, datetime_format, failed)
+
+    table = pd.DataFrame({column: trips[column].to_numpy()[valid] for column in carry})
+    for column in FEATURE_COLUMNS + ["trip_duration"]:
+        table[column] = features[column][valid]
+    # The vendor id is carried over as it is, to keep its integer categories
+    table["vendor"] = trips["vendor"].to_numpy()[valid]
+    return apply_dtypes(table, FEATURE_DTYPES)
+
+
+def _record_seconds(value, datetime_format):
+    """
+    Parse one timestamp like parse_timestamps, without building arrays when the
+    string has the exact "%Y-%m-%d %H:%M:%S" layout.
+    """
+    if (
+        datetime_format == DATETIME_FORMAT
+        and isinstance(value, str)
+        and len(value) == 19
+        and value[4] == value[7] == "-"
+        and value[10] == " "
+        and value[13] == value[16] == ":"
+        and (value[:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:]).isdigit()
+        and value.isascii()
+    ):
+        year, month, day = int(value[:4]), int(value[5:7]), int(value[8:10])
+        hour, minute, second = int(value[11:13]), int(value[14:16]), int(value[17:])
+        leap = year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+        if (
+            1677 < year < 2262
+            and 1 <= month <= 12
+            and 1 <= day <= _MONTH_DAYS[month] + (month == 2 and leap)
+            and hour < 24
+            and minute < 60
+            and second < 60
+        ):
+            return days_from_civil(year, month, day) * SECONDS_PER_DAY + hour * 3600 + minute * 60 + second
+
+    seconds, invalid = parse_timestamps(np.array([value], dtype=object), datetime_format)
+    if invalid[0]:
+        raise ValueError(f"Cannot parse timestamp {value!r}")
+    return int(seconds[0])
+
+
+def _record_float(trip, column):
+    value = trip.get(column)
+    return np.nan if value is None or value is pd.NA else float(value)
+
+
+def _record_missing(value):
+    return value is None or value is pd.NA or (isinstance(value, float) and value != value)
+
+
+def record_features(trip, datetime_format=DATETIME_FORMAT):
+    """
+    Compute the model input of a single prepped trip, as trip_features does.
+
+    Every rule comes from the same constants and calendar arithmetic as
+    trip_features, evaluated on Python scalars, so a trip costs microseconds
+    instead of the fixed overhead of array operations.
+
+    Args:
+        trip (dict): The TRIP_COLUMNS of the trip.
+        datetime_format (str): The strftime format of the timestamp strings.
+
+    Returns:
+        np.ndarray: The float32 features of the trip, in FEATURE_COLUMNS order.
+
+    Raises:
+        ValueError: If the trip is not usable, as described in trip_features.
+    """
+    features = {}
+    for column, (low, high) in _BOUNDS_FLOAT32.items():
+        value = float(np.float32(_record_float(trip, column)))
+        if not low <= value <= high:
+            raise ValueError(f"{column} {value} is outside the city")
+        features[column] = value
+
+    distance = _record_float(trip, "distance")
+    features["distance"] = float(np.float32(0 if distance != distance else distance))
+    if not features["distance"] > 0:
+        raise ValueError("distance has to be positive")
+
+    features["passengers"] = _record_float(trip, "passengers")
+    if features["passengers"] != features["passengers"]:
+        raise ValueError("passengers is missing")
+
+    store_forward = trip.get("store_forward")
+    features["store_forward"] = not (store_forward in STORE_FORWARD_NO or _record_missing(store_forward))
+    features["vendor"] = _record_float(trip, "vendor")
+    if features["vendor"] != features["vendor"]:
+        raise ValueError("vendor is missing")
+
+    pickup = _record_seconds(trip["pickup_datetime"], datetime_format)
+    dropoff = _record_seconds(trip["dropoff_datetime"], datetime_format)
+    for prefix, seconds in [("pickup", pickup), ("dropoff", dropoff)]:
+        for name, value in calendar_fields(seconds).items():
+            features[f"{prefix}_{name}"] = value
+    return np.array([features[column] for column in FEATURE_COLUMNS], dtype=np.float32)
@@ -0,0 +1,410 @@
+"""
+Shared readers and writers for the nyc_taxi pipeline steps.
+
+Each step hands its output to the next one through a uri_folder. CSV is still
+the default hand-off, but "parquet" and "arrow" (Arrow IPC / Feather v2) keep
+the dtypes of every column and let the next step read only the columns it needs.
+"""
+import os
+from pathlib import Path
+import pandas as pd
+
+# Output format name -> file extension written by that format
+DATA_FORMATS = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "arrow": ".arrow",
+}
+
+
+def format_from_path(path):
+    """
+    Work out the data format of a file from its extension.
+
+    Args:
+        path (str or Path): The file to inspect.
+
+    Returns:
+        str: One of the keys of DATA_FORMATS, or None if the extension is unknown.
+    """
+    suffix = Path(path).suffix.lower()
+    for data_format, extension in DATA_FORMATS.items():
+        if suffix == extension:
+            return data_format
+    if suffix == ".feather":
+        return "arrow"
+    return None
+
+
+def list_data_files(folder):
+    """
+    List the readable data files in a folder, in a stable order.
+
+    Args:
+        folder (str or Path): The uri_folder mounted for a step input.
+
+    Returns:
+        list[Path]: The data files, sorted by name.
+    """
+    folder = Path(folder)
+    return [
+        folder / filename
+        for filename in sorted(os.listdir(folder))
+        if format_from_path(filename) is not None
+    ]
+
+
+def find_data_file(folder, stem):
+    """
+    Find the file written for a given output name, whatever its format.
+
+    Args:
+        folder (str or Path): The folder to search.
+        stem (str): The file name without extension, e.g. "merged_data".
+
+    Returns:
+        Path: The matching data file.
+
+    Raises:
+        FileNotFoundError: If no data file with that name exists in the folder.
+    """
+    for path in list_data_files(folder):
+        if path.stem == stem:
+            return path
+    raise FileNotFoundError(f"No data file named '{stem}' in {folder}")
+
+
+def find_data_files(folder, stem):
+    """
+    Find the files of a step output, whether it is a single file or partitioned.
+
+    A partitioned output is a folder named after the output, with the data files
+    spread over puYear=<year>/puMonth=<month> subfolders.
+
+    Args:
+        folder (str or Path): The folder to search.
+        stem (str): The output name, e.g. "merged_data".
+
+    Returns:
+        list[Path]: The data files of the output, in a stable order.
+
+    Raises:
+        FileNotFoundError: If the output does not exist in the folder.
+    """
+    partitioned = Path(folder) / stem
+    if partitioned.is_dir():
+        return sorted(
+            path
+            for path in partitioned.rglob("*")
+            if path.is_file() and format_from_path(path) is not None
+        )
+    return [find_data_file(folder, stem)]
+
+
+def read_frame(path, columns=None, data_format=None, dtype=None):
+    """
+    Read a single data file into a DataFrame.
+
+    Args:
+        path (str or Path): The file to read.
+        columns (list[str], optional): Only read these columns.
+        data_format (str, optional): Override the format detected from the extension.
+        dtype (dict, optional): Column dtypes for CSV files. Parquet and Arrow
+            files already carry their dtypes.
+
+    Returns:
+        pd.DataFrame: The loaded data.
+    """
+    data_format = data_format or format_from_path(path) or "csv"
+    if data_format == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    if data_format == "arrow":
+        return pd.read_feather(path, columns=columns)
+    return pd.read_csv(
+        path, usecols=columns, dtype=dtype, float_precision="round_trip"
+    )
+
+
+def read_columns(path, data_format=None):
+    """
+    Read the column names of a data file without reading its rows.
+
+    Args:
+        path (str or Path): The file to inspect.
+        data_format (str, optional): Override the format detected from the extension.
+
+    Returns:
+        list[str]: The column names.
+    """
+    data_format = data_format or format_from_path(path) or "csv"
+    if data_format == "parquet":
+        import pyarrow.parquet as pq
+
+        return pq.read_schema(path).names
+    if data_format == "arrow":
+        import pyarrow as pa
+
+        with pa.memory_map(str(path), "r") as source:
+            return pa.ipc.open_file(source).schema.names
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def _arrow_type(dtype):
+    """
+    Map a pandas dtype name onto the Arrow type to read a column as.
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    if dtype in ("object", "string", "category"):
+        return pa.string()
+    if dtype == "bool":
+        return pa.bool_()
+    # Nullable integer dtypes such as "Int64" map onto their numpy counterpart
+    return pa.from_numpy_dtype(np.dtype(dtype.lower()))
+
+
+def common_arrow_type(types):
+    """
+    Pick the Arrow type a column read from several files is combined as.
+
+    Null columns take the type of the other files. Integer columns combine as
+    int64, integer and floating point columns as float64, timestamps with the
+    same time zone as the finest of their units, and any other mix as strings.
+
+    Args:
+        types (list[pa.DataType]): The type of the column in each file.
+
+    Returns:
+        pa.DataType: The combined type.
+    """
+    import pyarrow as pa
+
+    distinct = []
+    for type_ in types:
+        if not pa.types.is_null(type_) and type_ not in distinct:
+            distinct.append(type_)
+    if not distinct:
+        return pa.null()
+    if len(distinct) == 1:
+        return distinct[0]
+    if all(pa.types.is_integer(type_) for type_ in distinct):
+        return pa.int64()
+    if all(pa.types.is_integer(type_) or pa.types.is_floating(type_) for type_ in distinct):
+        return pa.float64()
+    if all(pa.types.is_timestamp(type_) and type_.tz == distinct[0].tz for type_ in distinct):
+        unit = max((type_.unit for type_ in distinct), key=["s", "ms", "us", "ns"].index)
+        return pa.timestamp(unit, distinct[0].tz)
+    return pa.string()
+
+
+def read_projected(path, dtype, data_format=None, use_threads=True):
+    """
+    Read only the columns named in dtype, with a multithreaded Arrow reader.
+
+    CSV files are parsed in parallel by pyarrow.csv with the column types given
+    up front, so no type inference or unused column parsing takes place.
+
+    Args:
+        path (str or Path): The file to read.
+        dtype (dict): Column name -> pandas dtype, for the columns to read.
+        data_format (str, optional): Override the format detected from the extension.
+        use_threads (bool): Parse with multiple threads. Turn this off when the
+            caller already reads several files in parallel processes.
+
+    Returns:
+        pd.DataFrame: The requested columns, cast to the requested dtypes.
+    """
+    data_format = data_format or format_from_path(path) or "csv"
+    columns = list(dtype)
+    if data_format == "parquet":
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path, columns=columns, use_threads=use_threads)
+    elif data_format == "arrow":
+        import pyarrow.feather as feather
+
+        table = feather.read_table(
+            str(path), columns=columns, memory_map=True, use_threads=use_threads
+        )
+    else:
+        import pyarrow.csv as pv
+
+        table = pv.read_csv(
+            str(path),
+            read_options=pv.ReadOptions(use_threads=use_threads),
+            convert_options=pv.ConvertOptions(
+                include_columns=columns,
+                column_types={name: _arrow_type(t) for name, t in dtype.items()},
+                strings_can_be_null=True,
+            ),
+        )
+    return table.to_pandas(use_threads=use_threads).astype(dtype)
+
+
+def iter_frames(path, chunk_size, columns=None, data_format=None, dtype=None):
+    """
+    Read a single data file as a sequence of DataFrames of at most chunk_size rows.
+
+    Only one chunk is held in memory at a time. Arrow files are memory-mapped,
+    so their chunks are sliced without a copy.
+
+    Args:
+        path (str or Path): The file to read.
+        chunk_size (int): The maximum number of rows per chunk.
+        columns (list[str], optional): Only read these columns.
+        data_format (str, optional): Override the format detected from the extension.
+        dtype (dict, optional): Column dtypes for CSV files.
+
+    Yields:
+        pd.DataFrame: The next chunk of rows.
+    """
+    data_format = data_format or format_from_path(path) or "csv"
+    if data_format == "parquet":
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    elif data_format == "arrow":
+        import pyarrow as pa
+
+        with pa.memory_map(str(path), "r") as source:
+            table = pa.ipc.open_file(source).read_all()
+            if columns is not None:
+                table = table.select(columns)
+            for batch in table.to_batches(max_chunksize=chunk_size):
+                yield batch.to_pandas()
+    else:
+        # Parse floats exactly, as the Arrow reader in read_projected does
+        yield from pd.read_csv(
+            path,
+            usecols=columns,
+            dtype=dtype,
+            chunksize=chunk_size,
+            float_precision="round_trip",
+        )
+
+
+def write_frame(df, folder, stem, data_format="csv"):
+    """
+    Write a DataFrame to a step output folder.
+
+    The index is not written; every step resets it before saving.
+
+    Args:
+        df (pd.DataFrame): The data to write.
+        folder (str or Path): The uri_folder mounted for the step output.
+        stem (str): The file name without extension.
+        data_format (str): One of the keys of DATA_FORMATS.
+
+    Returns:
+        Path: The file that was written.
+    """
+    if data_format not in DATA_FORMATS:
+        raise ValueError(f"Invalid data format: {data_format}")
+
+    path = Path(folder) / f"{stem}{DATA_FORMATS[data_format]}"
+    if data_format == "parquet":
+        df.to_parquet(path, index=False)
+    elif data_format == "arrow":
+        df.reset_index(drop=True).to_feather(path)
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+
+class FrameWriter:
+    """
+    Append DataFrame chunks to a single step output file.
+
+    The file has the same name and content that write_frame would produce for
+    the concatenated chunks, without holding them in memory. The columns and
+    dtypes of the first chunk fix the schema of the file, except that
+    categorical columns are written as plain values.
+
+    Args:
+        folder (str or Path): The uri_folder mounted for the step output.
+        stem (str): The file name without extension.
+        data_format (str): One of the keys of DATA_FORMATS.
+    """
+
+    def __init__(self, folder, stem, data_format="csv"):
+        if data_format not in DATA_FORMATS:
+            raise ValueError(f"Invalid data format: {data_format}")
+
+        self.path = Path(folder) / f"{stem}{DATA_FORMATS[data_format]}"
+        self.data_format = data_format
+        self.rows = 0
+        self._schema = None
+        self._writer = None
+
+    def write(self, df):
+        """
+        Append a chunk to the output file.
+
+        Args:
+            df (pd.DataFrame): The chunk to append. It may be empty.
+        """
+        if self.data_format == "csv":
+            df.to_csv(
+                self.path,
+                index=False,
+                mode="w" if self._schema is None else "a",
+                header=self._schema is None,
+            )
+            self._schema = list(df.columns)
+        else:
+            self._write_arrow(df)
+        self.rows += len(df)
+
+    def _write_arrow(self, df):
+        import numpy as np
+        import pyarrow as pa
+
+        # The categories of a column can differ from chunk to chunk, and an
+        # Arrow IPC file holds one dictionary per column, so categorical
+        # columns are stored as their values. Readers re-apply the dtype plan.
+        categorical = [
+            column
+            for column in df.columns
+            if isinstance(df[column].dtype, pd.CategoricalDtype)
+        ]
+        if categorical:
+            df = df.assign(**{column: np.asarray(df[column]) for column in categorical})
+
+        if self._schema is None:
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            # An object column with no values in the first chunk is inferred as
+            # null; the values in later chunks are strings.
+            for i, field in enumerate(schema):
+                if pa.types.is_null(field.type):
+                    schema = schema.set(i, pa.field(field.name, pa.string()))
+            self._schema = schema
+            if self.data_format == "parquet":
+                import pyarrow.parquet as pq
+
+                self._writer = pq.ParquetWriter(str(self.path), self._schema)
+            else:
+                self._writer = pa.ipc.new_file(str(self.path), self._schema)
+
+        table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        self._writer.write_table(table)
+
+    def close(self):
+        """
+        Finish the output file.
+
+        Returns:
+            Path: The file that was written.
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
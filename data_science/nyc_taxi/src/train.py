@@ -3,91 +3,455 @@ from pathlib import Path
 from uuid import uuid4
 from datetime import datetime
 import os
+import numpy as np
 import pandas as pd
 from sklearn.linear_model import LinearRegression
 from sklearn.model_selection import train_test_split
 import mlflow
+from feature_store import FeatureStore, FeatureStoreWriter, use_feature_store
+from instrumentation import StepProfiler, add_profile_arguments, span, timed_frames
+from model_sweep import expand_candidates, load_sweep, run_sweep
+from normal_equations import NormalEquations
+from taxi_io import (
+    DATA_FORMATS,
+    FrameWriter,
+    find_data_files,
+    iter_frames,
+    read_frame,
+    write_frame,
+)
+from taxi_schema import (
+    FEATURE_COLUMNS,
+    FEATURE_DTYPES,
+    TARGET_COLUMN,
+    apply_dtypes,
+    feature_matrix,
+    memory_report,
+)
+from step_cache import add_cache_arguments, run_cached
 
 mlflow.sklearn.autolog()
 
-parser = argparse.ArgumentParser("train")
-parser.add_argument("--train_data", type=str, help="Path to train data")
-parser.add_argument("--test_data", type=str, help="Path to test data")
-parser.add_argument("--model_output", type=str, help="Path of output model")
-parser.add_argument("--test_split_ratio", type=float, help="ratio of train test split")
-
-
-args = parser.parse_args()
-
-print("hello training world...")
-
-lines = [
-    f"Train data path: {args.train_data}",
-    f"Test data path: {args.test_data}",
-    f"Model output path: {args.model_output}",
-    f"Test split ratio:{args.test_split_ratio}",
-]
-
-for line in lines:
-    print(line)
-
-print("mounted_path files: ")
-arr = os.listdir(args.train_data)
-print(arr)
-
-df_list = []
-for filename in arr:
-    print("reading file: %s ..." % filename)
-    with open(os.path.join(args.train_data, filename), "r") as handle:
-        # print (handle.read())
-        input_df = pd.read_csv((Path(args.train_data) / filename))
-        df_list.append(input_df)
-
-train_data = df_list[0]
-print(train_data.columns)
-
-# Split the data into input(X) and output(y)
-y = train_data["cost"]
-# X = train_data.drop(['cost'], axis=1)
-X = train_data[
-    [
-        "distance",
-        "dropoff_latitude",
-        "dropoff_longitude",
-        "passengers",
-        "pickup_latitude",
-        "pickup_longitude",
-        "store_forward",
-        "vendor",
-        "pickup_weekday",
-        "pickup_month",
-        "pickup_monthday",
-        "pickup_hour",
-        "pickup_minute",
-        "pickup_second",
-        "dropoff_weekday",
-        "dropoff_month",
-        "dropoff_monthday",
-        "dropoff_hour",
-        "dropoff_minute",
-        "dropoff_second",
+def load_train_data(train_data):
+    """
+    Read every file of the transformed data with the compact dtype plan.
+
+    Args:
+        train_data (str): The folder written by the transform step.
+
+    Returns:
+        pd.DataFrame: The feature and target columns of all files.
+    """
+    print("mounted_path files: ")
+    arr = find_data_files(train_data, "transformed_data")
+    print(arr)
+
+    # Only read the columns the model needs, with the compact dtype plan
+    df_list = []
+    for path in arr:
+        print("reading file: %s ..." % path.name)
+        input_df = read_frame(
+            path, columns=FEATURE_COLUMNS + [TARGET_COLUMN], dtype=FEATURE_DTYPES
+        )
+        df_list.append(apply_dtypes(input_df, FEATURE_DTYPES))
+
+    # A partitioned transform output holds one file per month partition
+    return apply_dtypes(pd.concat(df_list, ignore_index=True), FEATURE_DTYPES)
+
+
+def fit_model(train_data, test_split_ratio):
+    """
+    Split the feature table and fit the linear regression model on the train set.
+
+    Args:
+        train_data (pd.DataFrame): The feature and target columns.
+        test_split_ratio (float): The fraction of rows held out for testing.
+
+    Returns:
+        tuple: The fitted model and the held out test data, with the feature
+            columns followed by the target.
+    """
+    # Split the data into input(X) and output(y)
+    y = train_data[TARGET_COLUMN]
+    # X = train_data.drop(['cost'], axis=1)
+    X = train_data[FEATURE_COLUMNS]
+
+    # Split the data into train and test sets
+    trainX, testX, trainy, testy = train_test_split(
+        X, y, test_size=test_split_ratio, random_state=42
+    )
+    print(trainX.shape)
+    print(trainX.columns)
+
+    # Train a Linear Regression Model with the train set
+    trainX_matrix = feature_matrix(trainX, dtype=np.float64)
+    model = LinearRegression().fit(trainX_matrix, trainy)
+    print(model.score(trainX_matrix, trainy))
+
+    # test_data = pd.DataFrame(testX, columns = )
+    testX[TARGET_COLUMN] = testy
+    print(testX.shape)
+    return model, testX
+
+
+def fit_store(store, test_split_ratio):
+    """
+    Split a feature store and fit the linear regression model on the train rows.
+
+    The split and the model are the same as fit_model gives on the feature
+    table the store was written from.
+
+    Args:
+        store (FeatureStore): The transformed data as a feature store.
+        test_split_ratio (float): The fraction of rows held out for testing.
+
+    Returns:
+        tuple: The fitted model, and the feature matrix and target of the held
+            out test rows.
+    """
+    trainX, testX, trainy, testy = train_test_split(
+        store.features, store.target, test_size=test_split_ratio, random_state=42
+    )
+    print(trainX.shape)
+
+    trainX = trainX.astype(np.float64)
+    model = LinearRegression().fit(trainX, trainy)
+    print(model.score(trainX, trainy))
+    print(testX.shape)
+    return model, testX, testy
+
+
+def train_from_store(args):
+    """
+    Train on the feature store of the transformed data and write the held out
+    test rows as a feature store too.
+
+    Args:
+        args (argparse.Namespace): The parsed step arguments.
+    """
+    with span("read") as record:
+        store = FeatureStore(args.train_data, "transformed_data")
+        record.rows_out = len(store)
+    print("feature store: %d rows, %.1f MB mapped" % (len(store), store.nbytes / 1e6))
+    mlflow.log_metric("train_data_megabytes", store.nbytes / 1e6)
+
+    with span("compute", rows_in=len(store)):
+        model, testX, testy = fit_store(store, args.test_split_ratio)
+    with span("write", rows_in=len(testy)):
+        mlflow.sklearn.save_model(model, args.model_output)
+        with FeatureStoreWriter(args.test_data, "test_data") as writer:
+            writer.append(testX, testy)
+
+
+def train(args):
+    """
+    Train the linear regression model and write it with the held out test data.
+
+    Args:
+        args (argparse.Namespace): The parsed step arguments.
+    """
+    if use_feature_store(
+        args.feature_store.lower() == "true", args.train_data, "transformed_data"
+    ):
+        train_from_store(args)
+        return
+
+    with span("read") as record:
+        train_data = load_train_data(args.train_data)
+        record.rows_out = len(train_data)
+    print(train_data.columns)
+
+    # Log how much memory the feature table takes
+    report = memory_report(train_data)
+    print("train data bytes per row: %.1f" % report["bytes_per_row"])
+    mlflow.log_metric("train_data_bytes_per_row", report["bytes_per_row"])
+    mlflow.log_metric("train_data_megabytes", report["bytes"] / 1e6)
+    mlflow.log_dict(report, "memory_report/train_data.json")
+
+    with span("compute", rows_in=len(train_data)):
+        model, test_data = fit_model(train_data, args.test_split_ratio)
+    with span("write", rows_in=len(test_data)):
+        mlflow.sklearn.save_model(model, args.model_output)
+        write_frame(test_data, args.test_data, "test_data", args.output_format)
+
+
+def train_sweep(args):
+    """
+    Sweep the candidate models of args.sweep and save the best one with the
+    held out test data.
+
+    The test split is the same as fit_model makes. Each candidate is logged as
+    a nested MLflow run, with its validation metrics.
+
+    Args:
+        args (argparse.Namespace): The parsed step arguments.
+    """
+    candidates = expand_candidates(load_sweep(args.sweep))
+    workers = args.workers or os.cpu_count()
+    print("sweeping %d candidates with %d workers ..." % (len(candidates), workers))
+
+    store = None
+    with span("read") as record:
+        if use_feature_store(
+            args.feature_store.lower() == "true", args.train_data, "transformed_data"
+        ):
+            store = FeatureStore(args.train_data, "transformed_data")
+            features, target = store.features, store.target
+        else:
+            train_data = load_train_data(args.train_data)
+            features = feature_matrix(train_data)
+            target = train_data[TARGET_COLUMN].to_numpy()
+        record.rows_out = len(target)
+
+    train_rows, test_rows = train_test_split(
+        np.arange(len(target)), test_size=args.test_split_ratio, random_state=42
+    )
+    with span("compute", rows_in=len(train_rows)):
+        model, results = run_sweep(
+            features, target, train_rows, candidates, workers, args.validation_ratio
+        )
+
+    for result in results:
+        print(
+            "  %-40s validation r2 %.5f, rmse %.4f, fit %.2fs"
+            % (
+                result["name"],
+                result["validation_r2_score"],
+                result["validation_root_mean_squared_error"],
+                result["fit_seconds"],
+            )
+        )
+        with mlflow.start_run(run_name=result["name"], nested=True):
+            mlflow.log_params(
+                {
+                    "estimator": result["estimator"],
+                    "features": ",".join(result["features"])
+                    if len(result["features"]) < len(FEATURE_COLUMNS)
+                    else "all",
+                    **result["params"],
+                }
+            )
+            mlflow.log_metrics(
+                {
+                    key: value
+                    for key, value in result.items()
+                    if key.startswith("validation_") or key == "fit_seconds"
+                }
+            )
+
+    best = max(results, key=lambda result: result["validation_r2_score"])
+    print("best candidate: %s" % best["name"])
+    mlflow.log_param("sweep_best_candidate", best["name"])
+    mlflow.log_dict({"best": best["name"], "candidates": results}, "sweep/results.json")
+
+    with span("write", rows_in=len(test_rows)):
+        mlflow.sklearn.save_model(model, args.model_output)
+        if store is not None:
+            with FeatureStoreWriter(args.test_data, "test_data") as writer:
+                writer.append(store.features[test_rows], store.target[test_rows])
+        else:
+            test_data = train_data.iloc[test_rows][FEATURE_COLUMNS + [TARGET_COLUMN]]
+            write_frame(test_data, args.test_data, "test_data", args.output_format)
+
+
+def stream_files(args, rng, stats):
+    """
+    Fold the transformed data files into the normal equations chunk by chunk.
+
+    Args:
+        args (argparse.Namespace): The parsed step arguments.
+        rng (np.random.Generator): The generator of the train/test draw.
+        stats (NormalEquations): The statistics to update with the train rows.
+
+    Returns:
+        int: The number of test rows written.
+    """
+    with FrameWriter(args.test_data, "test_data", args.output_format) as writer:
+        for path in find_data_files(args.train_data, "transformed_data"):
+            print("reading file: %s in chunks of %d rows ..." % (path.name, args.chunk_size))
+            chunks = iter_frames(
+                path,
+                args.chunk_size,
+                columns=FEATURE_COLUMNS + [TARGET_COLUMN],
+                dtype=FEATURE_DTYPES,
+            )
+            for chunk in timed_frames(chunks):
+                with span("compute", rows_in=len(chunk)):
+                    chunk = apply_dtypes(chunk, FEATURE_DTYPES)
+                    is_test = rng.random(len(chunk)) < args.test_split_ratio
+
+                    train_chunk = chunk[~is_test]
+                    stats.update(
+                        feature_matrix(train_chunk, dtype=np.float64),
+                        train_chunk[TARGET_COLUMN].to_numpy(dtype=np.float64),
+                    )
+                with span("write", rows_in=int(is_test.sum())):
+                    writer.write(chunk[is_test][FEATURE_COLUMNS + [TARGET_COLUMN]])
+    return writer.rows
+
+
+def stream_store(args, rng, stats):
+    """
+    Fold the feature store of the transformed data into the normal equations
+    chunk by chunk, and write the test rows as a feature store.
+
+    The random draw takes one value per row, so the split is the same as
+    stream_files makes over the files the store was written from.
+
+    Args:
+        args (argparse.Namespace): The parsed step arguments.
+        rng (np.random.Generator): The generator of the train/test draw.
+        stats (NormalEquations): The statistics to update with the train rows.
+
+    Returns:
+        int: The number of test rows written.
+    """
+    store = FeatureStore(args.train_data, "transformed_data")
+    print("reading the feature store in chunks of %d rows ..." % args.chunk_size)
+    with FeatureStoreWriter(args.test_data, "test_data") as writer:
+        for start in range(0, len(store), args.chunk_size):
+            features = store.features[start : start + args.chunk_size]
+            target = store.target[start : start + args.chunk_size]
+            with span("compute", rows_in=len(target)):
+                is_test = rng.random(len(target)) < args.test_split_ratio
+                stats.update(
+                    features[~is_test].astype(np.float64),
+                    target[~is_test].astype(np.float64),
+                )
+            with span("write", rows_in=int(is_test.sum())):
+                writer.append(features[is_test], target[is_test])
+    return writer.rows
+
+
+def train_streaming(args):
+    """
+    Train the linear regression model out of core, one chunk at a time.
+
+    Each chunk is split into train and test rows with a seeded random draw.
+    The train rows are folded into the sufficient statistics of the normal
+    equations, the test rows are appended to the test data, and the model is
+    solved once at the end. Memory stays flat whatever the number of rows,
+    and the coefficients are those LinearRegression would fit in memory on
+    the same train rows.
+
+    Args:
+        args (argparse.Namespace): The parsed step arguments.
+    """
+    rng = np.random.default_rng(42)
+    stats = NormalEquations(len(FEATURE_COLUMNS))
+
+    if use_feature_store(
+        args.feature_store.lower() == "true", args.train_data, "transformed_data"
+    ):
+        test_rows = stream_store(args, rng, stats)
+    else:
+        test_rows = stream_files(args, rng, stats)
+
+    print("train rows: %d, test rows: %d" % (stats.count, test_rows))
+    with span("compute"):
+        model = stats.to_estimator()
+        r2 = stats.r2_score(model.coef_)
+    print(r2)
+
+    mlflow.log_param("training_rows", stats.count)
+    mlflow.log_metric("training_r2_score", r2)
+    with span("write"):
+        mlflow.sklearn.save_model(model, args.model_output)
+
+
+def main():
+    """
+    Train the taxi fare model on the transformed data.
+    """
+    parser = argparse.ArgumentParser("train")
+    parser.add_argument("--train_data", type=str, help="Path to train data")
+    parser.add_argument("--test_data", type=str, help="Path to test data")
+    parser.add_argument("--model_output", type=str, help="Path of output model")
+    parser.add_argument("--test_split_ratio", type=float, help="ratio of train test split")
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="csv",
+        choices=list(DATA_FORMATS),
+        help="Format of the test data file",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=0,
+        help="Train out of core on chunks of this many rows (0 loads all the data at once)",
+    )
+    parser.add_argument(
+        "--sweep",
+        type=str,
+        default="none",
+        help="JSON list of candidate models, or the path of a JSON file, to train in parallel and keep the best of (none trains the single model)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to train the sweep candidates with (0 uses every core)",
+    )
+    parser.add_argument(
+        "--validation_ratio",
+        type=float,
+        default=0.2,
+        help="Fraction of the train rows the sweep candidates are compared on",
+    )
+    parser.add_argument(
+        "--feature_store",
+        type=str,
+        default="false",
+        help="Read the transformed data from the feature store transform wrote with --feature_store true, and write the test data as a feature store too",
+    )
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
+
+    args = parser.parse_args()
+
+    # The component command line cannot carry an empty value, so "none" stands
+    # for no sweep
+    if args.sweep.lower() == "none":
+        args.sweep = ""
+
+    print("hello training world...")
+
+    lines = [
+        f"Train data path: {args.train_data}",
+        f"Test data path: {args.test_data}",
+        f"Model output path: {args.model_output}",
+        f"Test split ratio:{args.test_split_ratio}",
+        f"Feature store: {args.feature_store}",
     ]
-]
 
-# Split the data into train and test sets
-trainX, testX, trainy, testy = train_test_split(
-    X, y, test_size=args.test_split_ratio, random_state=42
-)
-print(trainX.shape)
-print(trainX.columns)
+    for line in lines:
+        print(line)
+
+    if args.sweep and args.chunk_size > 0:
+        raise ValueError("A sweep needs the training data in memory, use --chunk_size 0")
+
+    def compute():
+        if args.sweep:
+            train_sweep(args)
+        elif args.chunk_size > 0:
+            train_streaming(args)
+        else:
+            train(args)
 
-# Train a Linear Regression Model with the train set
-model = LinearRegression().fit(trainX, trainy)
-print(model.score(trainX, trainy))
+    # A sweep file is hashed by content, like the input folders
+    inputs = ["train_data"] + (["sweep"] if os.path.isfile(args.sweep) else [])
+    with StepProfiler("train", profile=args.profile.lower() == "true"):
+        run_cached(
+            "train",
+            __file__,
+            args,
+            inputs,
+            ["model_output", "test_data"],
+            compute,
+            ignore=["workers"],
+        )
 
-mlflow.sklearn.save_model(model, args.model_output)
 
-# test_data = pd.DataFrame(testX, columns = )
-testX["cost"] = testy
-print(testX.shape)
-test_data = testX.to_csv(Path(args.test_data) / "test_data.csv")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -5,140 +5,257 @@ from datetime import datetime
 import os
 import pandas as pd
 import numpy as np
+from taxi_io import (
+    DATA_FORMATS,
+    FrameWriter,
+    find_data_files,
+    iter_frames,
+    list_data_files,
+    read_frame,
+    write_frame,
+)
+from feature_store import FeatureStoreWriter, write_feature_store
+from data_profile import DataProfile, add_data_profile_arguments, profile_frame, profiling
+from instrumentation import StepProfiler, add_profile_arguments, span, timed_frames
+from partitions import PartitionManifest
+from spatial_index import SpatialGrid, parse_bounds, spatial_features
+from step_cache import add_cache_arguments, run_cached
+from taxi_features import trip_feature_frame
+from taxi_schema import CLEAN_DTYPES
 
-parser = argparse.ArgumentParser("transform")
-parser.add_argument("--clean_data", type=str, help="Path to prepped data")
-parser.add_argument("--transformed_data", type=str, help="Path of output data")
 
-args = parser.parse_args()
+def transform_data(combined_df, grid=None, geohash_precision=0):
+    """
+    Filter and feature engineer a frame of prepped taxi data.
 
+    The features and filters are those of trip_features, which predict.py and
+    serve.py apply to the trips they score as well. Every operation works row
+    by row, so transforming the data in chunks and concatenating the results
+    gives the same rows as transforming it at once. Inside a DataProfile, the
+    rows kept and the rows failing each filter are added to the profile.
 
-lines = [
-    f"Clean data path: {args.clean_data}",
-    f"Transformed data output path: {args.transformed_data}",
-]
+    Args:
+        combined_df (pd.DataFrame): The prepped green and yellow taxi data.
+        grid (SpatialGrid, optional): Also add the grid cells of the pickup and
+            dropoff, their cell pair and the great-circle distance. These
+            columns are for analysis, they are not among FEATURE_COLUMNS.
+        geohash_precision (int): With a grid, also add the pickup and dropoff
+            geohashes of this many characters. 0 leaves them out.
 
-for line in lines:
-    print(line)
+    Returns:
+        pd.DataFrame: The transformed data, ready for training.
+    """
+    # Filter out coordinates for locations that are outside the city border, replace
+    # undefined store_forward and distance values, and split the pickup and dropoff
+    # datetimes into the day of the week, month, day of the month, hour, minute and
+    # second, plus the trip duration in seconds. The table keeps the compact dtype plan.
+    failed = {} if profiling() else None
+    feature_df = trip_feature_frame(combined_df, carry=["cost"], failed=failed)
 
-print("mounted_path files: ")
-arr = os.listdir(args.clean_data)
-print(arr)
+    # Before you package the dataset, filter it on records where the cost is greater
+    # than zero. Data points with a zero cost are major outliers that throw off
+    # prediction accuracy.
+    final_df = feature_df[feature_df.cost > 0]
+    final_df.reset_index(inplace=True, drop=True)
 
-df_list = []
-for filename in arr:
-    print("reading file: %s ..." % filename)
-    with open(os.path.join(args.clean_data, filename), "r") as handle:
-        # print (handle.read())
-        # ('input_df_%s' % filename) = pd.read_csv((Path(args.training_data) / filename))
-        input_df = pd.read_csv((Path(args.clean_data) / filename))
-        df_list.append(input_df)
+    if grid is not None:
+        final_df = final_df.assign(
+            **spatial_features(final_df, grid, geohash_precision, threads=os.cpu_count())
+        )
 
+    if failed is not None:
+        cost = combined_df["cost"].to_numpy(dtype=np.float64, na_value=np.nan)
+        failed["no_cost"] = int(np.count_nonzero(~(cost > 0)))
+        profile_frame(final_df, rows_in=len(combined_df), failed=failed)
+    return final_df
 
-# Transform the data
-combined_df = df_list[1]
-# These functions filter out coordinates for locations that are outside the city border.
 
-# Filter out coordinates for locations that are outside the city border.
-# Chain the column filter commands within the filter() function
-# and define the minimum and maximum bounds for each field
+def transform_incremental(
+    clean_data, merged_paths, transformed_data, output_format, grid=None, geohash_precision=0
+):
+    """
+    Transform only the prepped parts that are new or changed since the last run.
+
+    The output mirrors the layout of the input: every part of merged_data is
+    transformed into the part of transformed_data at the same relative path,
+    and recorded in the manifest of transformed_data. Parts whose size and
+    checksum match the manifest are reused.
+
+    Args:
+        clean_data (str): The folder written by the prep step.
+        merged_paths (list[Path]): The files of the merged_data output.
+        transformed_data (str): The folder to write the transformed data to. It
+            has to be the same folder as in the previous run for its parts to be reused.
+        output_format (str): The format of the transformed data files.
+        grid (SpatialGrid, optional): The grid of the location features, see
+            transform_data.
+        geohash_precision (int): The precision of the geohash features.
+    """
+    merged_dir = Path(clean_data) / "merged_data"
+    base = merged_dir if merged_dir.is_dir() else Path(clean_data)
+
+    manifest = PartitionManifest(transformed_data, output_format)
+    changed, reused = manifest.plan(base, merged_paths)
+    print("prepped parts reused: %d, to process: %d" % (len(reused), len(changed)))
+
+    for path, key, fingerprint in changed:
+        manifest.forget(key)
+        print("reading file: %s ..." % key)
+        with span("read") as record:
+            merged_df = read_frame(path, dtype=CLEAN_DTYPES)
+            record.rows_out = len(merged_df)
+        with span("compute", rows_in=len(merged_df)) as record:
+            final_df = transform_data(merged_df, grid, geohash_precision)
+            record.rows_out = len(final_df)
+
+        with span("write", rows_in=len(final_df)):
+            folder = Path(transformed_data) / "transformed_data" / Path(key).parent
+            folder.mkdir(parents=True, exist_ok=True)
+            output = write_frame(final_df, folder, Path(key).stem, output_format)
+        manifest.record(key, fingerprint, [output])
+    manifest.save()
+
+
+def main():
+    """
+    Feature engineer the merged data written by the prep step.
+    """
+    parser = argparse.ArgumentParser("transform")
+    parser.add_argument("--clean_data", type=str, help="Path to prepped data")
+    parser.add_argument("--transformed_data", type=str, help="Path of output data")
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="csv",
+        choices=list(DATA_FORMATS),
+        help="Format of the transformed data file",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=0,
+        help="Stream the prepped data in chunks of this many rows (0 loads it all at once)",
+    )
+    parser.add_argument(
+        "--incremental",
+        type=str,
+        default="false",
+        help="Only transform prepped parts that are new or changed since the last run",
+    )
+    parser.add_argument(
+        "--feature_store",
+        type=str,
+        default="false",
+        help="Also write the feature matrix and target as a memory-mapped feature store",
+    )
+    parser.add_argument(
+        "--grid_cell_km",
+        type=float,
+        default=0,
+        help="Add the pickup and dropoff cells of a grid with cells of this size (0 adds no location features)",
+    )
+    parser.add_argument(
+        "--grid_bounds",
+        type=str,
+        default="city",
+        help="Bounds of the grid as min_lat,max_lat,min_lon,max_lon (city uses the city bounds)",
+    )
+    parser.add_argument(
+        "--geohash_precision",
+        type=int,
+        default=0,
+        help="Also add the pickup and dropoff geohashes with this many characters (0 adds none)",
+    )
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
+    add_data_profile_arguments(parser)
+
+    args = parser.parse_args()
+
+    lines = [
+        f"Clean data path: {args.clean_data}",
+        f"Transformed data output path: {args.transformed_data}",
+        f"Chunk size: {args.chunk_size}",
+        f"Incremental: {args.incremental}",
+        f"Feature store: {args.feature_store}",
+        f"Grid cell size (km): {args.grid_cell_km}",
+    ]
+
+    for line in lines:
+        print(line)
+
+    print("mounted_path files: ")
+    arr = list_data_files(args.clean_data)
+    print(arr)
+
+    feature_store = args.feature_store.lower() == "true"
+    if feature_store and args.incremental.lower() == "true":
+        raise ValueError("A feature store cannot be written incrementally")
+
+    grid = None
+    if args.grid_cell_km > 0:
+        grid = SpatialGrid(parse_bounds(args.grid_bounds), args.grid_cell_km)
+        print("spatial grid: %d x %d cells" % (grid.rows, grid.columns))
+
+    # Transform the merged green and yellow data written by the prep step
+    def compute():
+        merged_paths = find_data_files(args.clean_data, "merged_data")
+
+        if args.incremental.lower() == "true":
+            transform_incremental(
+                args.clean_data,
+                merged_paths,
+                args.transformed_data,
+                args.output_format,
+                grid,
+                args.geohash_precision,
+            )
+        elif args.chunk_size > 0:
+            store_writer = None
+            if feature_store:
+                store_writer = FeatureStoreWriter(args.transformed_data, "transformed_data")
+            with FrameWriter(
+                args.transformed_data, "transformed_data", args.output_format
+            ) as writer:
+                for merged_path in merged_paths:
+                    print("reading file: %s in chunks of %d rows ..." % (merged_path.name, args.chunk_size))
+                    chunks = iter_frames(merged_path, args.chunk_size, dtype=CLEAN_DTYPES)
+                    for chunk in timed_frames(chunks):
+                        with span("compute", rows_in=len(chunk)) as record:
+                            final_df = transform_data(chunk, grid, args.geohash_precision)
+                            record.rows_out = len(final_df)
+                        with span("write", rows_in=len(final_df)):
+                            writer.write(final_df)
+                            if store_writer is not None:
+                                store_writer.write(final_df)
+            if store_writer is not None:
+                store_writer.close()
+            print("transformed rows written: %d" % writer.rows)
+        else:
+            with span("read") as record:
+                df_list = []
+                for merged_path in merged_paths:
+                    print("reading file: %s ..." % merged_path.name)
+                    df_list.append(read_frame(merged_path, dtype=CLEAN_DTYPES))
+                combined_df = pd.concat(df_list, ignore_index=True)
+                record.rows_out = len(combined_df)
+            with span("compute", rows_in=len(combined_df)) as record:
+                final_df = transform_data(combined_df, grid, args.geohash_precision)
+                record.rows_out = len(final_df)
+            print(final_df.head)
+            print(final_df.dtypes)
+
+            # Output data
+            with span("write", rows_in=len(final_df)):
+                write_frame(final_df, args.transformed_data, "transformed_data", args.output_format)
+                if feature_store:
+                    write_feature_store(final_df, args.transformed_data, "transformed_data")
+
+    with StepProfiler("transform", profile=args.profile.lower() == "true"), DataProfile(
+        "transform", enabled=args.data_profile.lower() == "true"
+    ):
+        run_cached("transform", __file__, args, ["clean_data"], ["transformed_data"], compute)
 
-combined_df = combined_df.astype(
-    {
-        "pickup_longitude": "float64",
-        "pickup_latitude": "float64",
-        "dropoff_longitude": "float64",
-        "dropoff_latitude": "float64",
-    }
-)
 
-latlong_filtered_df = combined_df[
-    (combined_df.pickup_longitude <= -73.72)
-    & (combined_df.pickup_longitude >= -74.09)
-    & (combined_df.pickup_latitude <= 40.88)
-    & (combined_df.pickup_latitude >= 40.53)
-    & (combined_df.dropoff_longitude <= -73.72)
-    & (combined_df.dropoff_longitude >= -74.72)
-    & (combined_df.dropoff_latitude <= 40.88)
-    & (combined_df.dropoff_latitude >= 40.53)
-]
-
-latlong_filtered_df.reset_index(inplace=True, drop=True)
-
-# These functions replace undefined values and rename to use meaningful names.
-replaced_stfor_vals_df = latlong_filtered_df.replace(
-    {"store_forward": "0"}, {"store_forward": "N"}
-).fillna({"store_forward": "N"})
-
-replaced_distance_vals_df = replaced_stfor_vals_df.replace(
-    {"distance": ".00"}, {"distance": 0}
-).fillna({"distance": 0})
-
-normalized_df = replaced_distance_vals_df.astype({"distance": "float64"})
-
-# These functions transform the renamed data to be used finally for training.
-
-# Split the pickup and dropoff date further into the day of the week, day of the month, and month values.
-# To get the day of the week value, use the derive_column_by_example() function.
-# The function takes an array parameter of example objects that define the input data,
-# and the preferred output. The function automatically determines your preferred transformation.
-# For the pickup and dropoff time columns, split the time into the hour, minute, and second by using
-# the split_column_by_example() function with no example parameter. After you generate the new features,
-# use the drop_columns() function to delete the original fields as the newly generated features are preferred.
-# Rename the rest of the fields to use meaningful descriptions.
-
-temp = pd.DatetimeIndex(normalized_df["pickup_datetime"], dtype="datetime64[ns]")
-normalized_df["pickup_date"] = temp.date
-normalized_df["pickup_weekday"] = temp.dayofweek
-normalized_df["pickup_month"] = temp.month
-normalized_df["pickup_monthday"] = temp.day
-normalized_df["pickup_time"] = temp.time
-normalized_df["pickup_hour"] = temp.hour
-normalized_df["pickup_minute"] = temp.minute
-normalized_df["pickup_second"] = temp.second
-
-temp = pd.DatetimeIndex(normalized_df["dropoff_datetime"], dtype="datetime64[ns]")
-normalized_df["dropoff_date"] = temp.date
-normalized_df["dropoff_weekday"] = temp.dayofweek
-normalized_df["dropoff_month"] = temp.month
-normalized_df["dropoff_monthday"] = temp.day
-normalized_df["dropoff_time"] = temp.time
-normalized_df["dropoff_hour"] = temp.hour
-normalized_df["dropoff_minute"] = temp.minute
-normalized_df["dropoff_second"] = temp.second
-
-del normalized_df["pickup_datetime"]
-del normalized_df["dropoff_datetime"]
-
-normalized_df.reset_index(inplace=True, drop=True)
-
-
-print(normalized_df.head)
-print(normalized_df.dtypes)
-
-
-# Drop the pickup_date, dropoff_date, pickup_time, dropoff_time columns because they're
-# no longer needed (granular time features like hour,
-# minute and second are more useful for model training).
-del normalized_df["pickup_date"]
-del normalized_df["dropoff_date"]
-del normalized_df["pickup_time"]
-del normalized_df["dropoff_time"]
-
-# Change the store_forward column to binary values
-normalized_df["store_forward"] = np.where((normalized_df.store_forward == "N"), 0, 1)
-
-# Before you package the dataset, run two final filters on the dataset.
-# To eliminate incorrectly captured data points,
-# filter the dataset on records where both the cost and distance variable values are greater than zero.
-# This step will significantly improve machine learning model accuracy,
-# because data points with a zero cost or distance represent major outliers that throw off prediction accuracy.
-
-final_df = normalized_df[(normalized_df.distance > 0) & (normalized_df.cost > 0)]
-final_df.reset_index(inplace=True, drop=True)
-print(final_df.head)
-
-# Output data
-transformed_data = final_df.to_csv(
-    (Path(args.transformed_data) / "transformed_data.csv")
-)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
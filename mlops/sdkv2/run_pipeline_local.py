@@ -0,0 +1,246 @@
+"""
+1. Reads the same JSON file of pipelines as create_pipeline.py.
+2. For each pipeline, builds the nyc_taxi_data_regression graph out of the step
+   functions in data_science/nyc_taxi/src, with one prep node per raw file.
+3. Runs the graph locally in a thread or process pool: a node starts as soon as
+   the nodes it depends on are done, and their DataFrames are handed to it in
+   memory instead of through files.
+4. Writes only the pipeline outputs: the trained model, the predictions and the
+   score report.
+
+Usage:
+    python mlops/sdkv2/run_pipeline_local.py variables/dev/pipelines/nyc_taxi/pipelines.json \
+        --output_dir local_runs --executor process --workers 4
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(REPO_ROOT / "data_science" / "nyc_taxi" / "src"))
+
+import mlflow  # noqa: E402
+import pandas as pd  # noqa: E402
+from predict import predict_frame  # noqa: E402
+from prep import group_by_source, read_and_cleanse  # noqa: E402
+from score import score_predictions, write_score_report  # noqa: E402
+from taxi_io import DATA_FORMATS, list_data_files, write_frame  # noqa: E402
+from train import fit_model  # noqa: E402
+from transform import transform_data  # noqa: E402
+
+# The step modules turn autolog on when imported, which would log every local
+# run as an MLflow run
+mlflow.sklearn.autolog(disable=True)
+
+# The components of the nyc_taxi_data_regression pipeline that run locally
+LOCAL_COMPONENTS = [
+    "prep_taxi_data",
+    "taxi_feature_engineering",
+    "train_linear_regression_model",
+    "predict_taxi_fares",
+    "score_model",
+]
+
+
+def prep_file(path, source):
+    """prep_taxi_data on a single raw file."""
+    clean_df, _ = read_and_cleanse(path, source)
+    return clean_df
+
+
+def merge_prepped(*frames):
+    """The merged_data output of prep_taxi_data, in raw file order."""
+    return pd.concat(frames, ignore_index=True)
+
+
+def train_model(transformed_data, test_split_ratio):
+    """train_linear_regression_model, returning the model and the test data."""
+    return fit_model(transformed_data, test_split_ratio)
+
+
+def predict_fares(trained):
+    """predict_taxi_fares on the output of train_model."""
+    model, test_data = trained
+    return predict_frame(model, test_data)
+
+
+def build_graph(raw_data, test_split_ratio):
+    """
+    Build the nyc_taxi_data_regression graph for a folder of raw files.
+
+    Args:
+        raw_data (str or Path): The folder of raw green and yellow taxi files.
+        test_split_ratio (float): The fraction of rows held out for testing.
+
+    Returns:
+        dict: Node name -> (function, names of the nodes whose results are
+            passed to it, extra arguments), in a dependency respecting order.
+    """
+    files = group_by_source(list_data_files(raw_data))
+    prep_nodes = []
+    graph = {}
+    for source, paths in files.items():
+        for path in paths:
+            name = f"prep_taxi_data[{path.name}]"
+            graph[name] = (prep_file, [], [path, source])
+            prep_nodes.append(name)
+
+    graph["merge_prepped"] = (merge_prepped, prep_nodes, [])
+    graph["taxi_feature_engineering"] = (transform_data, ["merge_prepped"], [])
+    graph["train_linear_regression_model"] = (
+        train_model,
+        ["taxi_feature_engineering"],
+        [test_split_ratio],
+    )
+    graph["predict_taxi_fares"] = (predict_fares, ["train_linear_regression_model"], [])
+    graph["score_model"] = (score_predictions, ["predict_taxi_fares"], [])
+    return graph
+
+
+def run_graph(graph, executor, keep=()):
+    """
+    Run every node of a graph once the nodes it depends on are done.
+
+    Results are held in memory, and an intermediate result is released as soon
+    as every node that needs it has started.
+
+    Args:
+        graph (dict): The graph, from build_graph.
+        executor (concurrent.futures.Executor): The pool to run the nodes in.
+        keep (list[str]): Nodes whose results are returned even though other
+            nodes depend on them.
+
+    Returns:
+        dict: Node name -> result, for the nodes in keep and the nodes nothing
+            depends on.
+    """
+    consumers = {name: 0 for name in graph}
+    for _, dependencies, _ in graph.values():
+        for dependency in dependencies:
+            consumers[dependency] += 1
+    intermediate = {
+        name for name, count in consumers.items() if count > 0 and name not in keep
+    }
+
+    results = {}
+    running = {}
+    pending = dict(graph)
+    started = {}
+    while pending or running:
+        for name, (func, dependencies, extra) in list(pending.items()):
+            if all(dependency in results for dependency in dependencies):
+                arguments = [results[dependency] for dependency in dependencies] + extra
+                running[executor.submit(func, *arguments)] = name
+                started[name] = time.perf_counter()
+                print("node started: %s" % name)
+                del pending[name]
+                for dependency in dependencies:
+                    consumers[dependency] -= 1
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = running.pop(future)
+            results[name] = future.result()
+            print("node done: %s in %.2fs" % (name, time.perf_counter() - started[name]))
+
+        # Drop the intermediate DataFrames nothing needs anymore
+        for name in [name for name in results if name in intermediate and consumers[name] == 0]:
+            del results[name]
+    return results
+
+
+def run_pipeline(pipeline_config, output_dir, executor, test_split_ratio, output_format):
+    """
+    Run one pipeline of the JSON file locally and write its outputs.
+
+    Args:
+        pipeline_config (dict): The pipeline entry of the JSON file.
+        output_dir (Path): The folder the pipeline outputs are written under.
+        executor (concurrent.futures.Executor): The pool to run the nodes in.
+        test_split_ratio (float): The fraction of rows held out for testing.
+        output_format (str): The format of the predictions file.
+    """
+    unknown = set(pipeline_config["pipeline_components"]) - set(LOCAL_COMPONENTS)
+    if unknown:
+        raise ValueError(f"Components without a local implementation: {sorted(unknown)}")
+
+    raw_data = REPO_ROOT / pipeline_config["file_paths"]["raw_data_path"]
+    graph = build_graph(raw_data, test_split_ratio)
+
+    start = time.perf_counter()
+    results = run_graph(
+        graph, executor, keep=["train_linear_regression_model", "predict_taxi_fares"]
+    )
+    print("pipeline %s ran in %.2fs" % (pipeline_config["name"], time.perf_counter() - start))
+
+    # Write the declared pipeline outputs only
+    outputs = {
+        name: output_dir / pipeline_config["name"] / name
+        for name in [
+            "pipeline_job_trained_model",
+            "pipeline_job_predictions",
+            "pipeline_job_score_report",
+        ]
+    }
+    for folder in outputs.values():
+        folder.mkdir(parents=True, exist_ok=True)
+
+    model, _ = results["train_linear_regression_model"]
+    mlflow.sklearn.save_model(model, outputs["pipeline_job_trained_model"] / "model")
+    write_frame(
+        results["predict_taxi_fares"],
+        outputs["pipeline_job_predictions"],
+        "predictions",
+        output_format,
+    )
+    write_score_report(model, results["score_model"], outputs["pipeline_job_score_report"])
+
+
+def main():
+    """
+    Run the pipelines of a JSON file locally.
+    """
+    parser = argparse.ArgumentParser("run_pipeline_local")
+    parser.add_argument("config", type=str, help="Path of the pipelines JSON file")
+    parser.add_argument("--output_dir", type=str, default="local_runs", help="Folder of the pipeline outputs")
+    parser.add_argument(
+        "--executor",
+        type=str,
+        default="thread",
+        choices=["thread", "process"],
+        help="Run the nodes in threads of this process or in a local process pool",
+    )
+    parser.add_argument("--workers", type=int, default=0, help="Number of threads or processes (0 uses every core)")
+    parser.add_argument("--test_split_ratio", type=float, default=0.2, help="Test data split ratio")
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="csv",
+        choices=list(DATA_FORMATS),
+        help="Format of the predictions file",
+    )
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = json.load(f)
+
+    workers = args.workers or os.cpu_count()
+    pool = ThreadPoolExecutor if args.executor == "thread" else ProcessPoolExecutor
+    with pool(max_workers=workers) as executor:
+        for pipeline_config in config["pipelines"]:
+            run_pipeline(
+                pipeline_config,
+                Path(args.output_dir),
+                executor,
+                args.test_split_ratio,
+                args.output_format,
+            )
+
+
+if __name__ == "__main__":
+    main()